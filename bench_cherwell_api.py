@@ -0,0 +1,148 @@
+"""
+Benchmarks of the Cherwell and BusinessObjectFactory paths against the offline fake server: startup, single calls,
+bulk creates and updates, query fan-out and attachment throughput.
+
+Run with ``python bench_cherwell_api.py [iterations] [latency in ms]``. Every request to the fake server is delayed
+by the latency, 5ms by default, so that the number of round trips and how many of them overlap show in the timings
+as they would against a real server.
+"""
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import timeit
+from contextlib import contextmanager
+
+from cherwell import Cherwell
+from cherwell_business_object import BusinessObjectFactory, Incident
+from cherwell_cache import business_object_cache
+from cherwell_fake_server import FakeCherwellServer
+from cherwell_pool import CherwellPool
+
+__author__ = 'jptingle'
+
+USERNAME = 'bench'
+PASSWORD = 'bench'
+BULK_OBJECTS = 50
+ATTACHMENT_SIZE = 1024 * 1024
+
+
+@contextmanager
+def quiet():
+    # The library prints progress and errors as it goes
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        yield
+    finally:
+        sys.stdout = stdout
+
+
+def timings(function, iterations):
+    with quiet():
+        times = sorted(timeit.repeat(function, repeat=iterations, number=1))
+    return times[0], times[len(times) // 2]
+
+
+def report(name, times, per=1, unit='calls'):
+    best, median = times
+    print "%-40s best %9.2f ms  median %9.2f ms  (%.1f %s/s)" % (name, best * 1000, median * 1000,
+                                                                  per / best, unit)
+
+
+def bench_startup(server, iterations):
+    report('Cherwell() with bundled WSDL and login',
+           timings(lambda: Cherwell(USERNAME, PASSWORD, server.url, use_bundled_wsdl=True), iterations))
+
+
+def bench_single_calls(cherwell, server, iterations):
+    recid = server.add_object('Incident', {'Summary': 'Benchmark', 'Status': 'New', 'IncidentID': '100000'})
+
+    def get_object():
+        business_object_cache.clear()
+        cherwell.get_bus_obj_by_recid('Incident', recid)
+    report('Cherwell.get_bus_obj_by_recid', timings(get_object, iterations))
+
+    factory = BusinessObjectFactory(cherwell)
+
+    def get_incident():
+        business_object_cache.clear()
+        factory.get_bo_of_type(Incident, '100000')
+    report('BusinessObjectFactory.get_bo_of_type', timings(get_incident, iterations))
+
+    report('BusinessObjectFactory.create_incident',
+           timings(lambda: factory.create_incident('nobody@example.com', 'Benchmark', 'Benchmark incident', 'Service',
+                                                   'Category', 'SubCategory', 'Service Desk'), iterations))
+
+
+def bench_bulk(connection, name, iterations):
+    recids = []
+
+    def create():
+        for result in connection.bulk_create(('Incident', {'Summary': 'Bulk %d' % x}) for x in range(BULK_OBJECTS)):
+            recids.append(result.value)
+
+    def update():
+        for result in connection.bulk_update(('Incident', recid, {'Status': 'Closed'})
+                                             for recid in recids[:BULK_OBJECTS]):
+            pass
+
+    report('%s.bulk_create of %d' % (name, BULK_OBJECTS), timings(create, iterations), BULK_OBJECTS, 'objects')
+    report('%s.bulk_update of %d' % (name, BULK_OBJECTS), timings(update, iterations), BULK_OBJECTS, 'objects')
+
+
+def bench_fan_out(cherwell, pool, server, iterations):
+    for x in range(100):
+        server.add_object('Incident', {'OwnedByTeam': 'Service Desk', 'Priority': str(x % 5),
+                                       'Status': 'New', 'Service': 'Email'})
+    fields = {'OwnedByTeam': 'Service Desk', 'Priority': '1', 'Status': 'New', 'Service': 'Email'}
+    # A single Cherwell runs the queries one at a time on its session, a pool runs them on several
+    for name, connection in (('Cherwell', cherwell), ('CherwellPool', pool)):
+        report('%s.get_bo_ids_matching_fields' % name,
+               timings(lambda: connection.get_bo_ids_matching_fields('Incident', fields), iterations))
+
+
+def bench_attachments(cherwell, server, iterations):
+    recid = server.add_object('Incident', {'Summary': 'Attachments'})
+    directory = tempfile.mkdtemp()
+    try:
+        upload_path = os.path.join(directory, 'upload.bin')
+        with open(upload_path, 'wb') as upload_file:
+            upload_file.write(os.urandom(ATTACHMENT_SIZE))
+        megabytes = ATTACHMENT_SIZE / (1024.0 * 1024)
+
+        report('add_attachment_from_file of %.0fMB' % megabytes,
+               timings(lambda: cherwell.add_attachment_from_file('Incident', recid, 'upload.bin', upload_path),
+                       iterations), megabytes, 'MB')
+
+        attachment_id = server.add_attachment(recid, 'download.bin', os.urandom(ATTACHMENT_SIZE))
+        download_path = os.path.join(directory, 'download.bin')
+        report('download_attachment of %.0fMB' % megabytes,
+               timings(lambda: cherwell.download_attachment(attachment_id, download_path, use_cache=False),
+                       iterations), megabytes, 'MB')
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main(iterations=5, latency_ms=5):
+    server = FakeCherwellServer(USERNAME, PASSWORD, latency=latency_ms / 1000.0).start()
+    pool = CherwellPool(USERNAME, PASSWORD, server.url, size=4, use_bundled_wsdl=True)
+    try:
+        print "%d iterations, %dms latency per request" % (iterations, latency_ms)
+        bench_startup(server, iterations)
+        with quiet():
+            cherwell = Cherwell(USERNAME, PASSWORD, server.url, use_bundled_wsdl=True)
+        bench_single_calls(cherwell, server, iterations)
+        bench_bulk(cherwell, 'Cherwell', iterations)
+        bench_bulk(pool, 'CherwellPool', iterations)
+        bench_fan_out(cherwell, pool, server, iterations)
+        bench_attachments(cherwell, server, iterations)
+    finally:
+        # Close the pool's kept-alive connections, which would otherwise outlive the server
+        pool.logout()
+        server.stop()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
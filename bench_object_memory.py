@@ -0,0 +1,87 @@
+"""
+Memory taken by each business object held in memory, compared with keeping the fields in per-object dicts parsed
+through an element tree the way import_xml used to.
+
+Run with ``python bench_object_memory.py [objects]``.
+"""
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+from cherwell_business_object import BusinessObject
+
+__author__ = 'jptingle'
+
+
+class DictBusinessObject(object):
+    """
+    A business object storing its fields the way BusinessObject did before FieldValues
+    """
+    def __init__(self, type, id):
+        self.type = type
+        self.id = id
+        self.has_pubid = False
+        self.fields = dict()
+        self.field_times = dict()
+        self.missing_fields = dict()
+        self.cherwell_connection = None
+
+    def import_xml(self, business_object_xml):
+        now = time.time()
+        for field in ET.fromstring(business_object_xml.encode('ascii', 'ignore')).find("FieldList"):
+            self.fields[field.get("Name")] = field.text
+            self.field_times[field.get("Name")] = now
+
+
+def make_xml(number, field_count):
+    fields = ''.join('<Field Name="Field%d">Value %d</Field>' % (x, x % 7) for x in range(field_count))
+    return u'<BusinessObject Name="Incident"><FieldList><Field Name="RecID">%032x</Field>%s</FieldList>' \
+           u'</BusinessObject>' % (number, fields)
+
+
+def deep_size(root):
+    """
+    Bytes taken by an object and everything it references, leaving out the schema shared by every object of a type
+    """
+    seen = set()
+    pending = [root]
+    total = 0
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or obj is None or isinstance(obj, type):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            pending.extend(obj.keys())
+            pending.extend(obj.values())
+        elif isinstance(obj, (list, tuple)):
+            pending.extend(obj)
+        if hasattr(obj, '__dict__'):
+            pending.append(obj.__dict__)
+        for base in type(obj).__mro__:
+            for slot in base.__dict__.get('__slots__', ()):
+                if slot not in ('schema', 'cherwell_connection') and hasattr(obj, slot):
+                    pending.append(getattr(obj, slot))
+    return total
+
+
+def main(objects=1000):
+    for field_count in (10, 50, 200):
+        sizes = []
+        for object_class in (DictBusinessObject, BusinessObject):
+            business_objects = []
+            for number in range(objects):
+                if object_class is BusinessObject:
+                    business_object = BusinessObject('Incident', str(number), None)
+                else:
+                    business_object = DictBusinessObject('Incident', str(number))
+                business_object.import_xml(make_xml(number, field_count))
+                business_objects.append(business_object)
+            sizes.append(deep_size(business_objects) / float(objects))
+        print "%3d fields: dict %8.0f bytes/object  compact %8.0f bytes/object  (%.1fx)" % (
+            field_count, sizes[0], sizes[1], sizes[0] / sizes[1])
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
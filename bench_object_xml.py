@@ -0,0 +1,40 @@
+"""
+Micro-benchmark of the business object XML serializers used for creates and updates.
+
+Run with ``python bench_object_xml.py [iterations]``.
+"""
+import sys
+import timeit
+
+from cherwell_business_object import BusinessObjectFactory
+
+__author__ = 'jptingle'
+
+
+def make_fields(count):
+    fields = dict()
+    for x in range(count):
+        fields['Field%d' % x] = 'Value %d with <markup> & "quotes"' % x if x % 5 == 0 else 'Value %d' % x
+    return fields
+
+
+def main(iterations=2000):
+    for count in (10, 200):
+        fields = make_fields(count)
+        etree_xml = BusinessObjectFactory.generate_object_xml_with_etree('Incident', fields)
+        fast_xml = BusinessObjectFactory.generate_object_xml('Incident', fields)
+        assert etree_xml == fast_xml, "serializers disagree for %d fields" % count
+
+        etree_time = min(timeit.repeat(
+            lambda: BusinessObjectFactory.generate_object_xml_with_etree('Incident', fields),
+            repeat=3, number=iterations)) / iterations
+        fast_time = min(timeit.repeat(
+            lambda: BusinessObjectFactory.generate_object_xml('Incident', fields),
+            repeat=3, number=iterations)) / iterations
+
+        print "%3d fields: ElementTree %8.1f us  writer %8.1f us  (%.1fx)" % (
+            count, etree_time * 1e6, fast_time * 1e6, etree_time / fast_time)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,95 @@
+"""
+Client-side cost of the create_incident, create_task and create_journal_entry chain, replayed from a cassette with no
+latency so that only the time spent in this library and suds is measured. Comparing its output across versions
+shows changes in the CPU time and the objects a workflow leaves behind.
+
+Run with ``python bench_replay.py [cassette] [iterations]``. A cassette that does not exist yet is recorded against
+the offline fake server first; one recorded against a real server with RecordingTransport must have been made by
+running the same chain.
+"""
+import gc
+import os
+import StringIO
+import sys
+import time
+from contextlib import contextmanager
+
+from cherwell import Cherwell
+from cherwell_business_object import BusinessObjectFactory
+from cherwell_cache import business_object_cache, field_id_cache, public_id_cache
+from cherwell_fake_server import FakeCherwellServer
+from cherwell_transport import RecordingTransport, ReplayTransport
+
+__author__ = 'jptingle'
+
+APILINK = 'http://localhost/CherwellService/api.asmx'
+
+
+@contextmanager
+def quiet():
+    # The library prints progress and errors as it goes
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        yield
+    finally:
+        sys.stdout = stdout
+
+
+def clear_caches():
+    business_object_cache.clear()
+    field_id_cache.clear()
+    public_id_cache.clear()
+
+
+def run_workflow(cherwell):
+    factory = BusinessObjectFactory(cherwell)
+    incident = factory.create_incident('nobody@example.com', 'Benchmark', 'Benchmark incident', 'Service',
+                                       'Category', 'SubCategory', 'Service Desk')
+    factory.create_task(incident.id, 'Service Desk', 'Nobody', '1', 'Subject', 'Notes')
+    factory.create_journal_entry(incident.id, 'Created a task')
+
+
+def record(cassette_path):
+    server = FakeCherwellServer('bench', 'bench').start()
+    try:
+        server.add_object('CustomerInternal', {'Email': 'nobody@example.com', 'FullName': 'Nobody'})
+        transport = RecordingTransport(cassette_path)
+        clear_caches()
+        with quiet():
+            run_workflow(Cherwell('bench', 'bench', server.url, use_bundled_wsdl=True, transport=transport))
+        transport.close()
+    finally:
+        server.stop()
+
+
+def main(cassette_path='workflow.cassette', iterations=20):
+    if not os.path.exists(cassette_path):
+        record(cassette_path)
+
+    cpu_times = []
+    retained = []
+    for x in range(iterations):
+        with quiet():
+            cherwell = Cherwell('bench', 'bench', APILINK, use_bundled_wsdl=True,
+                                transport=ReplayTransport(cassette_path, time_scale=0))
+        clear_caches()
+        gc.collect()
+        objects = len(gc.get_objects())
+        started = time.clock()
+        with quiet():
+            run_workflow(cherwell)
+        cpu_times.append(time.clock() - started)
+        gc.collect()
+        retained.append(len(gc.get_objects()) - objects)
+
+    cpu_times.sort()
+    retained.sort()
+    print "%d replays of %s" % (iterations, cassette_path)
+    print "CPU time:         best %8.2f ms  median %8.2f ms" % (cpu_times[0] * 1000,
+                                                                  cpu_times[len(cpu_times) // 2] * 1000)
+    print "objects retained: median %d" % retained[len(retained) // 2]
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2] + [int(arg) for arg in sys.argv[2:3]])
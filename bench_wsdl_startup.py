@@ -0,0 +1,51 @@
+"""
+Benchmark of suds client construction for the Cherwell API with and without the service model cache.
+
+Run with ``python bench_wsdl_startup.py [iterations]``. The bundled api.wsdl is used so that no
+server is needed.
+"""
+import shutil
+import sys
+import tempfile
+import timeit
+
+from suds.cache import NoCache
+
+from cherwell import create_soap_client
+
+__author__ = 'jptingle'
+
+APILINK = 'http://localhost/CherwellService/api.asmx'
+
+
+def best_of(function, iterations):
+    return min(timeit.repeat(function, repeat=iterations, number=1))
+
+
+def main(iterations=5):
+    cache_dir = tempfile.mkdtemp()
+    try:
+        def uncached():
+            create_soap_client(APILINK, use_bundled_wsdl=True, cache=NoCache())
+
+        def cold():
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            create_soap_client(APILINK, wsdl_cache_dir=cache_dir, use_bundled_wsdl=True)
+
+        def warm():
+            create_soap_client(APILINK, wsdl_cache_dir=cache_dir, use_bundled_wsdl=True)
+
+        uncached_time = best_of(uncached, iterations)
+        cold_time = best_of(cold, iterations)
+        warm()
+        warm_time = best_of(warm, iterations)
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    print "uncached: %8.1f ms" % (uncached_time * 1000)
+    print "cold:     %8.1f ms" % (cold_time * 1000)
+    print "warm:     %8.1f ms  (%.1fx faster than uncached)" % (warm_time * 1000, uncached_time / warm_time)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -1,20 +1,209 @@
+import hashlib
+import os
+import Queue
+import sys
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
 import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from contextlib import contextmanager
+from StringIO import StringIO
 
+from suds import WebFault
+from suds.cache import ObjectCache
 from suds.client import Client
+from suds.transport import Request, TransportError
+
+from cherwell_bulk import run_bulk
+from cherwell_business_object import BusinessObject, BusinessObjectXmlWriter
+from cherwell_cache import business_object_cache, field_id_cache, public_id_cache
+from cherwell_metrics import CallRecord, CountingReader, MetricsPlugin, carry_caller, current_path, current_tag, \
+    profile_call, soap_metrics, trace_methods
+from cherwell_transport import StreamingTransport, send_streaming
+from cherwell_wsdl import BUNDLED_WSDL, Base64File, Base64Writer, ServiceDescription, SoapFault
 
 # This comment should be...? Not on the current branch
 
 
-class Cherwell_Soap:
-    def __init__(self, username, password, apilink):
-        self.client = Client(apilink)
+def wsdl_cache_key(wsdl_url, wsdl_content):
+    """
+    Key of a cached service model, which changes whenever the WSDL location or content does
+
+    :param wsdl_url: Location the WSDL is loaded from
+    :type wsdl_url: str
+    :param wsdl_content: The raw WSDL document
+    :type wsdl_content: str
+    :return: cache key
+    :rtype: str
+    """
+    content_hash = hashlib.sha1(wsdl_content).hexdigest()
+    return hashlib.sha1(wsdl_url + '\0' + content_hash).hexdigest()
+
+
+def create_soap_client(apilink, wsdl_cache_dir=None, use_bundled_wsdl=False, **options):
+    """
+    Build the suds client for the Cherwell API.
+
+    With *wsdl_cache_dir* the parsed service model (WSDL and schema types) is pickled to disk
+    and loaded from there on the next start instead of being parsed again. With
+    *use_bundled_wsdl* the service model comes from the api.wsdl shipped with this library and
+    *apilink* is only used as the service endpoint, so no request is made before the first call.
+
+    :param apilink: Link to the Cherwell API WSDL or service endpoint
+    :type apilink: str
+    :param wsdl_cache_dir: Directory for the cached service model, None to disable caching
+    :type wsdl_cache_dir: str
+    :param use_bundled_wsdl: Whether to load the bundled api.wsdl instead of fetching apilink
+    :type use_bundled_wsdl: bool
+    :param options: Extra suds client options
+    :return: suds client
+    :rtype: Client
+    """
+    if use_bundled_wsdl:
+        wsdl_url = urlparse.urljoin('file:', urllib.pathname2url(BUNDLED_WSDL))
+        if apilink:
+            options.setdefault('location', apilink.split('?')[0])
+    else:
+        wsdl_url = apilink
+
+    if wsdl_cache_dir is not None:
+        if use_bundled_wsdl:
+            with open(BUNDLED_WSDL, 'rb') as wsdl_file:
+                wsdl_content = wsdl_file.read()
+        else:
+            wsdl_content = urllib2.urlopen(wsdl_url).read()
+        cache_location = os.path.join(wsdl_cache_dir, wsdl_cache_key(wsdl_url, wsdl_content))
+        options['cache'] = ObjectCache(location=cache_location, days=0)
+        options['cachingpolicy'] = 1
+
+    return Client(wsdl_url, **options)
+
+
+class FieldSelectivity(object):
+    """
+    Result sizes of field value queries learned as they run, used to order queries from the most
+    selective field to the least.
+    """
+    def __init__(self, weight=0.5):
+        """
+        :param weight: Weight of the newest result size in the moving average
+        :type weight: float
+        """
+        self.weight = weight
+        self.sizes = dict()
+        self.lock = threading.Lock()
+
+    def record(self, bo_type, field, size):
+        with self.lock:
+            previous = self.sizes.get((bo_type, field))
+            self.sizes[(bo_type, field)] = size if previous is None else \
+                self.weight * size + (1 - self.weight) * previous
+
+    def expected_size(self, bo_type, field):
+        """
+        The learned result size of a field, infinite when the field has not been queried yet
+
+        :rtype: float
+        """
+        with self.lock:
+            return self.sizes.get((bo_type, field), float('inf'))
+
+    def order(self, bo_type, fields):
+        """
+        Order field/value pairs from the most selective field to the least
+
+        :param bo_type: The type of business object queried
+        :type bo_type: str
+        :param fields: The fields to query
+        :type fields: dict
+        :return: the field/value pairs
+        :rtype: list
+        """
+        return sorted(fields.items(), key=lambda item: self.expected_size(bo_type, item[0]))
+
+
+class QueryRowReader(object):
+    """
+    XMLParser target reading the rows of a GetQueryResults or GetItemList result as the result text arrives. Each
+    row is handed to *add_row* as a dict of its attributes and fields once it has been read.
+    """
+    def __init__(self, add_row):
+        self.add_row = add_row
+        self.depth = 0
+        self.row = None
+        self.field_name = None
+        self.text = []
+
+    def start(self, tag, attrib):
+        self.depth += 1
+        if self.depth == 2:
+            self.row = dict(attrib)
+        elif self.depth == 3 and self.row is not None:
+            self.field_name = attrib.get('Name', tag)
+            self.text = []
+
+    def data(self, data):
+        if self.field_name is not None:
+            self.text.append(data)
+
+    def end(self, tag):
+        if self.depth == 3 and self.field_name is not None:
+            self.row[self.field_name] = ''.join(self.text) or None
+            self.field_name = None
+        elif self.depth == 2 and self.row is not None:
+            self.add_row(self.row)
+            self.row = None
+        self.depth -= 1
+
+    def close(self):
+        pass
+
+
+class _ReadCancelled(Exception):
+    """
+    Raised into a paged read when its caller stops iterating
+    """
+
+
+class _ReadFailed(object):
+    """
+    Handed to the caller of a paged read in place of a page when reading failed, to raise the error from there
+    """
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+class Cherwell_Soap(object):
+    # Registry the calls are recorded in
+    metrics = soap_metrics
+
+    def __init__(self, username, password, apilink, wsdl_cache_dir=None, use_bundled_wsdl=False, transport=None):
+        options = dict(transport=transport if transport is not None else StreamingTransport())
+        options['plugins'] = [MetricsPlugin(self)]
+        self.client = create_soap_client(apilink, wsdl_cache_dir, use_bundled_wsdl, **options)
         self.username = username
         self.password = password
+        self.thread_state = threading.local()
+        self.service = None
         if self.login():
             print "Logged in"
         else:
             print self.get_last_error()
 
+    @property
+    def last_error(self):
+        """
+        GetLastError text of the last failed command run by the calling thread, None if it succeeded
+        """
+        return getattr(self.thread_state, 'last_error', None)
+
+    @last_error.setter
+    def last_error(self, error):
+        self.thread_state.last_error = error
+
     def login(self):
         return self.client.service.Login(self.username, self.password)
 
@@ -24,20 +213,197 @@ class Cherwell_Soap:
     def get_last_error(self):
         return self.client.service.GetLastError()
 
-    def is_login_error(self):
-        if self.get_last_error():
-            if 'not logged in' in self.get_last_error():
+    def is_login_error(self, error=None):
+        """
+        Whether an error message means the session is no longer logged in
+
+        :param error: The error to check, fetched with GetLastError when not given
+        :type error: str
+        :return: Whether the error is a session expiry
+        :rtype: bool
+        """
+        if error is None:
+            error = self.get_last_error()
+        if error:
+            if 'not logged in' in error:
                 return True
         return False
 
+    @staticmethod
+    def is_failed_result(result):
+        """
+        Whether the primary response of a SOAP command signals a failure
+
+        :param result: The result returned by the SOAP command
+        :return: Whether the command failed
+        :rtype: bool
+        """
+        return result is None or result is False or result == ''
+
     def run_soap_cmd(self, cmd, *params):
-        result = cmd(*params)
-        if self.is_login_error():
-            result = cmd(*params)
+        """
+        Run a SOAP command. GetLastError is only asked for when the command itself fails, and
+        the command is retried once after logging back in if the session had expired. The call is
+        recorded in the metrics registry.
+
+        :param cmd: The suds service method to call
+        :param params: The parameters of the call
+        :return: result of the command
+        """
+        call = CallRecord(self.operation_name(cmd, params), current_tag(), current_path(), params)
+        outer_call = getattr(self.thread_state, 'call', None)
+        self.thread_state.call = call
+        self.last_error = None
+        result = None
+        try:
+            try:
+                result = self.attempt(call, cmd, params)
+            except (WebFault, SoapFault):
+                self.last_error = self.call_last_error(call)
+                if self.is_login_error(self.last_error) and self.call_login(call):
+                    result = self.attempt(call, cmd, params)
+                    return result
+                raise
+
+            if self.is_failed_result(result):
+                self.last_error = self.call_last_error(call)
+                if self.is_login_error(self.last_error):
+                    if self.call_login(call):
+                        result = self.attempt(call, cmd, params)
+                elif self.last_error is not None and "Please login" not in self.last_error:
+                    print self.last_error
+            return result
+        finally:
+            self.thread_state.call = outer_call
+            if self.is_failed_result(result):
+                call.error = self.last_error or call.operation + " failed"
+            self.metrics.record(call)
+            profile_call(call)
+
+    def operation_name(self, cmd, params):
+        if cmd in (self.send_streamed, self.receive_streamed, self.receive_base64_to_file):
+            return params[0]
+        method = getattr(cmd, 'method', None)
+        return getattr(method, 'name', None) or getattr(cmd, '__name__', 'unknown')
+
+    def attempt(self, call, cmd, params):
+        started = time.time()
+        call.in_attempt = True
+        try:
+            return cmd(*params)
+        finally:
+            call.in_attempt = False
+            call.latencies.append(time.time() - started)
+
+    def call_last_error(self, call):
+        call.last_error_hits += 1
+        return self.get_last_error()
+
+    def call_login(self, call):
+        call.relogins += 1
+        return self.login()
+
+    def count_bytes(self, sent=0, received=0):
+        """
+        Add to the bytes sent and received by the call the calling thread is making
+        """
+        call = getattr(self.thread_state, 'call', None)
+        if call is not None and call.in_attempt:
+            call.request_bytes += sent
+            call.response_bytes += received
+
+    def endpoint(self):
+        return self.client.options.location or self.client.wsdl.services[0].ports[0].location
+
+    def streaming_service(self):
+        if self.service is None:
+            self.service = ServiceDescription()
+        return self.service
+
+    def request_headers(self, operation_name):
+        return {'Content-Type': 'text/xml; charset=utf-8',
+                'SOAPAction': '"' + self.streaming_service().operations[operation_name].soap_action + '"'}
+
+    def send_streamed(self, operation_name, *params):
+        """
+        Call an operation with an envelope that is streamed to the server while it is built, instead of being built
+        in memory by suds. The call goes through the suds client's transport and so uses its session.
+
+        :param operation_name: Name of the operation
+        :type operation_name: str
+        :param params: Values of the operation parameters, in WSDL order, which may be streamed values
+        :return: result of the operation, None when the server answered without a body
+        :raises SoapFault: when the server answered with a fault
+        """
+        request = Request(self.endpoint(), self.streaming_service().request_body(operation_name, *params))
+        request.headers = self.request_headers(operation_name)
+        self.count_bytes(sent=len(request.message))
+        try:
+            reply = self.client.options.transport.send(request)
+        except TransportError as e:
+            # Answers without a body, as suds' own send takes them
+            if e.httpcode in (202, 204):
+                return None
+            # Faults come back as 500 responses
+            if e.httpcode != 500 or e.fp is None:
+                raise
+            reply_xml = e.fp.read()
         else:
-            if self.get_last_error() is not None and "Please login" not in self.get_last_error():
-                print self.get_last_error()
-        return result
+            # The transport returns no reply for 202 and 204 answers
+            if reply is None:
+                return None
+            reply_xml = reply.message
+        self.count_bytes(received=len(reply_xml or ''))
+        return self.service.parse_response(operation_name, reply_xml)
+
+    def receive_streamed(self, operation_name, write, *params):
+        """
+        Call an operation and hand the text of its result to *write* a piece at a time as the response arrives,
+        instead of reading the whole response into memory. The call goes through the suds client's transport and so
+        uses its session; transports without a send_streaming method hold the response in memory.
+
+        :param operation_name: Name of the operation
+        :type operation_name: str
+        :param write: Function taking each piece of the result text
+        :type write: function
+        :param params: Values of the operation parameters, in WSDL order
+        :return: Whether the response had a result
+        :rtype: bool
+        :raises SoapFault: when the server answered with a fault
+        """
+        service = self.streaming_service()
+        request = Request(self.endpoint(), service.build_request(operation_name, *params))
+        request.headers = self.request_headers(operation_name)
+        self.count_bytes(sent=len(request.message))
+        response = send_streaming(self.client.options.transport, request)
+        try:
+            # Faults come back as 500 responses
+            if response.code >= 300 and response.code != 500:
+                raise TransportError("HTTP error %d" % response.code, response.code, StringIO(response.read()))
+            return service.read_streamed_response(operation_name, CountingReader(response, self.count_bytes), write)
+        finally:
+            response.close()
+
+    def receive_base64_to_file(self, operation_name, file_path, *params):
+        """
+        Call an operation whose result is base64 text, decoding the result into a file as it arrives. The file is
+        removed again when the call fails.
+
+        :return: Bytes written to the file, None if the response had no result
+        :rtype: int
+        """
+        written = False
+        try:
+            with open(file_path, 'wb') as out_file:
+                writer = Base64Writer(out_file)
+                if not self.receive_streamed(operation_name, writer.write, *params):
+                    return None
+                writer.close()
+            written = True
+            return writer.size
+        finally:
+            if not written and os.path.exists(file_path):
+                os.remove(file_path)
 
     def get_business_object_by_public_id(self, business_object_type, object_id):
         return self.run_soap_cmd(self.client.service.GetBusinessObjectByPublicId, business_object_type, object_id)
@@ -63,6 +429,28 @@ class Cherwell_Soap:
     def add_attachment_to_record(self, business_object_type, object_record_id, attachment_name, attachment_data):
         return self.run_soap_cmd(self.client.service.AddAttachmentToRecord, business_object_type, object_record_id,
                                                          attachment_name, attachment_data.encode("base64"))
+
+    def add_attachment_from_file(self, business_object_type, object_record_id, attachment_name, file_path):
+        return self.run_soap_cmd(self.send_streamed, 'AddAttachmentToRecord', business_object_type, object_record_id,
+                                 attachment_name, Base64File(file_path))
+
+    def get_attachments_for_business_object(self, business_object_type, object_record_id):
+        return self.run_soap_cmd(self.client.service.GetAttachmentsForBusinessObject, business_object_type,
+                                 object_record_id)
+
+    def get_attachment(self, attachment_id):
+        return self.run_soap_cmd(self.client.service.GetAttachment, attachment_id)
+
+    def download_attachment(self, attachment_id, file_path):
+        return self.run_soap_cmd(self.receive_base64_to_file, 'GetAttachment', file_path, attachment_id)
+
+    def get_query_results(self, query_id, record_limit=0):
+        return self.run_soap_cmd(self.client.service.GetQueryResults, query_id, False, record_limit, False, 0.0, True)
+
+    def get_item_list(self, object_type, object_name_or_id, location='', force_refresh=False):
+        return self.run_soap_cmd(self.client.service.GetItemList, object_type, object_name_or_id, location,
+                                 force_refresh)
+
     def get_business_object_def(self, business_object_type):
         return self.run_soap_cmd(self.client.service.GetBusinessObjectDefinition, business_object_type)
 
@@ -70,8 +458,17 @@ class Cherwell_Soap:
         return self.run_soap_cmd(self.client.service.GetParametersForAction, business_object_type, recid, action)
 
 class Cherwell:
-    def __init__(self, username, password, apilink):
-        self.cherwell = Cherwell_Soap(username, password, apilink)
+    # CherwellMirror answering reads of the types it mirrors, None to read everything from Cherwell
+    mirror = None
+    # DefinitionCache checking creates and updates before they are sent, None to send them unchecked
+    definitions = None
+    # AttachmentCache keeping downloaded attachments across runs, None to download them every time
+    attachment_cache = None
+
+    def __init__(self, username, password, apilink, **soap_options):
+        self.cherwell = Cherwell_Soap(username, password, apilink, **soap_options)
+        self.field_selectivity = FieldSelectivity()
+        self.session_lock = threading.RLock()
 
     def logout(self):
         self.cherwell.logout()
@@ -79,6 +476,32 @@ class Cherwell:
     def login(self):
         self.cherwell.login()
 
+    def endpoint(self):
+        """
+        URL of the server, telling its objects apart from other servers' in the shared caches
+
+        :rtype: str
+        """
+        return self.cherwell.endpoint()
+
+    def worker_count(self, max_workers=None):
+        """
+        Most calls to run at once. Cherwell keeps one last error per session, so a single connection runs its calls
+        one at a time whatever is asked for; a CherwellPool runs up to *max_workers*.
+
+        :rtype: int
+        """
+        return 1
+
+    @contextmanager
+    def session(self):
+        """
+        Use this connection for several calls, like CherwellPool.session does with one of its sessions. Cherwell
+        keeps one last error per session, so other threads' sessions wait until the block ends.
+        """
+        with self.session_lock:
+            yield self
+
     def get_bus_obj_by_publicid(self, business_object_type, object_id):
         """
         Gets a business object by its public id
@@ -91,6 +514,10 @@ class Cherwell:
         :rtype: str
         """
         try:
+            if self.mirror is not None:
+                business_object_xml = self.mirror.get_xml(business_object_type, object_id, is_pubid=True)
+                if business_object_xml is not None:
+                    return business_object_xml
             business_object_xml = self.cherwell.get_business_object_by_public_id(business_object_type, object_id)
             return business_object_xml
         except Exception as e:
@@ -109,6 +536,10 @@ class Cherwell:
         :rtype: str
         """
         try:
+            if self.mirror is not None:
+                business_object_xml = self.mirror.get_xml(business_object_type, object_id)
+                if business_object_xml is not None:
+                    return business_object_xml
             business_object_xml = self.cherwell.get_business_object(business_object_type,
                                                                         object_id)
             return business_object_xml
@@ -116,6 +547,76 @@ class Cherwell:
         except Exception as e:
             print e.message
 
+    def get_many(self, business_object_type, object_ids, wantpubid=True, max_workers=None):
+        """
+        Get many business objects at once. Repeated ids are fetched once, objects in the business object cache are
+        not fetched at all, and on a CherwellPool the rest are fetched on up to *max_workers* sessions while this
+        thread parses what they have downloaded. A single Cherwell connection fetches them one at a time.
+
+        :param business_object_type: The type of business object to get
+        :type business_object_type: str
+        :param object_ids: The ids of the objects
+        :type object_ids: list
+        :param wantpubid: Whether the ids are public ids rather than record ids
+        :type wantpubid: bool
+        :param max_workers: Most objects to fetch at once
+        :type max_workers: int
+        :return: the object of each id in the order given, None where it could not be fetched
+        :rtype: list
+
+        **Example**::
+
+            tasks = cherwell_server.get_many('Task', incident.get_task_ids())
+        """
+        found = dict()
+        pending = Queue.Queue()
+        endpoint = self.endpoint()
+        for object_id in OrderedDict.fromkeys(object_ids):
+            business_object = business_object_cache.get(endpoint, business_object_type, object_id, wantpubid)
+            if business_object is None:
+                pending.put(object_id)
+            else:
+                found[object_id] = business_object
+
+        misses = pending.qsize()
+        fetched = Queue.Queue()
+
+        def fetch_objects():
+            while True:
+                try:
+                    object_id = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                business_object_xml = None
+                try:
+                    with self.session() as session:
+                        fetch = session.get_bus_obj_by_publicid if wantpubid else session.get_bus_obj_by_recid
+                        business_object_xml = fetch(business_object_type, object_id)
+                finally:
+                    fetched.put((object_id, business_object_xml))
+
+        worker_count = min(self.worker_count(max_workers), misses)
+        workers = []
+        if worker_count == 1:
+            fetch_objects()
+        else:
+            workers = [threading.Thread(target=carry_caller(fetch_objects)) for x in range(worker_count)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for x in range(misses):
+            object_id, business_object_xml = fetched.get()
+            if business_object_xml:
+                business_object = BusinessObject(business_object_type, object_id, self)
+                business_object.has_pubid = wantpubid
+                business_object.import_xml(business_object_xml)
+                business_object_cache.add(business_object)
+                found[object_id] = business_object
+        for worker in workers:
+            worker.join()
+
+        return [found.get(object_id) for object_id in object_ids]
+
     def query_by_field_value(self, business_object_type, field, value, wantpubid=True):
         """
         Query for business objects that match a specific field
@@ -132,6 +633,10 @@ class Cherwell:
         :rtype: list
         """
         try:
+            if self.mirror is not None:
+                mirrored_ids = self.mirror.match(business_object_type, {field: value}, wantpubid)
+                if mirrored_ids is not None:
+                    return mirrored_ids
             query_result = self.cherwell.query_by_field_value(business_object_type, field, value)
             parsed_query_result = self.parse_query(query_result, wantpubid)
 
@@ -160,21 +665,256 @@ class Cherwell:
             print "Query Failed"
             return []
 
+    def iter_query_by_field_value(self, business_object_type, field, value, wantpubid=True, wantboth=False):
+        """
+        Query for business objects that match a specific field, yielding their ids as the result is parsed
+
+        :param business_object_type: Type of business object to query for
+        :type business_object_type: str
+        :param field: Field to match
+        :type field: str
+        :param value: Value of field to match
+        :type value: str
+        :param wantpubid: Whether or not you want a public id as a result
+        :type wantpubid: bool
+        :param wantboth: Whether you want (record id, public id) pairs as a result
+        :type wantboth: bool
+        :return: query results
+        :rtype: generator
+        """
+        query_result = self.cherwell.query_by_field_value(business_object_type, field, value)
+        return self.iter_query_ids(query_result) if wantboth else self.iter_query(query_result, wantpubid)
+
+    def iter_query_by_stored_query(self, business_object_type, query_name, scope='Global', wantpubid=True,
+                                   wantboth=False):
+        """
+        Query for business objects that match a specific stored query, yielding their ids as the result is parsed
+
+        :param business_object_type: Type of business object to query for
+        :param query_name: The name of the query in the system
+        :param scope: Where the query is stored in the system
+        :param wantpubid: Whether or not you want a public id as a result
+        :param wantboth: Whether you want (record id, public id) pairs as a result
+        :return: query results
+        :rtype: generator
+        """
+        query_result = self.cherwell.query_by_stored_query(business_object_type, query_name, scope)
+        return self.iter_query_ids(query_result) if wantboth else self.iter_query(query_result, wantpubid)
+
+    def iter_query_ids(self, query_result):
+        """
+        Parse a query result incrementally, yielding the record id and public id of each record as soon as it has
+        been read. Records are dropped once yielded, so large results never exist as a full tree in memory.
+
+        :param query_result: XML result of a query
+        :type query_result: str
+        :return: (record id, public id) of each record
+        :rtype: generator
+        """
+        if isinstance(query_result, unicode):
+            query_result = query_result.encode('utf-8')
+        parents = []
+        for event, element in ET.iterparse(StringIO(query_result), events=('start', 'end')):
+            if event == 'start':
+                parents.append(element)
+                continue
+            parents.pop()
+            if element.tag == 'Record':
+                yield element.get('RecId'), element.text
+                if parents:
+                    parents[-1].remove(element)
+
+    def iter_query(self, query_result, wantpubid=False):
+        for recid, public_id in self.iter_query_ids(query_result):
+            yield public_id if wantpubid else recid
+
     def parse_query(self, query_result, wantpubid=False):
-        parsed_result_list = []
-        root = ET.fromstring(query_result)
+        return list(self.iter_query(query_result, wantpubid))
+
+    def parse_query_ids(self, query_result):
+        """
+        Parse both the record id and the public id of every record in a query result
+
+        :param query_result: XML result of a query
+        :type query_result: str
+        :return: (record id, public id) of each record
+        :rtype: list
+        """
+        return list(self.iter_query_ids(query_result))
+
+    def iter_query_results(self, business_object_type, query_id, record_limit=0, page_size=500):
+        """
+        Run a stored query with GetQueryResults and yield a BusinessObject holding the fields of each row, so the
+        rows of a query take one call instead of one call each. The result is parsed as it arrives and handed over
+        a page at a time, the next page being read while the caller works through the current one. Objects already
+        in the shared business object cache are updated and reused.
+
+        On a CherwellPool the read holds one session until the results have been read or the iteration stops.
+
+        :param business_object_type: Type of business object the query returns
+        :type business_object_type: str
+        :param query_id: Name or id of the stored query
+        :type query_id: str
+        :param record_limit: Most rows to return, 0 for all of them
+        :type record_limit: int
+        :param page_size: Rows to read ahead of the caller
+        :type page_size: int
+        :return: the object of each row
+        :rtype: generator
+
+        **Example**::
+
+            for incident in cherwell_server.iter_query_results('Incident', 'Open Security Incidents'):
+                print incident['IncidentID'], incident['Status']
+        """
+        for rows in self.iter_result_pages('GetQueryResults', (query_id, False, record_limit, False, 0.0, True),
+                                           page_size):
+            for row in rows:
+                yield self.row_object(business_object_type, row)
+
+    def iter_item_list(self, object_type, object_name_or_id, location='', force_refresh=False, page_size=500):
+        """
+        List items with GetItemList, yielding the attributes and fields of each item, read a page at a time like
+        iter_query_results
+
+        :param object_type: Type of the items to list
+        :type object_type: str
+        :param object_name_or_id: Name or id of the object whose items to list
+        :type object_name_or_id: str
+        :param location: Location of the items
+        :type location: str
+        :param force_refresh: Whether the server should refresh the list first
+        :type force_refresh: bool
+        :param page_size: Items to read ahead of the caller
+        :type page_size: int
+        :return: a dict of each item
+        :rtype: generator
+        """
+        for rows in self.iter_result_pages('GetItemList', (object_type, object_name_or_id, location, force_refresh),
+                                           page_size):
+            for row in rows:
+                yield row
+
+    def iter_result_pages(self, operation_name, params, page_size=500, errors=None):
+        """
+        Call an operation returning rows and yield them a page at a time. A thread reads and parses the response
+        while the previous page is being used, and waits once it has a page ready.
+
+        :param operation_name: The operation to call
+        :type operation_name: str
+        :param params: The parameters of the operation
+        :type params: tuple
+        :param page_size: Most rows in a page
+        :type page_size: int
+        :param errors: List to append the error to when the server refuses the call or answers it with a fault, which
+            then just ends the pages. Without it a fault is raised, and a refused call just ends the pages.
+        :type errors: list
+        :return: lists of row dicts
+        :rtype: generator
+        :raises: any other error of the read, once the pages read before it have been yielded
+        """
+        pages = Queue.Queue(1)
+        stopped = threading.Event()
+        page = []
+
+        def put(rows):
+            while True:
+                if stopped.is_set():
+                    raise _ReadCancelled()
+                try:
+                    pages.put(rows, timeout=0.1)
+                    return
+                except Queue.Full:
+                    pass
+
+        def add_row(row):
+            page.append(row)
+            if len(page) >= page_size:
+                put(page[:])
+                del page[:]
+
+        def read():
+            end = None
+            try:
+                parser = ET.XMLParser(target=QueryRowReader(add_row))
+
+                def feed(text):
+                    parser.feed(text.encode('utf-8') if isinstance(text, unicode) else text)
+
+                with self.session() as session:
+                    if session.cherwell.run_soap_cmd(session.cherwell.receive_streamed, operation_name, feed,
+                                                     *params):
+                        parser.close()
+                    elif errors is not None:
+                        errors.append(session.cherwell.last_error or operation_name + " failed")
+                if page:
+                    put(page[:])
+            except _ReadCancelled:
+                return
+            except (WebFault, SoapFault) as e:
+                if errors is None:
+                    end = _ReadFailed(sys.exc_info())
+                else:
+                    # A fault answers the whole call, so no rows were read
+                    print e.message
+                    errors.append(str(e) or e.__class__.__name__)
+            except Exception:
+                end = _ReadFailed(sys.exc_info())
+            try:
+                put(end)
+            except _ReadCancelled:
+                pass
+
+        reader = threading.Thread(target=carry_caller(read))
+        reader.daemon = True
+        reader.start()
         try:
-            for Record in root.iter("Record"):
-                business_object_id = Record.get('RecId') if not wantpubid else Record.text
-                parsed_result_list.append(business_object_id)
-        except:
-            for Record in root.getiterator("Record"):
-                business_object_id = Record.get('RecId') if not wantpubid else Record.text
-                parsed_result_list.append(business_object_id)
+            while True:
+                rows = pages.get()
+                if rows is None:
+                    return
+                if isinstance(rows, _ReadFailed):
+                    raise rows.exc_info[0], rows.exc_info[1], rows.exc_info[2]
+                yield rows
+        finally:
+            stopped.set()
+            reader.join()
+
+    def row_object(self, business_object_type, row):
+        """
+        Get the business object of a query result row, holding the fields of the row
+        """
+        recid = row.pop('RecId', None) or row.get('RecID')
+        business_object = business_object_cache.get(self.endpoint(), business_object_type, recid) if recid else None
+        if business_object is None:
+            business_object = BusinessObject(business_object_type, recid, self)
+        if recid:
+            row['RecID'] = recid
+        business_object.import_fields(row)
+        business_object_cache.add(business_object)
+        return business_object
+
+    def query_ids_by_field_value(self, business_object_type, field, value):
+        """
+        Query for the record and public ids of business objects that match a specific field
 
-        return parsed_result_list
+        :param business_object_type: Type of business object to query for
+        :type business_object_type: str
+        :param field: Field to match
+        :type field: str
+        :param value: Value of field to match
+        :type value: str
+        :return: (record id, public id) of each match
+        :rtype: list
+        """
+        try:
+            query_result = self.cherwell.query_by_field_value(business_object_type, field, value)
+            return self.parse_query_ids(query_result)
+        except:
+            print "Query failed"
+            return []
 
-    def update_business_object(self, object_id, object_type, update_xml, givenrecid=True):
+    def update_business_object(self, object_id, object_type, update_xml, givenrecid=True, field_dict=None):
         """
         Update a business object's fields
 
@@ -184,10 +924,15 @@ class Cherwell:
         :type update_object: BusinessObject
         :param givenrecid: Whether or not object_id is a rec id or not
         :type givenrecid: bool
+        :param field_dict: The fields update_xml was written from, checked instead of reading them back from the XML
+        :type field_dict: dict
         :return: result of the update
         :rtype: str
         """
         try:
+            if not self.check_fields(object_type, update_xml, field_dict):
+                print "Object " + str(object_id) + " failed to update"
+                return False
             if givenrecid:
                 update_result = self.cherwell.update_business_object(object_type,
                                                                          object_id,
@@ -198,26 +943,151 @@ class Cherwell:
                                                                                    update_xml)
             if update_result is False:
                 print "Object " + str(object_id) + " failed to update"
+            else:
+                business_object_cache.invalidate(self.endpoint(), object_type, object_id, is_pubid=not givenrecid)
+                if self.mirror is not None:
+                    self.mirror.invalidate(object_type, object_id, is_pubid=not givenrecid)
             return update_result
         except Exception as e:
             print e.message
 
-    def create_business_object(self, business_object_type, business_object_xml):
+    def create_business_object(self, business_object_type, business_object_xml, field_dict=None):
         """
         Create a business object on Cherwell according to the business object given
 
         :param business_object: The business object to make
         :type business_object: BusinessObject
+        :param field_dict: The fields business_object_xml was written from, checked instead of reading them back
+                           from the XML
+        :type field_dict: dict
         :return: record id of the created object
         """
         try:
-
+            if not self.check_fields(business_object_type, business_object_xml, field_dict, creating=True):
+                return None
             object_recid = self.cherwell.create_business_object(business_object_type,
                                                                     business_object_xml)
+            if object_recid:
+                business_object_cache.invalidate(self.endpoint(), business_object_type, object_recid)
+                if self.mirror is not None:
+                    self.mirror.invalidate(business_object_type, object_recid)
             return object_recid
         except Exception as e:
             print e.message
 
+    def get_business_object_definition(self, business_object_type):
+        """
+        Gets the definition of a business object type
+
+        :param business_object_type: The type of business object
+        :type business_object_type: str
+        :return: definition of the type
+        :rtype: str
+        """
+        try:
+            return self.cherwell.get_business_object_def(business_object_type)
+        except Exception as e:
+            print e.message
+
+    def check_fields(self, business_object_type, business_object_xml, field_dict=None, creating=False):
+        """
+        Check the fields of a create or update against the type's definition, when there are definitions to check
+        against. What is wrong is printed and kept as the last error, as if Cherwell had rejected the call.
+
+        :param business_object_type: The type of business object
+        :type business_object_type: str
+        :param business_object_xml: The XML to be sent
+        :type business_object_xml: str
+        :param field_dict: The fields the XML was written from, None to read them from the XML
+        :type field_dict: dict
+        :param creating: Whether the XML creates the object
+        :type creating: bool
+        :return: Whether the fields can be sent
+        :rtype: bool
+        """
+        if self.definitions is None:
+            return True
+        if field_dict is None:
+            if isinstance(business_object_xml, unicode):
+                business_object_xml = business_object_xml.encode('utf-8')
+            field_dict = dict((field.get('Name'), field.text)
+                              for field in ET.fromstring(business_object_xml).iter('Field'))
+        problems = self.definitions.check(self, business_object_type, field_dict, creating)
+        if problems:
+            self.cherwell.last_error = "; ".join(problems)
+            print self.cherwell.last_error
+            return False
+        return True
+
+    def bulk_create(self, objects, max_workers=None, max_pending=None, rate=None, checkpoint_path=None):
+        """
+        Create many business objects, running up to *max_workers* creates at once on a CherwellPool, each on its own
+        session. A single Cherwell connection runs them one at a time.
+
+        :param objects: (type, fields) of each object to create
+        :type objects: iterable
+        :param max_workers: Most creates to run at once
+        :type max_workers: int
+        :param max_pending: Most objects read ahead and results waiting to be consumed
+        :type max_pending: int
+        :param rate: Most creates to start per second, None for no limit
+        :type rate: float
+        :param checkpoint_path: File recording the objects created so far, so a restarted run skips them
+        :type checkpoint_path: str
+        :return: generator of a BulkResult per object, holding its record id or error, in the order they finish
+        :rtype: generator
+
+        **Example**::
+
+            for result in cherwell_server.bulk_create(('Incident', fields) for fields in rows):
+                if not result.ok:
+                    print result.index, result.error
+        """
+        def create(bo_object):
+            bo_type, fields = bo_object
+            creation_xml = BusinessObjectXmlWriter.for_type(bo_type).write(fields)
+            with self.session() as session:
+                recid = session.create_business_object(bo_type, creation_xml, fields)
+                if recid:
+                    return recid, None
+                return None, session.cherwell.last_error or "CreateBusinessObject failed"
+
+        return run_bulk(objects, carry_caller(create), self.worker_count(max_workers), max_pending, rate,
+                        checkpoint_path)
+
+    def bulk_update(self, objects, givenrecid=True, max_workers=None, max_pending=None, rate=None,
+                    checkpoint_path=None):
+        """
+        Update many business objects, running up to *max_workers* updates at once on a CherwellPool, each on its own
+        session. A single Cherwell connection runs them one at a time.
+
+        :param objects: (type, id, fields) of each object to update
+        :type objects: iterable
+        :param givenrecid: Whether the ids are record ids rather than public ids
+        :type givenrecid: bool
+        :param max_workers: Most updates to run at once
+        :type max_workers: int
+        :param max_pending: Most objects read ahead and results waiting to be consumed
+        :type max_pending: int
+        :param rate: Most updates to start per second, None for no limit
+        :type rate: float
+        :param checkpoint_path: File recording the objects updated so far, so a restarted run skips them
+        :type checkpoint_path: str
+        :return: generator of a BulkResult per object, holding the update result or error, in the order they finish
+        :rtype: generator
+        """
+        def update(bo_object):
+            bo_type, object_id, fields = bo_object
+            update_xml = BusinessObjectXmlWriter.for_type(bo_type).write(fields)
+            with self.session() as session:
+                update_result = session.update_business_object(object_id, bo_type, update_xml, givenrecid, fields)
+                if update_result:
+                    return update_result, None
+                return None, session.cherwell.last_error or "UpdateBusinessObject failed"
+
+        return run_bulk(objects, carry_caller(update), self.worker_count(max_workers), max_pending, rate,
+                        checkpoint_path)
+
     def add_attachment_to_record(self, business_object_type, object_record_id,
                                  attachment_name, attachment_data):
         """
@@ -229,7 +1099,7 @@ class Cherwell:
         :type object_record_id: str
         :param attachment_name: Name of the attachment
         :type attachment_name: str
-        :param attachment_data: Data of the attachment
+        :param attachment_data: Data of the attachment, base64 encoded once on the way to Cherwell
         :type attachment_data: str
         :return: result of attachment
         :rtype: str
@@ -237,33 +1107,159 @@ class Cherwell:
         try:
             attachment_result = self.cherwell.add_attachment_to_record(
                 business_object_type, object_record_id,
-                attachment_name, attachment_data.encode("base64")
+                attachment_name, attachment_data
             )
             return attachment_result
         except Exception as e:
             print e.message
 
-    def get_bo_ids_matching_fields(self, bo_type, fields, wantPubId=True):
+    def add_attachment_from_file(self, business_object_type, object_record_id, attachment_name, file_path):
+        """
+        Attach a file to a business object. The file is read, encoded and sent a chunk at a time, so uploads take
+        the same memory whatever the size of the file.
+
+        :param business_object_type: Type of business object
+        :type business_object_type: str
+        :param object_record_id: record id of the object to attach to
+        :type object_record_id: str
+        :param attachment_name: Name of the attachment
+        :type attachment_name: str
+        :param file_path: Path of the file to attach
+        :type file_path: str
+        :return: result of attachment
+        :rtype: bool
+        """
+        try:
+            return self.cherwell.add_attachment_from_file(business_object_type, object_record_id,
+                                                          attachment_name, file_path)
+        except Exception as e:
+            print e.message
+
+    def get_attachments(self, business_object_type, object_record_id):
+        """
+        List the attachments of a business object
+
+        :param business_object_type: Type of business object
+        :type business_object_type: str
+        :param object_record_id: record id of the object
+        :type object_record_id: str
+        :return: the attributes of each attachment, such as its Id and Name
+        :rtype: list
+        """
+        try:
+            attachments_xml = self.cherwell.get_attachments_for_business_object(business_object_type,
+                                                                                object_record_id)
+            if not attachments_xml:
+                return []
+            if isinstance(attachments_xml, unicode):
+                attachments_xml = attachments_xml.encode('utf-8')
+            attachments = []
+            for attachment_element in ET.fromstring(attachments_xml):
+                attachment = dict(attachment_element.attrib)
+                for child in attachment_element:
+                    attachment[child.tag] = child.text
+                attachments.append(attachment)
+            return attachments
+        except Exception as e:
+            print e.message
+            return []
+
+    def download_attachment(self, attachment_id, file_path, use_cache=True):
+        """
+        Download an attachment to a file. The attachment is decoded into the file as it arrives, so downloads take
+        the same memory whatever the size of the attachment. With an attachment_cache, attachments already in it
+        are copied from there instead of being downloaded again.
+
+        :param attachment_id: Id of the attachment
+        :type attachment_id: str
+        :param file_path: Path of the file to write
+        :type file_path: str
+        :param use_cache: Whether to look the attachment up in, and add it to, the attachment cache
+        :type use_cache: bool
+        :return: Whether the attachment was written to the file
+        :rtype: bool
+        """
+        try:
+            if not use_cache or self.attachment_cache is None:
+                return self.cherwell.download_attachment(attachment_id, file_path) is not None
+            endpoint = self.cherwell.endpoint()
+            if self.attachment_cache.copy(endpoint, attachment_id, file_path):
+                return True
+            if self.attachment_cache.store(endpoint, attachment_id, lambda temp_path:
+                                           self.cherwell.download_attachment(attachment_id, temp_path)):
+                return self.attachment_cache.copy(endpoint, attachment_id, file_path)
+            return False
+        except Exception as e:
+            print e.message
+            return False
+
+    def get_bo_ids_matching_fields(self, bo_type, fields, wantPubId=True, max_workers=None, selective_first=False):
         """
         Get a list of business objects matching the specified fields.
 
+        One query is made per field. On a CherwellPool they run concurrently on up to *max_workers* sessions, and
+        as soon as the results seen so far have nothing in common the queries that have not started are skipped.
+
         :param bo_type: The type of business object to search for
         :type bo_type: str
         :param fields: The fields that are desired to match
         :type fields: dict
         :param wantPubId: Whether or not you want a public id as a result
         :type wantPubId: bool
+        :param max_workers: Most queries to run at once, 1 to run them one after another
+        :type max_workers: int
+        :param selective_first: Whether to run the queries one after another, starting with the field
+                                that has returned the fewest results so far
+        :type selective_first: bool
         :return: list of business objects matching the specified fields
         :rtype: list
         """
-        results = list()
-
-        for field, value in fields.iteritems():
-            results.append(set(self.query_by_field_value(bo_type, field, value, wantPubId)))
-
-        matched_bo = set.intersection(*results)
+        if self.mirror is not None:
+            mirrored_ids = self.mirror.match(bo_type, fields, wantPubId)
+            if mirrored_ids is not None:
+                return mirrored_ids
+        max_workers = self.worker_count(max_workers)
+        if selective_first:
+            max_workers = 1
+            field_values = self.field_selectivity.order(bo_type, fields)
+        else:
+            field_values = fields.items()
+
+        pending = Queue.Queue()
+        for field_value in field_values:
+            pending.put(field_value)
+        matched = []
+        lock = threading.Lock()
+
+        def run_queries():
+            while True:
+                with lock:
+                    if matched and not matched[0]:
+                        return
+                try:
+                    field, value = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                with self.session() as session:
+                    result = set(session.query_by_field_value(bo_type, field, value, wantPubId))
+                self.field_selectivity.record(bo_type, field, len(result))
+                with lock:
+                    if matched:
+                        matched[0] &= result
+                    else:
+                        matched.append(result)
+
+        if max_workers > 1 and len(field_values) > 1:
+            workers = [threading.Thread(target=carry_caller(run_queries))
+                       for x in range(min(max_workers, len(field_values)))]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        else:
+            run_queries()
 
-        return list(matched_bo)
+        return list(matched[0]) if matched else []
 
     def get_incidents_of_team(self, team_name):
         """
@@ -310,6 +1306,155 @@ class Cherwell:
         student = self.get_bo_ids_matching_fields("CustomerInternal", {"ID_Number": student_id}, wantpubid)[0]
         return student
 
+    def get_ids_by_field_value(self, business_object_type, field, value):
+        """
+        Gets the record and public id of the first business object with a field value. Found ids are cached, so
+        resolving the same value again does not query the server.
+
+        :param business_object_type: Type of business object to query for
+        :type business_object_type: str
+        :param field: Field to match
+        :type field: str
+        :param value: Value of field to match
+        :type value: str
+        :return: (record id, public id) of the object, None if no object matches
+        :rtype: tuple
+        """
+        endpoint = self.endpoint()
+        key = (endpoint, business_object_type, field, value)
+        ids = field_id_cache.get(key)
+        if ids is None:
+            records = self.query_ids_by_field_value(business_object_type, field, value)
+            if not records:
+                return None
+            ids = records[0]
+            field_id_cache.put(key, ids)
+            public_id_cache.put((endpoint, business_object_type, ids[1]), ids[0])
+        return ids
+
+    def get_recid(self, business_object_type, public_id, public_id_field=None):
+        """
+        Gets the record id of a business object from its public id, without downloading the object when possible
+
+        :param business_object_type: Type of business object
+        :type business_object_type: str
+        :param public_id: The public id of the object
+        :type public_id: str
+        :param public_id_field: The field holding the public id if it is NOT "<BOname>ID"
+        :type public_id_field: str
+        :return: record id of the object, None if it was not found
+        :rtype: str
+        """
+        endpoint = self.endpoint()
+        cached_bo = business_object_cache.get(endpoint, business_object_type, public_id, is_pubid=True)
+        if cached_bo is not None and cached_bo.fields.get('RecID'):
+            return cached_bo.fields['RecID']
+        recid = public_id_cache.get((endpoint, business_object_type, public_id))
+        if recid is not None:
+            return recid
+
+        field = public_id_field if public_id_field is not None else business_object_type + 'ID'
+        for record_recid, record_public_id in self.query_ids_by_field_value(business_object_type, field, public_id):
+            if record_public_id == public_id:
+                recid = record_recid
+        if recid is None:
+            business_object_xml = self.get_bus_obj_by_publicid(business_object_type, public_id)
+            if not business_object_xml:
+                return None
+            if isinstance(business_object_xml, unicode):
+                business_object_xml = business_object_xml.encode('utf-8')
+            for field_element in ET.fromstring(business_object_xml).iter('Field'):
+                if field_element.get('Name') == 'RecID':
+                    recid = field_element.text
+        if recid is not None:
+            public_id_cache.put((endpoint, business_object_type, public_id), recid)
+        return recid
+
+    def preload_ids(self, business_object_type, query_name, scope='Global'):
+        """
+        Cache the public id to record id mapping of every object a stored query returns, so that get_recid can
+        answer for them without querying the server
+
+        :param business_object_type: Type of business object to query for
+        :type business_object_type: str
+        :param query_name: The name of the query in the system
+        :type query_name: str
+        :param scope: Where the query is stored in the system
+        :type scope: str
+        :return: number of objects cached
+        :rtype: int
+        """
+        try:
+            query_result = self.cherwell.query_by_stored_query(business_object_type, query_name, scope)
+            records = self.parse_query_ids(query_result)
+        except:
+            print "Query Failed"
+            return 0
+        endpoint = self.endpoint()
+        for recid, public_id in records:
+            public_id_cache.put((endpoint, business_object_type, public_id), recid)
+        return len(records)
+
+    def preload_field_ids(self, business_object_type, field, query_id, public_id_field=None):
+        """
+        Cache the record and public ids of every object a stored query returns by the value of one of its fields, so
+        that get_ids_by_field_value, and get_recid, can answer for them without querying the server. The query is
+        run with GetQueryResults and must return the field and the public id field.
+
+        :param business_object_type: Type of business object the query returns
+        :type business_object_type: str
+        :param field: The field the objects are looked up by, such as the Email of customers
+        :type field: str
+        :param query_id: Name or id of the stored query
+        :type query_id: str
+        :param public_id_field: The field holding the public id if it is NOT "<BOname>ID"
+        :type public_id_field: str
+        :return: number of objects cached
+        :rtype: int
+        """
+        if public_id_field is None:
+            public_id_field = business_object_type + 'ID'
+        endpoint = self.endpoint()
+        count = 0
+        try:
+            for rows in self.iter_result_pages('GetQueryResults', (query_id, False, 0, False, 0.0, True)):
+                for row in rows:
+                    recid = row.get('RecID') or row.get('RecId')
+                    value = row.get(field)
+                    if not recid or value is None:
+                        continue
+                    ids = (recid, row.get(public_id_field))
+                    field_id_cache.put((endpoint, business_object_type, field, value), ids)
+                    if ids[1] is not None:
+                        public_id_cache.put((endpoint, business_object_type, ids[1]), recid)
+                    count += 1
+        except Exception as e:
+            print e.message
+        return count
+
+    def preload_customer_ids(self, query_id):
+        """
+        Cache the ids of every customer a stored query returns by their email, so incidents for those customers are
+        created without looking the customer up
+
+        :param query_id: Name or id of a stored query on CustomerInternal returning Email and CustomerInternalID
+        :type query_id: str
+        :return: number of customers cached
+        :rtype: int
+        """
+        return self.preload_field_ids("CustomerInternal", "Email", query_id)
+
+    def get_customer_ids(self, user_email):
+        """
+        Gets both the record and public id of a customer given their email, with a single query
+
+        :param user_email: The email of the customer
+        :type user_email: str
+        :return: (record id, public id) of the customer, None if there is no customer with that email
+        :rtype: tuple
+        """
+        return self.get_ids_by_field_value("CustomerInternal", "Email", user_email)
+
     def get_customer_id(self, user_email, wantpubid=True):
         """
         Gets the record or public id of a customer given their email.
@@ -321,5 +1466,11 @@ class Cherwell:
         :return: id of the customer object in question
         :rtype: str
         """
-        user = self.query_by_field_value("CustomerInternal", "Email", user_email, wantpubid)[0]
-        return user
+        customer_ids = self.get_customer_ids(user_email)
+        if customer_ids is None:
+            raise IndexError("No customer has the email " + str(user_email))
+        return customer_ids[1] if wantpubid else customer_ids[0]
+
+
+# Tag the SOAP calls made by each method with the method, see cherwell_metrics
+trace_methods(Cherwell)
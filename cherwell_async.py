@@ -0,0 +1,334 @@
+"""
+A non-blocking client for the Cherwell SOAP API.
+
+Python 2 has no asyncio, so calls return futures instead of coroutines: every method queues its call and
+returns a SoapFuture right away, and callers either wait on the future or get a callback when it is done.
+Envelopes are built straight from the bundled api.wsdl and sent by a fixed number of workers, each on its own
+keep-alive connection, which bounds how many calls are in flight at once.
+
+**Example**::
+
+    client = AsyncCherwellSoap(username, password, apilink, max_concurrency=4)
+    client.login().result()
+    futures = [client.get_business_object_by_public_id('Incident', pubid) for pubid in incident_ids]
+    incidents = [future.result() for future in futures]
+    client.close()
+"""
+import Queue
+import sys
+import threading
+import urllib2
+import urlparse
+from contextlib import contextmanager
+from cookielib import CookieJar
+from StringIO import StringIO
+
+from suds.transport import TransportError
+
+from cherwell_transport import CookieResponse, KeepAliveConnection
+from cherwell_wsdl import Base64File, ServiceDescription, SoapFault
+
+__author__ = 'jptingle'
+
+
+class SoapFuture(object):
+    """
+    The pending result of a call made with AsyncCherwellSoap
+    """
+    def __init__(self):
+        self.finished = threading.Event()
+        self.callbacks = []
+        self.lock = threading.Lock()
+        self.value = None
+        self.error = None
+
+    def done(self):
+        return self.finished.is_set()
+
+    def result(self, timeout=None):
+        """
+        Wait for the call to finish and get its result
+
+        :param timeout: Seconds to wait, None to wait forever
+        :type timeout: float
+        :return: result of the call
+        :raises SoapFault: when the server answered with a fault
+        """
+        if not self.finished.wait(timeout):
+            raise RuntimeError("SOAP call did not finish within " + str(timeout) + " seconds")
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def exception(self, timeout=None):
+        if not self.finished.wait(timeout):
+            raise RuntimeError("SOAP call did not finish within " + str(timeout) + " seconds")
+        return self.error
+
+    def add_done_callback(self, callback):
+        """
+        Call *callback* with this future once the call is done. The callback runs on the worker that made the
+        call, or right away if the call is already done.
+
+        :param callback: function taking the future
+        :return: None
+        """
+        with self.lock:
+            if not self.finished.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def set_result(self, value):
+        self.value = value
+        self.finish()
+
+    def set_exception(self, error):
+        self.error = error
+        self.finish()
+
+    def finish(self):
+        with self.lock:
+            self.finished.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                print e.message
+
+
+class SessionLock(object):
+    """
+    Lets any number of calls share a Cherwell session, or one worker have it to itself while it asks why a call
+    failed and logs back in. Workers waiting to have the session to themselves go before new shared calls.
+    """
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.sharing = 0
+        self.waiting = 0
+        self.held = False
+
+    @contextmanager
+    def shared(self):
+        with self.condition:
+            while self.held or self.waiting:
+                self.condition.wait()
+            self.sharing += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.sharing -= 1
+                if not self.sharing:
+                    self.condition.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        with self.condition:
+            self.waiting += 1
+            while self.held or self.sharing:
+                self.condition.wait()
+            self.waiting -= 1
+            self.held = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.held = False
+                self.condition.notify_all()
+
+
+class AsyncCherwellSoap(object):
+    """
+    Non-blocking counterpart of Cherwell_Soap. All workers share one cookie jar and so one Cherwell session.
+    Calls run on it side by side, but when one fails the worker waits until no other call is in flight before it
+    asks GetLastError and logs back in, so it never reads another call's error and only one worker logs in again
+    after the session expired.
+    """
+    def __init__(self, username, password, apilink=None, max_concurrency=8, timeout=90, service=None):
+        """
+        :param username: Cherwell user name
+        :type username: str
+        :param password: Cherwell password
+        :type password: str
+        :param apilink: Link to the Cherwell API, the endpoint of the WSDL when not given
+        :type apilink: str
+        :param max_concurrency: The most calls in flight at once
+        :type max_concurrency: int
+        :param timeout: Socket timeout of each call in seconds
+        :type timeout: float
+        :param service: Service description to use instead of the bundled api.wsdl
+        :type service: ServiceDescription
+        """
+        self.username = username
+        self.password = password
+        self.service = service if service is not None else ServiceDescription()
+        self.location = apilink.split('?')[0] if apilink else self.service.location
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.cookiejar = CookieJar()
+        self.session_lock = SessionLock()
+        self.session_generation = 0
+        self.pending_calls = Queue.Queue()
+        self.workers = []
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def start_workers(self):
+        with self.lock:
+            parsed_location = urlparse.urlsplit(self.location)
+            while len(self.workers) < self.max_concurrency:
+                connection = KeepAliveConnection(parsed_location.scheme, parsed_location.netloc, self.timeout)
+                worker = threading.Thread(target=self.work, args=(connection,))
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+
+    def close(self):
+        """
+        Finish the queued calls and stop the workers
+
+        :return: None
+        """
+        with self.lock:
+            workers, self.workers = self.workers, []
+        for worker in workers:
+            self.pending_calls.put(None)
+        for worker in workers:
+            worker.join()
+
+    def work(self, connection):
+        while True:
+            call = self.pending_calls.get()
+            if call is None:
+                connection.close()
+                return
+            future, operation_name, params, relogin = call
+            try:
+                if relogin:
+                    result = self.run_soap_cmd(connection, operation_name, *params)
+                else:
+                    with self.session_lock.shared():
+                        result = self.send(connection, operation_name, *params)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def send(self, connection, operation_name, *params):
+        """
+        Make one SOAP call on a worker's connection and wait for its result
+        """
+        operation = self.service.operations[operation_name]
+        envelope = self.service.request_body(operation_name, *params)
+        headers = {'Content-Type': 'text/xml; charset=utf-8',
+                   'SOAPAction': '"' + operation.soap_action + '"'}
+        u2request = urllib2.Request(self.location, envelope, headers)
+        self.cookiejar.add_cookie_header(u2request)
+        response, data = connection.request('POST', self.location, envelope, dict(u2request.header_items()))
+        self.cookiejar.extract_cookies(CookieResponse(response), u2request)
+        if response.status >= 300 and response.status != 500:
+            raise TransportError(response.reason, response.status, StringIO(data))
+        return self.service.parse_response(operation_name, data)
+
+    def run_soap_cmd(self, connection, operation_name, *params):
+        """
+        Make a SOAP call the way Cherwell_Soap.run_soap_cmd does: GetLastError is only asked for when the
+        call fails, and the call is retried once after logging back in if the session had expired.
+
+        A failed call holds the session on its own while it checks it. If another worker logged back in since the
+        call was sent, the call is just retried; otherwise no other call is in flight, so GetLastError says whether
+        the session is still logged in.
+        """
+        fault = None
+        with self.session_lock.shared():
+            generation = self.session_generation
+            try:
+                result = self.send(connection, operation_name, *params)
+            except SoapFault:
+                fault = sys.exc_info()
+            else:
+                if result is not None and result is not False and result != '':
+                    return result
+
+        with self.session_lock.exclusive():
+            if self.session_generation != generation or self.relogin_if_expired(connection):
+                return self.send(connection, operation_name, *params)
+        if fault is not None:
+            raise fault[0], fault[1], fault[2]
+        return result
+
+    def relogin_if_expired(self, connection):
+        error = self.send(connection, 'GetLastError')
+        if error and 'not logged in' in error:
+            if self.send(connection, 'Login', self.username, self.password):
+                self.session_generation += 1
+                return True
+        return False
+
+    def call(self, operation_name, *params):
+        """
+        Queue a call of any operation in the WSDL
+
+        :param operation_name: Name of the WSDL operation
+        :type operation_name: str
+        :param params: Values of the operation parameters, in WSDL order
+        :return: the pending result
+        :rtype: SoapFuture
+        """
+        return self.queue_call(operation_name, params, True)
+
+    def queue_call(self, operation_name, params, relogin):
+        if operation_name not in self.service.operations:
+            raise ValueError(operation_name + " is not an operation of the Cherwell API")
+        future = SoapFuture()
+        self.start_workers()
+        self.pending_calls.put((future, operation_name, params, relogin))
+        return future
+
+    def login(self):
+        return self.queue_call('Login', (self.username, self.password), False)
+
+    def logout(self):
+        return self.queue_call('Logout', (), False)
+
+    def get_last_error(self):
+        return self.queue_call('GetLastError', (), False)
+
+    def get_business_object_by_public_id(self, business_object_type, object_id):
+        return self.call('GetBusinessObjectByPublicId', business_object_type, object_id)
+
+    def get_business_object(self, business_object_type, object_id):
+        return self.call('GetBusinessObject', business_object_type, object_id)
+
+    def query_by_field_value(self, business_object_type, field, value):
+        return self.call('QueryByFieldValue', business_object_type, field, value)
+
+    def query_by_stored_query(self, business_object_type, query_name, scope='Global'):
+        return self.call('QueryByStoredQueryWithScope', business_object_type, query_name, scope, self.username)
+
+    def update_business_object(self, object_type, object_id, update_xml):
+        return self.call('UpdateBusinessObject', object_type, object_id, update_xml)
+
+    def update_business_object_by_pubid(self, object_type, object_id, update_xml):
+        return self.call('UpdateBusinessObjectByPublicId', object_type, object_id, update_xml)
+
+    def create_business_object(self, business_object_type, business_object_xml):
+        return self.call('CreateBusinessObject', business_object_type, business_object_xml)
+
+    def add_attachment_to_record(self, business_object_type, object_record_id, attachment_name, attachment_data):
+        return self.call('AddAttachmentToRecord', business_object_type, object_record_id,
+                         attachment_name, attachment_data.encode("base64"))
+
+    def add_attachment_from_file(self, business_object_type, object_record_id, attachment_name, file_path):
+        return self.call('AddAttachmentToRecord', business_object_type, object_record_id,
+                         attachment_name, Base64File(file_path))
+
+    def get_business_object_def(self, business_object_type):
+        return self.call('GetBusinessObjectDefinition', business_object_type)
@@ -0,0 +1,241 @@
+"""
+Runs many Cherwell calls, such as the creates and updates of a migration, on a bounded number of threads.
+
+Items are read from their iterable only as workers free up, and results are handed back one at a time as they
+finish, so neither the input nor the output is ever held in memory in full. Failed items are reported with the
+GetLastError text of their call instead of stopping the run. A checkpoint file records the items that succeeded,
+so a run restarted after a crash skips them. A run with a single worker makes its calls on the consuming thread.
+"""
+import json
+import os
+import Queue
+import threading
+import time
+
+__author__ = 'jptingle'
+
+# Seconds between checks of whether the consumer of a run has gone away
+_POLL_INTERVAL = 0.1
+
+
+class BulkResult(object):
+    """
+    The outcome of one item of a bulk run
+    """
+    def __init__(self, index, item, value=None, error=None):
+        """
+        :param index: Position of the item in the iterable given to the run
+        :type index: int
+        :param item: The item
+        :param value: What the call returned, e.g. the record id of a created object
+        :param error: GetLastError text, or a description of the failure, when the call failed
+        :type error: str
+        """
+        self.index = index
+        self.item = item
+        self.value = value
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.ok:
+            return "BulkResult(%d, value=%r)" % (self.index, self.value)
+        return "BulkResult(%d, error=%r)" % (self.index, self.error)
+
+
+class RateLimiter(object):
+    """
+    Spaces out the calls of every thread sharing it so that no more than *rate* start per second
+    """
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_start = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_start)
+            self.next_start = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class BulkCheckpoint(object):
+    """
+    Append-only file of the items a bulk run has finished, identified by their position in the run's iterable.
+    Runs resumed from a checkpoint must be given the same items in the same order.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.values = dict()
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, 'r+b') as checkpoint_file:
+                complete = 0
+                for line in iter(checkpoint_file.readline, ''):
+                    if not line.endswith('\n'):
+                        break
+                    complete += len(line)
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.values[entry['index']] = entry['value']
+                # The last line of a crashed run may be cut short, and the next record must not be appended to it
+                checkpoint_file.truncate(complete)
+        self.checkpoint_file = open(path, 'a')
+
+    def __contains__(self, index):
+        return index in self.values
+
+    def record(self, result):
+        with self.lock:
+            self.values[result.index] = result.value
+            self.checkpoint_file.write(json.dumps({'index': result.index, 'value': result.value}) + '\n')
+            self.checkpoint_file.flush()
+
+    def close(self):
+        with self.lock:
+            self.checkpoint_file.close()
+
+
+def run_item(index, item, call, checkpoint):
+    try:
+        value, error = call(item)
+    except Exception as e:
+        value, error = None, str(e) or e.__class__.__name__
+    result = BulkResult(index, item, value, error)
+    if result.ok and checkpoint is not None:
+        checkpoint.record(result)
+    return result
+
+
+def run_bulk(items, call, max_workers=4, max_pending=None, rate=None, checkpoint_path=None):
+    """
+    Make one call per item on up to *max_workers* threads
+
+    :param items: The items to run, read lazily
+    :type items: iterable
+    :param call: Function making the call of one item and returning its value and, when it failed, its error text
+    :type call: function
+    :param max_workers: Most calls to run at once
+    :type max_workers: int
+    :param max_pending: Most items read ahead of the workers and results waiting to be consumed, twice
+                        *max_workers* by default
+    :type max_pending: int
+    :param rate: Most calls to start per second, None for no limit
+    :type rate: float
+    :param checkpoint_path: File recording the items that succeeded. Items it already holds are skipped.
+    :type checkpoint_path: str
+    :return: generator of the result of every item that was run, in the order they finish
+    :rtype: generator
+    """
+    max_workers = max(1, max_workers)
+    if max_workers == 1:
+        return run_inline(items, call, rate, checkpoint_path)
+    return run_threaded(items, call, max_workers, max_pending, rate, checkpoint_path)
+
+
+def run_inline(items, call, rate, checkpoint_path):
+    """
+    Make the calls of run_bulk one after another as the results are consumed
+    """
+    rate_limiter = RateLimiter(rate)
+    checkpoint = BulkCheckpoint(checkpoint_path) if checkpoint_path else None
+    try:
+        iterator = enumerate(items)
+        while True:
+            try:
+                index, item = next(iterator)
+            except StopIteration:
+                return
+            except Exception as e:
+                yield BulkResult(-1, None, error="Reading the items failed: " + str(e))
+                return
+            if checkpoint is not None and index in checkpoint:
+                continue
+            rate_limiter.wait()
+            yield run_item(index, item, call, checkpoint)
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+
+
+def run_threaded(items, call, max_workers, max_pending, rate, checkpoint_path):
+    """
+    Make the calls of run_bulk on *max_workers* threads
+    """
+    if max_pending is None:
+        max_pending = 2 * max_workers
+    pending_items = Queue.Queue(max_pending)
+    results = Queue.Queue(max_pending)
+    stopped = threading.Event()
+    rate_limiter = RateLimiter(rate)
+    checkpoint = BulkCheckpoint(checkpoint_path) if checkpoint_path else None
+
+    def put(queue, entry):
+        # Wait for room, giving up once the run is stopped
+        while not stopped.is_set():
+            try:
+                queue.put(entry, timeout=_POLL_INTERVAL)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def read_items():
+        try:
+            for index, item in enumerate(items):
+                if checkpoint is not None and index in checkpoint:
+                    continue
+                if not put(pending_items, (index, item)):
+                    return
+        except Exception as e:
+            put(results, BulkResult(-1, None, error="Reading the items failed: " + str(e)))
+        finally:
+            for x in range(max_workers):
+                put(pending_items, None)
+
+    def run_items():
+        try:
+            while not stopped.is_set():
+                try:
+                    entry = pending_items.get(timeout=_POLL_INTERVAL)
+                except Queue.Empty:
+                    continue
+                if entry is None:
+                    return
+                index, item = entry
+                rate_limiter.wait()
+                if not put(results, run_item(index, item, call, checkpoint)):
+                    return
+        finally:
+            put(results, None)
+
+    threads = [threading.Thread(target=read_items)]
+    threads.extend(threading.Thread(target=run_items) for x in range(max_workers))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        running = max_workers
+        while running:
+            result = results.get()
+            if result is None:
+                running -= 1
+            else:
+                yield result
+    finally:
+        # Also reached when the consumer stops iterating early
+        stopped.set()
+        for thread in threads:
+            thread.join()
+        if checkpoint is not None:
+            checkpoint.close()
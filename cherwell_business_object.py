@@ -1,8 +1,218 @@
 import xml.etree.ElementTree as ET
+import threading
 import time
 import datetime
 
 import cherwellconstants
+from cherwell_cache import business_object_cache, missing_field_cache
+from cherwell_metrics import trace_methods
+
+# Marks the positions of fields an object does not hold
+_UNSET = object()
+
+
+class FieldSchema(object):
+    """
+    The field names of one business object type, interned and numbered in the order they were first seen. Every
+    object of the type shares the schema and stores its field values in a list indexed by these positions, so the
+    names are held once per type rather than once per object.
+    """
+    __slots__ = ('type', 'names', 'positions', 'lock')
+    schemas = dict()
+
+    def __init__(self, botype):
+        self.type = botype
+        self.names = []
+        self.positions = dict()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def for_type(cls, botype):
+        """
+        Get the shared schema of a business object type
+
+        :param botype: Type of business object
+        :type botype: str
+        :rtype: FieldSchema
+        """
+        schema = cls.schemas.get(botype)
+        if schema is None:
+            schema = cls.schemas.setdefault(botype, cls(botype))
+        return schema
+
+    def position(self, field_name):
+        """
+        Get the position of a field, adding the field to the schema when it is new
+
+        :param field_name: The name of the field
+        :type field_name: str
+        :rtype: int
+        """
+        position = self.positions.get(field_name)
+        if position is None:
+            with self.lock:
+                position = self.positions.get(field_name)
+                if position is None:
+                    if type(field_name) is str:
+                        field_name = intern(field_name)
+                    position = len(self.names)
+                    self.names.append(field_name)
+                    self.positions[field_name] = position
+        return position
+
+    def extend(self, field_names):
+        """
+        Add fields to the schema ahead of time, e.g. every field of the type's GetBusinessObjectDefinition, so
+        objects of the type are laid out in the definition's order
+
+        :param field_names: The names of the fields
+        :type field_names: list
+        :return: None
+        """
+        for field_name in field_names:
+            self.position(field_name)
+
+
+class FieldValues(object):
+    """
+    Mapping of field name to value that keeps its values in a list laid out by a FieldSchema. It supports the dict
+    operations business objects and their callers use on *fields*.
+    """
+    __slots__ = ('schema', 'slots')
+
+    def __init__(self, schema, values=None):
+        self.schema = schema
+        self.slots = []
+        if values:
+            self.update(values)
+
+    def __getitem__(self, field_name):
+        position = self.schema.positions.get(field_name)
+        if position is not None and position < len(self.slots):
+            value = self.slots[position]
+            if value is not _UNSET:
+                return value
+        raise KeyError(field_name)
+
+    def __setitem__(self, field_name, value):
+        position = self.schema.position(field_name)
+        slots = self.slots
+        if position >= len(slots):
+            slots.extend([_UNSET] * (len(self.schema.names) - len(slots)))
+        slots[position] = value
+
+    def __delitem__(self, field_name):
+        self.__getitem__(field_name)
+        self.slots[self.schema.positions[field_name]] = _UNSET
+
+    def __contains__(self, field_name):
+        position = self.schema.positions.get(field_name)
+        return position is not None and position < len(self.slots) and self.slots[position] is not _UNSET
+
+    has_key = __contains__
+
+    def __iter__(self):
+        names = self.schema.names
+        return (names[position] for position, value in enumerate(self.slots) if value is not _UNSET)
+
+    def __len__(self):
+        return sum(1 for value in self.slots if value is not _UNSET)
+
+    def __eq__(self, other):
+        return dict(self.iteritems()) == (dict(other.iteritems()) if isinstance(other, FieldValues) else other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+    def get(self, field_name, default=None):
+        try:
+            return self[field_name]
+        except KeyError:
+            return default
+
+    def pop(self, field_name, *default):
+        try:
+            value = self[field_name]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        self.slots[self.schema.positions[field_name]] = _UNSET
+        return value
+
+    def iteritems(self):
+        names = self.schema.names
+        return ((names[position], value) for position, value in enumerate(self.slots) if value is not _UNSET)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def keys(self):
+        return list(self)
+
+    iterkeys = __iter__
+
+    def values(self):
+        return [value for value in self.slots if value is not _UNSET]
+
+    def update(self, values):
+        for field_name, value in values.iteritems() if hasattr(values, 'iteritems') else values:
+            self[field_name] = value
+
+    def copy(self):
+        return dict(self.iteritems())
+
+    def clear(self):
+        self.slots = []
+
+
+class FieldListReader(object):
+    """
+    XMLParser target that copies the <FieldList> of a business object's XML straight into the object as the parser
+    reads it, without building an element tree
+    """
+    def __init__(self, business_object, now):
+        self.business_object = business_object
+        self.now = now
+        self.depth = 0
+        self.in_field_list = False
+        self.field_name = None
+        self.text = []
+
+    def start(self, tag, attrib):
+        self.depth += 1
+        if self.depth == 2 and tag == 'FieldList':
+            self.in_field_list = True
+        elif self.depth == 3 and self.in_field_list and tag == 'Field':
+            self.field_name = attrib.get('Name')
+            self.text = []
+
+    def data(self, data):
+        if self.field_name is not None:
+            self.text.append(data)
+
+    def end(self, tag):
+        if self.depth == 3 and self.field_name is not None:
+            self.import_field(self.field_name, ''.join(self.text) or None)
+            self.field_name = None
+        elif self.depth == 2:
+            self.in_field_list = False
+        self.depth -= 1
+
+    def import_field(self, field_name, value):
+        business_object = self.business_object
+        if business_object.dirty_fields and field_name in business_object.dirty_fields:
+            # Keep changes that have not been committed yet
+            return
+        business_object.fields[field_name] = value
+        business_object.field_times[field_name] = self.now
+
+    def close(self):
+        return self.business_object
+
 
 class BusinessObject(object):
     """
@@ -11,13 +221,40 @@ class BusinessObject(object):
     id and type. Fields can be set and retrieved with this class. Any changes made to the object will be uploaded to
     Cherwell to reflect changes. Any fields requested from the object that are not available locally will be downloaded
     from Cherwell and cached appropriately.
+
+    Cached fields are kept for *field_ttl* seconds (forever when None) before the next read downloads the object again.
+    Fields objects of a type turned out not to have are remembered for the type for *missing_field_ttl* seconds, so
+    reading a misspelled field does not download an object of the type every time. Both can be set per object, and
+    default to *default_field_ttl* and *default_missing_field_ttl* of the class.
+
+    Field values are kept in FieldValues laid out by the FieldSchema of the object's type, and business objects have
+    __slots__, so large numbers of them can be held in memory at once.
+
+    Setting a field to the value it already has is dropped. Inside a ``with`` block on the object, changed fields are
+    only marked dirty and are sent together in one update when the block exits or commit() is called::
+
+        with incident:
+            incident.assign('Service Desk')
+            incident['Status'] = 'New'
     """
+    __slots__ = ('type', 'id', 'has_pubid', 'fields', 'field_times', 'downloaded', 'cherwell_connection',
+                 'dirty_fields', 'batch_depth', 'field_ttl', 'missing_field_ttl')
+    default_field_ttl = None
+    default_missing_field_ttl = 300
+
     def __init__(self, type, id, cherwell_instance):
         self.type = type
         self.id = id
         self.has_pubid = False
-        self.fields = dict()
+        schema = FieldSchema.for_type(type)
+        self.fields = FieldValues(schema)
+        self.field_times = FieldValues(schema)
+        self.downloaded = False
         self.cherwell_connection = cherwell_instance
+        self.dirty_fields = None
+        self.batch_depth = 0
+        self.field_ttl = self.default_field_ttl
+        self.missing_field_ttl = self.default_missing_field_ttl
 
     def __eq__(self, other):
         try:
@@ -37,44 +274,109 @@ class BusinessObject(object):
         :rtype: BusinessObject
         """
         try:
-            xml_root = ET.fromstring(business_object_xml.encode('ascii', 'ignore'))
-            fields = xml_root.find("FieldList")
-            for children in fields:
-                field_name = children.get("Name")
-                field_value = children.text
-                self.fields[field_name] = field_value
+            if isinstance(business_object_xml, unicode):
+                business_object_xml = business_object_xml.encode('utf-8')
+            parser = ET.XMLParser(target=FieldListReader(self, time.time()))
+            parser.feed(business_object_xml)
+            parser.close()
 
         except ET.ParseError as e:
             print e.message
 
+    def import_fields(self, field_dict):
+        """
+        Cache field values that are already on the server without sending them back, such as the fields an object
+        was just created with
+
+        :param field_dict: The field values
+        :type field_dict: dict
+        :return: None
+        """
+        reader = FieldListReader(self, time.time())
+        for field, value in field_dict.iteritems():
+            reader.import_field(field, value)
+
     def push_update_to_cherwell(self, field_dict):
         """
         Push the specified fields to Cherwell to be updated with the business object.
 
         :param field_dict: The fields to change
         :type field_dict: dict
-        :return: None
+        :return: Whether the update succeeded
+        :rtype: bool
         """
         update_xml = BusinessObjectFactory.generate_object_xml(self.type, field_dict)
         userecid = False if self.has_pubid else True
-        self.cherwell_connection.update_business_object(self.id, self.type, update_xml, userecid)
+        cached = business_object_cache.get(self.cherwell_connection.endpoint(), self.type, self.id, self.has_pubid)
+        if self.cherwell_connection.update_business_object(self.id, self.type, update_xml, userecid, field_dict):
+            # Cherwell may have changed fields it computes, such as LastModifiedDateTime, so every cached field is
+            # stale. The update dropped the record from the shared cache; put back the instance other code already
+            # shares rather than replacing it with this one, for its next read to download the record again.
+            self.invalidate()
+            if cached is not None and cached is not self:
+                cached.invalidate()
+                business_object_cache.add(cached)
+            else:
+                business_object_cache.add(self)
+            return True
+        return False
+
+    def __enter__(self):
+        self.batch_depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.batch_depth -= 1
+        # Changes made before an error stay dirty until commit() or refresh()
+        if self.batch_depth == 0 and exc_type is None:
+            self.commit()
+
+    def is_changed(self, field_name, value):
+        """
+        Whether setting a field to a value would change it
+
+        :param field_name: The name of the field
+        :type field_name: str
+        :param value: The new value
+        :type value: str
+        :rtype: bool
+        """
+        return field_name not in self.fields or not self.is_fresh(field_name) or self.fields[field_name] != value
+
+    def commit(self):
+        """
+        Send every dirty field to Cherwell in one update
+
+        :return: Whether the update succeeded, True when there was nothing to send
+        :rtype: bool
+        """
+        if not self.dirty_fields:
+            return True
+        field_dict = dict((field, self.fields.get(field)) for field in self.dirty_fields)
+        if not self.push_update_to_cherwell(field_dict):
+            return False
+        self.dirty_fields = None
+        return True
 
     def set_fields(self, field_dict):
         try:
+            now = time.time()
             for field, value in field_dict.iteritems():
+                if not self.is_changed(field, value):
+                    continue
                 self.fields[field] = value
+                self.field_times[field] = now
+                if self.dirty_fields is None:
+                    self.dirty_fields = set()
+                self.dirty_fields.add(field)
 
-            self.push_update_to_cherwell(field_dict)
+            if not self.batch_depth:
+                self.commit()
         except Exception as e:
             print e.message
 
     def set_field(self, field_name, value):
-        try:
-            self.fields[field_name] = value
-
-            self.push_update_to_cherwell({field_name: value})
-        except KeyError as e:
-            print e.message
+        self.set_fields({field_name: value})
 
     def get_fields(self, field_names):
         field_values = []
@@ -88,11 +390,61 @@ class BusinessObject(object):
     def get_latest_from_server(self):
         """
         Gets the latest version of the business object from cherwell
-        :return: None
+        :return: Whether the object was downloaded
+        :rtype: bool
         """
         bo_from_server = self.cherwell_connection.get_bus_obj_by_publicid(self.type, self.id) if self.has_pubid else \
             self.cherwell_connection.get_bus_obj_by_recid(self.type, self.id)
+        if not bo_from_server:
+            return False
         self.import_xml(bo_from_server)
+        self.downloaded = True
+        return True
+
+    def is_fresh(self, field_name):
+        """
+        Whether the cached value of a field can be used without downloading the object again
+
+        :param field_name: The name of the field
+        :type field_name: str
+        :rtype: bool
+        """
+        if field_name not in self.field_times:
+            return False
+        return self.field_ttl is None or time.time() - self.field_times[field_name] < self.field_ttl
+
+    def is_known_missing(self, field_name):
+        """
+        Whether objects of the type were recently found not to have a field
+
+        :param field_name: The name of the field
+        :type field_name: str
+        :rtype: bool
+        """
+        missing_since = missing_field_cache.get((self.type, field_name))
+        return missing_since is not None and time.time() - missing_since < self.missing_field_ttl
+
+    def refresh(self):
+        """
+        Download the object again, replacing every cached field and dropping changes that were not committed
+
+        :return: Whether the object was downloaded
+        :rtype: bool
+        """
+        self.dirty_fields = None
+        return self.get_latest_from_server()
+
+    def invalidate(self, *field_names):
+        """
+        Mark cached fields as stale so that the next read of any of them downloads the object again. With no field
+        names every field is invalidated.
+
+        :param field_names: The fields to invalidate
+        :return: None
+        """
+        for field_name in field_names or self.fields.keys():
+            self.field_times.pop(field_name, None)
+            missing_field_cache.invalidate((self.type, field_name))
 
     def __getitem__(self, item):
         """
@@ -102,41 +454,36 @@ class BusinessObject(object):
         :return: field value
         :rtype: str
         """
-        try:
+        if self.is_fresh(item):
             return self.fields[item]
-        except:
+        if not self.is_known_missing(item):
             try:
-                self.get_latest_from_server()
-                return self.fields[item]
+                if self.get_latest_from_server() and item not in self.fields:
+                    missing_field_cache.put((self.type, item), time.time())
             except:
-                print "Error retrieving field - " + str(item)
+                pass
+        if item in self.fields:
+            return self.fields[item]
+        print "Error retrieving field - " + str(item)
 
     def __setitem__(self, key, value):
         self.set_field(key, value)
 
-    def to_xml(self):
+    def to_xml(self, use_cached=False):
         """
         Returns the XML version of the business object
 
+        :param use_cached: Whether to use the cached fields when none of them are stale instead of always downloading
+                           the object. An object that was never downloaded, and so may only hold some of its fields,
+                           is downloaded anyway.
+        :type use_cached: bool
         :return: XML of business object
         :rtype: str
         """
+        if not use_cached or not self.downloaded or not all(self.is_fresh(field) for field in self.fields):
+            self.get_latest_from_server()
 
-        self.get_latest_from_server()
-
-        bo_xml_root = ET.Element("BusinessObject")
-        bo_xml_root.set("Name", self.type)
-        field_list = ET.SubElement(bo_xml_root, "FieldList")
-
-        # Add fields
-        for field in self.fields:
-            _field = ET.SubElement(field_list, "Field")
-            _field.set("Name", field)
-            _field.text = self.fields[field]
-
-        bo_xml_string = ET.tostring(bo_xml_root)
-
-        return bo_xml_string
+        return BusinessObjectXmlWriter.for_type(self.type).write(self.fields)
 
     def get_related_bo_ids(self, relatedtype, wantpubid=True):
         """
@@ -155,6 +502,22 @@ class BusinessObject(object):
                                                                     wantpubid)
         return related_bo_ids
 
+    def get_related_bos(self, relatedtype, wantpubid=True):
+        """
+        Get the business objects related to this business object, fetched together rather than one at a time as
+        their fields are read
+
+        :param relatedtype: Type to search for
+        :type relatedtype: str
+        :param wantpubid: whether to find the related objects by their public ids
+        :type wantpubid: bool
+        :return: the objects related to this object
+        :rtype: list
+        """
+        related_bo_ids = self.get_related_bo_ids(relatedtype, wantpubid)
+        return [related_bo for related_bo in self.cherwell_connection.get_many(relatedtype, related_bo_ids, wantpubid)
+                if related_bo is not None]
+
     def attach_file(self, filename, filepath):
         """
         Attach a file to the business object
@@ -163,14 +526,33 @@ class BusinessObject(object):
         :type filename: str
         :param filepath: the path to the file
         :type filepath: str
-        :return: None
+        :return: Whether the file was attached
+        :rtype: bool
         """
-        fout = open(filepath, 'rb')
-        data = fout.read()
-        fout.close()
+        return self.cherwell_connection.add_attachment_from_file(self.type, self['RecID'], filename, filepath)
 
-        data = data.encode("base64")
-        return self.cherwell_connection.add_attachment_to_record(self.type, self['RecID'], filename, data)
+    def list_attachments(self):
+        """
+        List the attachments of the business object
+
+        :return: the attributes of each attachment, such as its Id and Name
+        :rtype: list
+        """
+        return self.cherwell_connection.get_attachments(self.type, self['RecID'])
+
+    def download_attachment(self, attachment, filepath):
+        """
+        Download an attachment of the business object to a file
+
+        :param attachment: The attachment as listed by list_attachments, or its id
+        :type attachment: dict
+        :param filepath: the path of the file to write
+        :type filepath: str
+        :return: Whether the attachment was written to the file
+        :rtype: bool
+        """
+        attachment_id = attachment['Id'] if isinstance(attachment, dict) else attachment
+        return self.cherwell_connection.download_attachment(attachment_id, filepath)
 
 
 class Incident(BusinessObject):
@@ -178,6 +560,8 @@ class Incident(BusinessObject):
     Incident Object
     :
     """
+    __slots__ = ()
+
     def __init__(self, incident_id, cherwell_connection):
         super(Incident, self).__init__('Incident', incident_id, cherwell_connection)
         self.has_pubid = True
@@ -191,6 +575,15 @@ class Incident(BusinessObject):
         """
         return self.get_related_bo_ids('Task')
 
+    def get_tasks(self):
+        """
+        Retrieve the tasks attached to the incident.
+
+        :return: list of tasks attached
+        :rtype: list
+        """
+        return self.get_related_bos('Task')
+
     def set_pending(self, reason):
         """
         Set an incident to pending with a reason
@@ -225,9 +618,12 @@ class Incident(BusinessObject):
         :param email: email of the customer
         :type email: str
         :return: None
+        :raises IndexError: when no customer has the email
         """
-        customer_recid = self.cherwell_connection.get_customer_id(email, wantpubid=False)
-        customer_display_name = self.cherwell_connection.get_customer_id(email)
+        customer_ids = self.cherwell_connection.get_customer_ids(email)
+        if customer_ids is None:
+            raise IndexError("No customer has the email " + str(email))
+        customer_recid, customer_display_name = customer_ids
         customer_fields = {'CustomerRecID': customer_recid,
                            'CustomerDisplayName': customer_display_name,
                            'CustomerTypeID': '93405caa107c376a2bd15c4c8885a900be316f3a72'}
@@ -245,10 +641,7 @@ class Incident(BusinessObject):
                          'OwnedByTeam': assigned_team,
                          'TempDefaultTeam': assigned_team}
 
-        # Fields are set twice because sometimes cherwell does not process the first request
-        for x in range(0, 2):
-            self.set_fields(assign_fields)
-
+        self.set_fields(assign_fields)
 
     def is_status(self, status):
         """
@@ -277,6 +670,8 @@ class SpecificsInformationSecurity(BusinessObject):
     """
 
     """
+    __slots__ = ()
+
     def __init__(self, id, cherwell_connection):
         super(SpecificsInformationSecurity, self).__init__('SpecificsInformationSecurity', id, cherwell_connection)
 
@@ -285,6 +680,8 @@ class Task(BusinessObject):
     """
 
     """
+    __slots__ = ()
+
     def __init__(self, id, cherwell_connection):
         super(Task, self).__init__('Task', id, cherwell_connection)
         self.has_pubid = True
@@ -294,6 +691,8 @@ class JournalHistory(BusinessObject):
     """
 
     """
+    __slots__ = ()
+
     def __init__(self, recid, cherwell_connection):
         super(JournalHistory, self).__init__('JournalHistory', recid, cherwell_connection)
 
@@ -302,6 +701,8 @@ class JournalTeamNote(BusinessObject):
     """
 
     """
+    __slots__ = ()
+
     def __init__(self, recid, cherwell_connection):
         super(JournalTeamNote, self).__init__('JournalTeamNote', recid, cherwell_connection)
 
@@ -310,6 +711,8 @@ class Customer(BusinessObject):
     """
 
     """
+    __slots__ = ('customer_id', 'email')
+
     def __init__(self, customerid, cherwell_connection, givenrecid=False):
         if not givenrecid:
             self.customer_id = self.cherwell_connection.get_customer_id(customerid)
@@ -322,15 +725,132 @@ class Customer(BusinessObject):
             self.email = self['Email']
 
 class ConfigComputer(BusinessObject):
+    __slots__ = ()
+
     def __init__(self, assettag, cherwell_connection):
         self.has_pubid = True
         super(ConfigComputer, self).__init__('ConfigComputer', assettag, cherwell_connection)
 
 class DriveInfo(BusinessObject):
+    __slots__ = ()
+
     def __init__(self, recid, cherwell_connection):
         self.has_pubid = False
         super(DriveInfo, self).__init__('DriveInfo', recid, cherwell_connection)
 
+def _serialization_error(text):
+    return TypeError("cannot serialize %r (type %s)" % (text, type(text).__name__))
+
+
+def escape_xml_text(text):
+    """
+    Escape field text exactly as ElementTree.tostring does
+
+    :param text: The text to escape
+    :type text: str
+    :return: escaped US-ASCII text
+    :rtype: str
+    """
+    try:
+        if "&" in text:
+            text = text.replace("&", "&amp;")
+        if "<" in text:
+            text = text.replace("<", "&lt;")
+        if ">" in text:
+            text = text.replace(">", "&gt;")
+        return text.encode("us-ascii", "xmlcharrefreplace")
+    except (TypeError, AttributeError):
+        raise _serialization_error(text)
+
+
+def escape_xml_attribute(text):
+    """
+    Escape an attribute value exactly as ElementTree.tostring does
+
+    :param text: The attribute value to escape
+    :type text: str
+    :return: escaped US-ASCII text
+    :rtype: str
+    """
+    try:
+        if "&" in text:
+            text = text.replace("&", "&amp;")
+        if "<" in text:
+            text = text.replace("<", "&lt;")
+        if ">" in text:
+            text = text.replace(">", "&gt;")
+        if "\"" in text:
+            text = text.replace("\"", "&quot;")
+        if "\n" in text:
+            text = text.replace("\n", "&#10;")
+        return text.encode("us-ascii", "xmlcharrefreplace")
+    except (TypeError, AttributeError):
+        raise _serialization_error(text)
+
+
+class BusinessObjectXmlWriter(object):
+    """
+    Writes the <BusinessObject><FieldList><Field Name=...> XML of a business object type into a single buffer,
+    byte for byte what ElementTree.tostring produces for the same tree. The escaped tags of the type and of each of
+    its field names are built once and reused for every object of that type.
+    """
+    writers = dict()
+
+    def __init__(self, botype):
+        business_object_tag = '<BusinessObject Name="' + escape_xml_attribute(botype) + '">'
+        self.head = business_object_tag + '<FieldList>'
+        self.tail = '</FieldList></BusinessObject>'
+        self.empty = business_object_tag + '<FieldList /></BusinessObject>'
+        self.field_tags = dict()
+
+    @classmethod
+    def for_type(cls, botype):
+        """
+        Get the shared writer of a business object type
+
+        :param botype: Type of business object
+        :type botype: str
+        :rtype: BusinessObjectXmlWriter
+        """
+        writer = cls.writers.get(botype)
+        if writer is None:
+            writer = cls.writers.setdefault(botype, cls(botype))
+        return writer
+
+    def field_tag(self, field_name):
+        tags = self.field_tags.get(field_name)
+        if tags is None:
+            escaped_name = escape_xml_attribute(field_name)
+            tags = ('<Field Name="' + escaped_name + '">', '<Field Name="' + escaped_name + '" />')
+            self.field_tags[field_name] = tags
+        return tags
+
+    def write(self, field_dict):
+        """
+        Write the XML of a business object with the given fields
+
+        :param field_dict: Field values of the object
+        :type field_dict: dict
+        :return: the XML string of the object
+        :rtype: str
+        """
+        if not field_dict:
+            return self.empty
+        buffer = [self.head]
+        append = buffer.append
+        field_tags = self.field_tags
+        for field, text in field_dict.iteritems():
+            tags = field_tags.get(field) or self.field_tag(field)
+            if text:
+                append(tags[0])
+                append(escape_xml_text(text))
+                append('</Field>')
+            else:
+                append(tags[1])
+        append(self.tail)
+        return ''.join(buffer)
+
+
 class BusinessObjectFactory:
     """
     This is where business objects are created. You can create any business object with the create_business_object method,
@@ -351,6 +871,21 @@ class BusinessObjectFactory:
         :return: the XML string of the object
         :rtype: dict
         """
+        return BusinessObjectXmlWriter.for_type(botype).write(field_dict)
+
+    @staticmethod
+    def generate_object_xml_with_etree(botype, field_dict):
+        """
+        Generate the XML for the creation/update of a business object through an ElementTree. This is the reference
+        for generate_object_xml, which writes the same bytes without building the tree.
+
+        :param botype: Type of object to generate
+        :type botype: str
+        :param field_dict: dictionary of fields for the update/creation
+        :type field_dict: dict
+        :return: the XML string of the object
+        :rtype: str
+        """
         bo_xml_root = ET.Element("BusinessObject")
         bo_xml_root.set("Name", botype)
         field_list = ET.SubElement(bo_xml_root, "FieldList")
@@ -380,18 +915,20 @@ class BusinessObjectFactory:
         :rtype: BusinessObject
         """
         creation_xml = BusinessObjectFactory.generate_object_xml(type, field_dict)
-        recid = self.cherwell_connection.create_business_object(type, creation_xml)
+        recid = self.cherwell_connection.create_business_object(type, creation_xml, field_dict)
         business_object = BusinessObject(type, recid, self.cherwell_connection)
-        business_object.set_fields(field_dict)
+        if recid:
+            # The object was created with these values, there is no need to update it with them again
+            business_object.import_fields(dict(field_dict, RecID=recid))
 
         return business_object
 
 
     def populate_customer_field(self, customer_email, fields):
         try:
-            fields['CustomerDisplayName'] = self.cherwell_connection.get_customer_id(customer_email)
+            fields['CustomerRecID'], fields['CustomerDisplayName'] = \
+                self.cherwell_connection.get_customer_ids(customer_email)
             fields['CustomerTypeID'] = cherwellconstants.CUSTOMER_TYPE_ID
-            fields['CustomerRecID'] = self.cherwell_connection.get_customer_id(customer_email, wantpubid=False)
         except:
             fields['CustomerDisplayName'] = customer_email
             fields['CustomerTypeID'] = cherwellconstants.CUSTOMER_TYPE_ID
@@ -436,12 +973,13 @@ class BusinessObjectFactory:
 
         print "Calling the business object factory"
         incident = self.create_bo_of_type(Incident, fields, haspubid=True)
+        if incident is None:
+            return None
 
-        print "Assigning team"
-        incident.assign(team_owner_name)
-
-        print "Setting the status"
-        incident['Status'] = 'New'
+        print "Assigning team and setting the status"
+        with incident:
+            incident.assign(team_owner_name)
+            incident['Status'] = 'New'
         return incident
 
 
@@ -467,7 +1005,7 @@ class BusinessObjectFactory:
         :return: Task BusinessObject
         :rtype: Task
         """
-        parent_recid = Incident(parent_pubid, self.cherwell_connection)['RecID']
+        parent_recid = self.cherwell_connection.get_recid('Incident', parent_pubid)
 
         params = {"ParentRecID": parent_recid,
                   "OwnedByTeam": team_owner_name,
@@ -488,7 +1026,7 @@ class BusinessObjectFactory:
         :param changes_made:
         :return: a journal entry object
         """
-        parent_recid = Incident(parent_pubid, self.cherwell_connection)['RecID']
+        parent_recid = self.cherwell_connection.get_recid('Incident', parent_pubid)
 
         params = {'ParentRecID': parent_recid,
                   'ParentTypeID': cherwellconstants.PARENT_TYPE_ID_INCIDENT,
@@ -501,9 +1039,31 @@ class BusinessObjectFactory:
         return self.create_bo_of_type(JournalHistory, params)
 
 
-    def create_bo_of_type(self, type, params, haspubid=False, altpub=None):
+    def get_bo_of_type(self, type, object_id):
+        """
+        Get a BusinessObject that is defined in the *cherwell_business_object* class by its id. An instance already in
+        the shared business object cache is reused, so looking the same object up again does not download it again.
+
+        :param type: The BusinessObject derivation (this is NOT a string, it is the ACTUAL type)
+        :type type: BusinessObject
+        :param object_id: The public id of the object if the type has one, its record id otherwise
+        :type object_id: str
+        :return: the specified BusinessObject derivative requested
+        :rtype: BusinessObject
+        """
+        bo = type(object_id, self.cherwell_connection)
+        cached_bo = business_object_cache.get(self.cherwell_connection.endpoint(), bo.type, object_id, bo.has_pubid)
+        if cached_bo is not None:
+            return cached_bo
+        if bo['RecID'] is not None:
+            business_object_cache.add(bo)
+        return bo
+
+
+    def create_bo_of_type(self, type, params, haspubid=False, altpub=None, fetch=True):
         """
-        Method for creating a BusinessObject that is defined in the *cherwell_business_object* class
+        Method for creating a BusinessObject that is defined in the *cherwell_business_object* class. This takes one
+        call to create the object and, unless *fetch* is False, one call to download it.
 
         :param type: The BusinessObject derivation (this is NOT a string, it is the ACTUAL type)
         :type type: BusinessObject
@@ -513,7 +1073,10 @@ class BusinessObjectFactory:
         :type haspubid: bool
         :param altpub: The field name for the public id if it is NOT "<BOname>ID"
         :type altpub: str
-        :return: the specified BusinessObject derivative requested
+        :param fetch: Whether to download the created object to get the fields Cherwell fills in, such as its public
+                      id. Without it the object only holds *params* and its record id, and is looked up by record id.
+        :type fetch: bool
+        :return: the specified BusinessObject derivative requested, None if it could not be created
         :rtype: BusinessObject
         """
         if type.__name__ is 'BusinessObject':
@@ -523,9 +1086,23 @@ class BusinessObjectFactory:
             pubid_fieldname = type.__name__ + 'ID'
         else:
             pubid_fieldname = altpub
-        created_bo = self.create_business_object(type.__name__, params)
-        bo = type(created_bo.id, self.cherwell_connection) if not haspubid else type(created_bo[pubid_fieldname], self.cherwell_connection)
-        bo.import_xml(created_bo.to_xml())
+        creation_xml = BusinessObjectFactory.generate_object_xml(type.__name__, params)
+        recid = self.cherwell_connection.create_business_object(type.__name__, creation_xml, params)
+        if not recid:
+            print "Failed to create " + type.__name__
+            return None
+
+        bo = type(recid, self.cherwell_connection)
+        bo_xml = self.cherwell_connection.get_bus_obj_by_recid(type.__name__, recid) if fetch else None
+        if bo_xml:
+            bo.import_xml(bo_xml)
+        else:
+            bo.import_fields(dict(params, RecID=recid))
+        if haspubid and bo.fields.get(pubid_fieldname):
+            bo.id = bo.fields[pubid_fieldname]
+        else:
+            bo.has_pubid = False
+        business_object_cache.add(bo)
         return bo
 
 
@@ -537,7 +1114,7 @@ class BusinessObjectFactory:
         :param notes:
         :return: the team note requested
         """
-        parent_recid = Incident(parent_pubid, self.cherwell_connection)['RecID']
+        parent_recid = self.cherwell_connection.get_recid('Incident', parent_pubid)
 
         params = {'ParentRecID': parent_recid,
                   'ParentTypeID': cherwellconstants.PARENT_TYPE_ID_INCIDENT,
@@ -566,6 +1143,11 @@ class BusinessObjectFactory:
         return business_object
 
 
+# Tag the SOAP calls made by each method with the method, see cherwell_metrics
+for _class in [BusinessObject, BusinessObjectFactory] + BusinessObject.__subclasses__():
+    trace_methods(_class, skip=('is_changed', 'is_fresh', 'is_known_missing'))
+
+
 # if __name__ == '__main__':
 #     # Used for  generating a unit test ticket
 #     BusinessObjectFactory = BusinessObjectFactory(None)
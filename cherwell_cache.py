@@ -0,0 +1,348 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+__author__ = 'jptingle'
+
+
+class BusinessObjectCache(object):
+    """
+    Identity map of BusinessObjects keyed by server, type and record id, with an index of public ids. Code that
+    looks an object up through the cache gets the instance already in memory, along with every field it has
+    downloaded, instead of a new object that downloads the record again. Servers are told apart by the endpoint of
+    the connection an object was read through, so objects of different servers never stand in for each other.
+
+    The least recently used objects are evicted once there are more than *max_objects* or their fields take more
+    than roughly *max_bytes*. Objects are invalidated whenever Cherwell creates or updates their record.
+    """
+    def __init__(self, max_objects=1000, max_bytes=32 * 1024 * 1024):
+        self.max_objects = max_objects
+        self.max_bytes = max_bytes
+        self.objects = OrderedDict()
+        self.sizes = dict()
+        self.public_ids = dict()
+        self.aliases = dict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.objects)
+
+    @staticmethod
+    def size_of(business_object):
+        """
+        Approximate memory taken by the fields of a business object
+
+        :rtype: int
+        """
+        return 200 + sum(len(name) + len(value or '') + 100 for name, value in business_object.fields.iteritems())
+
+    def key(self, endpoint, bo_type, object_id, is_pubid=False):
+        if is_pubid:
+            return self.public_ids.get((endpoint, bo_type, object_id))
+        return endpoint, bo_type, object_id
+
+    def get(self, endpoint, bo_type, object_id, is_pubid=False):
+        """
+        Get a cached business object
+
+        :param endpoint: URL of the server the object is on
+        :type endpoint: str
+        :param bo_type: The type of business object
+        :type bo_type: str
+        :param object_id: The record id or public id of the object
+        :type object_id: str
+        :param is_pubid: Whether object_id is a public id
+        :type is_pubid: bool
+        :return: the cached object, None if it is not cached
+        :rtype: BusinessObject
+        """
+        with self.lock:
+            key = self.key(endpoint, bo_type, object_id, is_pubid)
+            business_object = self.objects.pop(key, None)
+            if business_object is None:
+                self.misses += 1
+                return None
+            self.objects[key] = business_object
+            self.hits += 1
+            self.resize(key)
+            return business_object
+
+    def add(self, business_object):
+        """
+        Cache a business object under the endpoint of its connection. Objects that do not know their record id yet
+        are not cached.
+
+        :param business_object: The object to cache
+        :type business_object: BusinessObject
+        :return: None
+        """
+        recid = business_object.fields.get('RecID')
+        if not recid:
+            return
+        endpoint = business_object.cherwell_connection.endpoint()
+        with self.lock:
+            key = (endpoint, business_object.type, recid)
+            self.remove(key)
+            self.objects[key] = business_object
+            self.sizes[key] = 0
+            if business_object.has_pubid and business_object.id is not None:
+                alias = (endpoint, business_object.type, business_object.id)
+                self.public_ids[alias] = key
+                self.aliases[key] = alias
+            self.resize(key)
+
+    def resize(self, key):
+        size = self.size_of(self.objects[key])
+        self.total_bytes += size - self.sizes[key]
+        self.sizes[key] = size
+        while len(self.objects) > 1 and (len(self.objects) > self.max_objects or self.total_bytes > self.max_bytes):
+            self.remove(next(iter(self.objects)))
+
+    def remove(self, key):
+        if self.objects.pop(key, None) is not None:
+            self.total_bytes -= self.sizes.pop(key)
+            alias = self.aliases.pop(key, None)
+            if alias is not None:
+                del self.public_ids[alias]
+
+    def invalidate(self, endpoint, bo_type, object_id, is_pubid=False):
+        """
+        Drop a business object from the cache
+
+        :param endpoint: URL of the server the object is on
+        :type endpoint: str
+        :param bo_type: The type of business object
+        :type bo_type: str
+        :param object_id: The record id or public id of the object
+        :type object_id: str
+        :param is_pubid: Whether object_id is a public id
+        :type is_pubid: bool
+        :return: None
+        """
+        with self.lock:
+            key = self.key(endpoint, bo_type, object_id, is_pubid)
+            if key is not None:
+                self.remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.objects.clear()
+            self.sizes.clear()
+            self.public_ids.clear()
+            self.aliases.clear()
+            self.total_bytes = 0
+
+
+class TTLCache(object):
+    """
+    A bounded mapping whose entries expire *ttl* seconds after they are stored. The least recently used entries are
+    evicted once there are more than *max_entries*.
+    """
+    def __init__(self, max_entries=10000, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """
+        Get a stored value
+
+        :param key: The key of the value
+        :return: the value, None if it is not stored or has expired
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires is not None and expires < time.time():
+                return None
+            self.entries[key] = entry
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl if self.ttl is not None else None, value)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class AttachmentCache(object):
+    """
+    Content-addressed store of downloaded attachments on disk, kept across runs. Each file is stored once under the
+    SHA-256 of its content, and an index maps every attachment id of a server to the content it was downloaded with,
+    so an attachment is never downloaded twice and attachments with the same content share one file.
+
+    The least recently used files are removed once the stored content takes more than *max_bytes*.
+    """
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024):
+        """
+        :param directory: Directory of the cache
+        :type directory: str
+        :param max_bytes: Most bytes of content to keep
+        :type max_bytes: int
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    def index_path(self, endpoint, attachment_id):
+        key = u'%s\n%s' % (endpoint, attachment_id)
+        return os.path.join(self.directory, 'ids', hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def content_path(self, content_hash):
+        return os.path.join(self.directory, 'content', content_hash[:2], content_hash)
+
+    def get(self, endpoint, attachment_id):
+        """
+        Get the cached file of an attachment
+
+        :param endpoint: URL of the server the attachment is on
+        :type endpoint: str
+        :param attachment_id: Id of the attachment
+        :type attachment_id: str
+        :return: path of the cached file, None if it is not cached
+        :rtype: str
+        """
+        index_path = self.index_path(endpoint, attachment_id)
+        try:
+            with open(index_path) as index_file:
+                content_path = self.content_path(index_file.read().strip())
+        except IOError:
+            return None
+        try:
+            # Marks the file as recently used
+            os.utime(content_path, None)
+        except OSError:
+            # Evicted, so the index entry goes too
+            try:
+                os.remove(index_path)
+            except OSError:
+                pass
+            return None
+        return content_path
+
+    def store(self, endpoint, attachment_id, download):
+        """
+        Download an attachment into the cache
+
+        :param endpoint: URL of the server the attachment is on
+        :type endpoint: str
+        :param attachment_id: Id of the attachment
+        :type attachment_id: str
+        :param download: Function downloading the attachment to the path it is given, returning None on failure
+        :type download: function
+        :return: path of the cached file, None if the download failed
+        :rtype: str
+        """
+        index_path = self.index_path(endpoint, attachment_id)
+        for directory in (os.path.dirname(index_path), os.path.join(self.directory, 'content')):
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    # Made by another process in the meantime
+                    pass
+        temp_file, temp_path = tempfile.mkstemp(dir=self.directory)
+        os.close(temp_file)
+        try:
+            if download(temp_path) is None:
+                return None
+            content_hash = hashlib.sha256()
+            with open(temp_path, 'rb') as downloaded_file:
+                for block in iter(lambda: downloaded_file.read(65536), ''):
+                    content_hash.update(block)
+            content_path = self.content_path(content_hash.hexdigest())
+            if not os.path.exists(content_path):
+                if not os.path.isdir(os.path.dirname(content_path)):
+                    os.makedirs(os.path.dirname(content_path))
+                os.rename(temp_path, content_path)
+
+            # Written aside and renamed, so other processes never see a partial index entry
+            index_file, index_temp_path = tempfile.mkstemp(dir=self.directory)
+            os.write(index_file, content_hash.hexdigest())
+            os.close(index_file)
+            os.rename(index_temp_path, index_path)
+            self.evict(keep=content_path)
+            return content_path
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used files until the content takes at most max_bytes
+
+        :param keep: Path of a file not to remove
+        :type keep: str
+        """
+        with self.lock:
+            files = []
+            total_bytes = 0
+            for directory, _, names in os.walk(os.path.join(self.directory, 'content')):
+                for name in names:
+                    path = os.path.join(directory, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, path))
+                    total_bytes += stat.st_size
+            files.sort()
+            for _, size, path in files:
+                if total_bytes <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.remove(path)
+                except OSError:
+                    # Removed by another process in the meantime
+                    pass
+                total_bytes -= size
+
+    def copy(self, endpoint, attachment_id, file_path):
+        """
+        Copy the cached file of an attachment
+
+        :return: Whether the attachment was cached
+        :rtype: bool
+        """
+        content_path = self.get(endpoint, attachment_id)
+        if content_path is None:
+            return False
+        shutil.copyfile(content_path, file_path)
+        return True
+
+
+# Shared by every Cherwell connection and BusinessObjectFactory in the process
+business_object_cache = BusinessObjectCache()
+
+# (endpoint, type, public id) -> record id
+public_id_cache = TTLCache(max_entries=100000, ttl=24 * 3600)
+
+# (endpoint, type, field, value) -> (record id, public id) of the first object with that field value
+field_id_cache = TTLCache(max_entries=10000, ttl=3600)
+
+# (type, field) -> when objects of the type were last found not to have the field
+missing_field_cache = TTLCache(max_entries=10000, ttl=None)
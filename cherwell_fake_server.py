@@ -0,0 +1,479 @@
+"""
+An in-process fake of the Cherwell SOAP API for running the library offline. Requests and responses are
+read and written with the bundled api.wsdl and business objects live in memory.
+
+Latency and failures of a real server can be injected: every request can be delayed, and a share of them answered
+with a failed result, as Cherwell does when a call goes wrong, or with a SOAP fault.
+
+**Example**::
+
+    server = FakeCherwellServer('user', 'password').start()
+    cherwell = Cherwell('user', 'password', server.url, use_bundled_wsdl=True)
+    ...
+    server.stop()
+"""
+import BaseHTTPServer
+import itertools
+import random
+import SocketServer
+import threading
+import time
+import uuid
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+
+from cherwell_wsdl import BUNDLED_WSDL, ServiceDescription
+
+__author__ = 'jptingle'
+
+SESSION_COOKIE = 'ASP.NET_SessionId'
+NOT_LOGGED_IN = 'You are not logged in. Please login and try again.'
+INJECTED_ERROR = 'Injected error'
+
+# Operations never failed on purpose, so that clients can always log in and learn why a call failed
+_UNFAILING_OPERATIONS = ('Login', 'Logout', 'GetLastError')
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class _FakeCherwellHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers are written one by one, which Nagle's algorithm would hold back on kept-alive connections
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.fake.connection_opened()
+
+    def do_GET(self):
+        with open(self.server.fake.wsdl_path, 'rb') as wsdl_file:
+            self.reply(200, wsdl_file.read())
+
+    def do_POST(self):
+        request_xml = self.rfile.read(int(self.headers['Content-Length']))
+        session_id = None
+        for cookie in self.headers.getheaders('Cookie'):
+            for morsel in cookie.split(';'):
+                name, _, value = morsel.strip().partition('=')
+                if name == SESSION_COOKIE:
+                    session_id = value
+        status, response_xml, new_session_id = self.server.fake.handle(session_id, request_xml)
+        self.reply(status, response_xml, new_session_id)
+
+    def reply(self, status, body, session_id=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        if session_id is not None:
+            self.send_header('Set-Cookie', SESSION_COOKIE + '=' + session_id + '; path=/')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeCherwellServer(object):
+    """
+    A local HTTP server answering Cherwell API calls from an in-memory store of business objects.
+    Each business object type gets a public id field named "<type>ID" when it is created.
+    """
+    def __init__(self, username='', password='', wsdl_path=BUNDLED_WSDL, latency=0, jitter=0, error_rate=0,
+                 fault_rate=0, seed=None):
+        """
+        :param username: User name to accept
+        :type username: str
+        :param password: Password to accept
+        :type password: str
+        :param wsdl_path: WSDL to read and write requests and responses with
+        :type wsdl_path: str
+        :param latency: Seconds every request is delayed by, or a dict of them by operation with None as the default
+        :type latency: float
+        :param jitter: Most seconds added at random to the latency of each request
+        :type jitter: float
+        :param error_rate: Share of requests answered with a failed result and an error for GetLastError
+        :type error_rate: float
+        :param fault_rate: Share of requests answered with a SOAP fault
+        :type fault_rate: float
+        :param seed: Seed of the choice of requests to delay and fail, for repeatable runs
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.fault_rate = fault_rate
+        self.random = random.Random(seed)
+        self.injected_errors = 0
+        self.injected_faults = 0
+        self.username = username
+        self.password = password
+        self.service = ServiceDescription(wsdl_path)
+        self.wsdl_path = wsdl_path
+        self.objects = OrderedDict()
+        self.public_ids = dict()
+        self.stored_queries = dict()
+        self.query_columns = dict()
+        self.definitions = dict()
+        self.attachments = dict()
+        self.attachment_ids = OrderedDict()
+        self.sessions = set()
+        self.last_errors = dict()
+        self.calls = []
+        self.connections = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.public_id_counter = itertools.count(100000)
+        self.lock = threading.RLock()
+        self.http_server = None
+        self.handlers = {
+            'Login': self.login,
+            'Logout': self.logout,
+            'GetLastError': self.get_last_error,
+            'GetBusinessObject': self.get_business_object,
+            'GetBusinessObjectByPublicId': self.get_business_object_by_public_id,
+            'QueryByFieldValue': self.query_by_field_value,
+            'QueryByStoredQuery': self.query_by_stored_query,
+            'QueryByStoredQueryWithScope': self.query_by_stored_query,
+            'GetQueryResults': self.get_query_results,
+            'GetItemList': self.get_item_list,
+            'GetBusinessObjectDefinition': self.get_business_object_definition,
+            'CreateBusinessObject': self.create_business_object,
+            'UpdateBusinessObject': self.update_business_object,
+            'UpdateBusinessObjectByPublicId': self.update_business_object_by_public_id,
+            'AddAttachmentToRecord': self.add_attachment_to_record,
+            'GetAttachmentsForBusinessObject': self.get_attachments_for_business_object,
+            'GetAttachment': self.get_attachment,
+        }
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/CherwellService/api.asmx' % self.http_server.server_port
+
+    def start(self):
+        self.http_server = _ThreadingHTTPServer(('127.0.0.1', 0), _FakeCherwellHandler)
+        self.http_server.fake = self
+        thread = threading.Thread(target=self.http_server.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.http_server.shutdown()
+        self.http_server.server_close()
+
+    def connection_opened(self):
+        with self.lock:
+            self.connections += 1
+
+    def expire_sessions(self):
+        """
+        Log every client out, as the server does when sessions time out
+
+        :return: None
+        """
+        with self.lock:
+            self.sessions.clear()
+
+    def call_count(self, operation_name=None):
+        with self.lock:
+            if operation_name is None:
+                return len(self.calls)
+            return self.calls.count(operation_name)
+
+    def handle(self, session_id, request_xml):
+        """
+        Answer one SOAP request
+
+        :param session_id: The session cookie sent with the request
+        :type session_id: str
+        :param request_xml: The request envelope
+        :type request_xml: str
+        :return: HTTP status, response envelope and a session id to set, if any
+        :rtype: tuple
+        """
+        operation_name, params = self.service.parse_request(request_xml)
+        with self.lock:
+            self.calls.append(operation_name)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            delay, failure = self.injection(operation_name)
+            if delay:
+                time.sleep(delay)
+            if failure == 'fault':
+                return 500, self.service.build_fault(INJECTED_ERROR), None
+            if failure == 'error':
+                self.set_error(session_id, INJECTED_ERROR)
+                return 200, self.service.build_response(operation_name, None), None
+            return self.dispatch(session_id, operation_name, params)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def injection(self, operation_name):
+        """
+        Choose the delay of a request and whether to fail it
+
+        :return: seconds to delay the request by, and 'error', 'fault' or None
+        :rtype: tuple
+        """
+        latency = self.latency
+        if isinstance(latency, dict):
+            latency = latency.get(operation_name, latency.get(None, 0))
+        with self.lock:
+            delay = latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+            if operation_name in _UNFAILING_OPERATIONS:
+                return delay, None
+            draw = self.random.random()
+            if draw < self.fault_rate:
+                self.injected_faults += 1
+                return delay, 'fault'
+            if draw < self.fault_rate + self.error_rate:
+                self.injected_errors += 1
+                return delay, 'error'
+        return delay, None
+
+    def dispatch(self, session_id, operation_name, params):
+        handler = self.handlers.get(operation_name)
+        if handler is None:
+            return 500, self.service.build_fault(operation_name + ' is not implemented by the fake server'), None
+        if operation_name == 'Login':
+            new_session_id = uuid.uuid4().hex
+            result = handler(session_id, params, new_session_id)
+            return 200, self.service.build_response(operation_name, result), new_session_id if result else None
+        if operation_name != 'GetLastError':
+            with self.lock:
+                logged_in = session_id in self.sessions
+            if not logged_in:
+                self.set_error(session_id, NOT_LOGGED_IN)
+                return 200, self.service.build_response(operation_name, None), None
+            self.set_error(session_id, None)
+        try:
+            result = handler(session_id, params)
+        except Exception as e:
+            return 500, self.service.build_fault(str(e)), None
+        return 200, self.service.build_response(operation_name, result), None
+
+    def set_error(self, session_id, error):
+        with self.lock:
+            self.last_errors[session_id] = error
+
+    def add_object(self, business_object_type, fields):
+        """
+        Put a business object straight into the store
+
+        :param business_object_type: Type of the object
+        :type business_object_type: str
+        :param fields: Field values of the object
+        :type fields: dict
+        :return: record id of the object
+        :rtype: str
+        """
+        with self.lock:
+            recid = uuid.uuid4().hex
+            record = OrderedDict(fields)
+            record['RecID'] = recid
+            public_id_field = business_object_type + 'ID'
+            if not record.get(public_id_field):
+                record[public_id_field] = str(next(self.public_id_counter))
+            self.objects[recid] = (business_object_type, record)
+            self.public_ids[(business_object_type, record[public_id_field])] = recid
+            return recid
+
+    def add_stored_query(self, query_name, business_object_type, fields, columns=None):
+        """
+        Define a stored query matching objects of a type whose fields equal the given values
+
+        :param columns: The fields GetQueryResults returns for each row, every field when None
+        :type columns: list
+        :return: None
+        """
+        self.stored_queries[query_name] = (business_object_type, dict(fields))
+        self.query_columns[query_name] = columns
+
+    def add_definition(self, business_object_type, fields):
+        """
+        Define the fields of a business object type for GetBusinessObjectDefinition. Objects are not checked against
+        it.
+
+        :param fields: Attributes of each field, such as Name, Type, Size and Required
+        :type fields: list
+        :return: None
+        """
+        self.definitions[business_object_type] = [dict(field) for field in fields]
+
+    def find_records(self, business_object_type, fields):
+        with self.lock:
+            return [(recid, record) for recid, (object_type, record) in self.objects.items()
+                    if object_type == business_object_type and
+                    all(record.get(field) == value for field, value in fields.items())]
+
+    def object_xml(self, business_object_type, record):
+        root = ET.Element('BusinessObject')
+        root.set('Name', business_object_type)
+        root.set('RecID', record['RecID'])
+        field_list = ET.SubElement(root, 'FieldList')
+        for name, value in record.items():
+            field = ET.SubElement(field_list, 'Field')
+            field.set('Name', name)
+            field.text = value
+        return ET.tostring(root)
+
+    def query_xml(self, business_object_type, records):
+        root = ET.Element('QueryResult')
+        for recid, record in records:
+            element = ET.SubElement(root, 'Record')
+            element.set('RecId', recid)
+            element.text = record.get(business_object_type + 'ID')
+        return ET.tostring(root)
+
+    @staticmethod
+    def parse_fields(business_object_xml):
+        fields = OrderedDict()
+        for field in ET.fromstring(business_object_xml).find('FieldList'):
+            fields[field.get('Name')] = field.text
+        return fields
+
+    def login(self, session_id, params, new_session_id):
+        if params['userId'] == self.username and params['password'] == self.password:
+            with self.lock:
+                self.sessions.add(new_session_id)
+            self.set_error(new_session_id, None)
+            return True
+        self.set_error(session_id, 'Invalid user name or password')
+        return False
+
+    def logout(self, session_id, params):
+        with self.lock:
+            self.sessions.discard(session_id)
+        return True
+
+    def get_last_error(self, session_id, params):
+        with self.lock:
+            return self.last_errors.get(session_id)
+
+    def get_business_object(self, session_id, params):
+        with self.lock:
+            object_type, record = self.objects.get(params['busObRecId'], (None, None))
+        if object_type != params['busObNameOrId']:
+            self.set_error(session_id, 'Business object not found')
+            return None
+        return self.object_xml(object_type, record)
+
+    def get_business_object_by_public_id(self, session_id, params):
+        with self.lock:
+            recid = self.public_ids.get((params['busObNameOrId'], params['busObPublicId']))
+        return self.get_business_object(session_id, {'busObNameOrId': params['busObNameOrId'], 'busObRecId': recid})
+
+    def query_by_field_value(self, session_id, params):
+        business_object_type = params['busObNameOrId']
+        records = self.find_records(business_object_type, {params['fieldNameOrId']: params['value']})
+        return self.query_xml(business_object_type, records)
+
+    def query_by_stored_query(self, session_id, params):
+        if params['queryNameOrId'] not in self.stored_queries:
+            self.set_error(session_id, 'Stored query not found')
+            return None
+        business_object_type, fields = self.stored_queries[params['queryNameOrId']]
+        return self.query_xml(business_object_type, self.find_records(business_object_type, fields))
+
+    def get_query_results(self, session_id, params):
+        if params['queryId'] not in self.stored_queries:
+            self.set_error(session_id, 'Stored query not found')
+            return None
+        business_object_type, fields = self.stored_queries[params['queryId']]
+        records = self.find_records(business_object_type, fields)
+        record_limit = int(params.get('recordLimit') or 0)
+        if record_limit:
+            records = records[:record_limit]
+        columns = self.query_columns.get(params['queryId'])
+        root = ET.Element('QueryResult')
+        for recid, record in records:
+            element = ET.SubElement(root, 'Record', RecId=recid)
+            for name, value in record.items():
+                if columns is None or name in columns:
+                    ET.SubElement(element, 'Field', Name=name).text = value
+        return ET.tostring(root)
+
+    def get_item_list(self, session_id, params):
+        # Lists the stored queries on the object named by objectNameOrId
+        root = ET.Element('ItemList')
+        for query_name, (business_object_type, fields) in sorted(self.stored_queries.items()):
+            if business_object_type == params['objectNameOrId']:
+                ET.SubElement(root, 'Item', Name=query_name, Type=params['objectType'] or '')
+        return ET.tostring(root)
+
+    def get_business_object_definition(self, session_id, params):
+        if params['nameOrId'] not in self.definitions:
+            self.set_error(session_id, 'Business object definition not found')
+            return None
+        root = ET.Element('BusinessObjectDef', Name=params['nameOrId'])
+        field_list = ET.SubElement(root, 'FieldList')
+        for field in self.definitions[params['nameOrId']]:
+            ET.SubElement(field_list, 'Field', field)
+        return ET.tostring(root)
+
+    def create_business_object(self, session_id, params):
+        return self.add_object(params['busObNameOrId'], self.parse_fields(params['creationXml']))
+
+    def update_business_object(self, session_id, params):
+        with self.lock:
+            object_type, record = self.objects.get(params['busObRecId'], (None, None))
+            if object_type != params['busObNameOrId']:
+                self.set_error(session_id, 'Business object not found')
+                return False
+            record.update(self.parse_fields(params['updateXml']))
+            return True
+
+    def update_business_object_by_public_id(self, session_id, params):
+        with self.lock:
+            recid = self.public_ids.get((params['busObNameOrId'], params['busObPublicId']))
+        return self.update_business_object(session_id, {'busObNameOrId': params['busObNameOrId'],
+                                                        'busObRecId': recid,
+                                                        'updateXml': params['updateXml']})
+
+    def add_attachment(self, recid, attachment_name, data):
+        """
+        Attach data straight to a business object in the store
+
+        :return: id of the attachment
+        :rtype: str
+        """
+        with self.lock:
+            attachments = self.attachments.setdefault(recid, [])
+            attachment_id = uuid.uuid4().hex
+            self.attachment_ids[attachment_id] = (recid, len(attachments))
+            attachments.append((attachment_name, data))
+            return attachment_id
+
+    def add_attachment_to_record(self, session_id, params):
+        with self.lock:
+            if params['busObRecId'] not in self.objects:
+                self.set_error(session_id, 'Business object not found')
+                return False
+            self.add_attachment(params['busObRecId'], params['attachmentName'],
+                                params['attachmentData'].decode('base64'))
+            return True
+
+    def get_attachments_for_business_object(self, session_id, params):
+        with self.lock:
+            object_type, record = self.objects.get(params['busObRecId'], (None, None))
+            if object_type != params['busObNameOrId']:
+                self.set_error(session_id, 'Business object not found')
+                return None
+            attachments_root = ET.Element('Attachments')
+            for attachment_id, (recid, index) in self.attachment_ids.items():
+                if recid == params['busObRecId']:
+                    attachment_name, data = self.attachments[recid][index]
+                    ET.SubElement(attachments_root, 'Attachment',
+                                  Id=attachment_id, Name=attachment_name, Size=str(len(data)))
+            return ET.tostring(attachments_root)
+
+    def get_attachment(self, session_id, params):
+        with self.lock:
+            if params['attachmentId'] not in self.attachment_ids:
+                self.set_error(session_id, 'Attachment not found')
+                return None
+            recid, index = self.attachment_ids[params['attachmentId']]
+            return self.attachments[recid][index][1].encode('base64')
@@ -0,0 +1,567 @@
+"""
+Counts, latencies and sizes of the SOAP calls Cherwell_Soap makes, by WSDL operation.
+
+Every call run through Cherwell_Soap.run_soap_cmd is recorded with its latency, the bytes sent and received, the
+GetLastError calls it needed and whether it was retried after logging back in. Calls are also tagged with the
+outermost Cherwell, BusinessObject or BusinessObjectFactory method the calling thread is running, so that the calls
+one high-level method turns into can be counted.
+
+Recorded calls are kept in a Metrics registry, which can be dumped in the Prometheus text format or as a JSON
+snapshot, and hands each call to the hooks added to it.
+
+A RoundTripProfiler block keeps every call made inside it, from the calling thread and the threads it starts, under
+the full stack of traced methods that made it. It reports them as a tree, points out calls repeated with the same
+arguments, and can fail the block when it makes more round trips than it was budgeted.
+"""
+import bisect
+import functools
+import inspect
+import itertools
+import json
+import threading
+import time
+import types
+from collections import OrderedDict
+
+from suds.plugin import MessagePlugin
+
+__author__ = 'jptingle'
+
+_tags = threading.local()
+_invocation_ids = itertools.count()
+
+# Invocations each registry remembers per caller, to count every invocation once however many calls it makes
+_RECENT_INVOCATIONS = 1000
+
+
+def current_tag():
+    """
+    The outermost traced method the calling thread is running, and the id of that invocation of it
+
+    :return: the method as "Class.method" and the invocation id, None outside traced methods
+    :rtype: tuple
+    """
+    stack = getattr(_tags, 'stack', None)
+    return stack[0] if stack else None
+
+
+def current_caller():
+    """
+    :return: the outermost traced method the calling thread is running, None outside traced methods
+    :rtype: str
+    """
+    tag = current_tag()
+    return tag[0] if tag else None
+
+
+def current_path():
+    """
+    :return: every traced method the calling thread is running, outermost first
+    :rtype: tuple
+    """
+    return tuple(caller for caller, invocation in getattr(_tags, 'stack', None) or ())
+
+
+def _push(tag):
+    stack = getattr(_tags, 'stack', None)
+    if stack is None:
+        stack = _tags.stack = []
+    stack.append(tag)
+
+
+class caller_tag(object):
+    """
+    Context manager tagging the calls made in its block with a caller, unless an outer caller is already tagged
+    """
+    def __init__(self, caller):
+        self.caller = caller
+
+    def __enter__(self):
+        _push((self.caller, next(_invocation_ids)))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _tags.stack.pop()
+
+
+def traced(caller):
+    """
+    Decorate a method so the calls it makes are tagged with *caller*
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def traced_function(*args, **kwargs):
+            with caller_tag(caller):
+                return function(*args, **kwargs)
+        return traced_function
+    return decorate
+
+
+def trace_methods(cls, skip=()):
+    """
+    Trace the public methods a class defines, other than generators, whose calls happen as they are iterated
+
+    :param cls: The class
+    :type cls: type
+    :param skip: Methods to leave alone, such as cheap ones run for every field read
+    :type skip: tuple
+    :return: None
+    """
+    for name, function in cls.__dict__.items():
+        if name.startswith('_') or name in skip or not isinstance(function, types.FunctionType) or \
+                inspect.isgeneratorfunction(function):
+            continue
+        setattr(cls, name, traced(cls.__name__ + '.' + name)(function))
+
+
+def carry_caller(function):
+    """
+    Wrap the target of a thread so the calls it makes are tagged with the callers, and kept by the profilers, of the
+    thread that started it
+    """
+    stack = list(getattr(_tags, 'stack', None) or ())
+    profilers = list(getattr(_tags, 'profilers', None) or ())
+    if not stack and not profilers:
+        return function
+
+    @functools.wraps(function)
+    def tagged_function(*args, **kwargs):
+        outer_stack = getattr(_tags, 'stack', None)
+        outer_profilers = getattr(_tags, 'profilers', None)
+        _tags.stack = list(stack)
+        _tags.profilers = list(profilers)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _tags.stack = outer_stack
+            _tags.profilers = outer_profilers
+    return tagged_function
+
+
+def profile_call(call):
+    """
+    Hand a finished call to the profilers active on the calling thread
+    """
+    for profiler in getattr(_tags, 'profilers', None) or ():
+        profiler.add(call)
+
+
+class LatencyHistogram(object):
+    """
+    Counts of latencies in buckets growing by a quarter of an octave from 1ms, about 19% wide, up to two minutes
+    """
+    bounds = [0.001 * 2 ** (x / 4.0) for x in range(69)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def percentile(self, fraction):
+        """
+        Estimate a percentile by interpolating within its bucket
+
+        :param fraction: The percentile, e.g. 0.95
+        :type fraction: float
+        :return: latency in seconds, None when nothing was observed
+        :rtype: float
+        """
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                if index == len(self.bounds):
+                    return self.bounds[-1]
+                lower = self.bounds[index - 1] if index else 0.0
+                return lower + (self.bounds[index] - lower) * (rank - seen) / count
+            seen += count
+        return self.bounds[-1]
+
+
+class CallRecord(object):
+    """
+    One call of an operation through run_soap_cmd, as handed to hooks
+    """
+    def __init__(self, operation, tag=None, path=(), arguments=()):
+        self.operation = operation
+        self.caller, self.invocation = tag if tag is not None else (None, None)
+        self.path = path
+        self.arguments = arguments
+        self.started = time.time()
+        self.latencies = []
+        self.in_attempt = False
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.last_error_hits = 0
+        self.relogins = 0
+        self.error = None
+
+    @property
+    def retries(self):
+        return max(0, len(self.latencies) - 1)
+
+    @property
+    def round_trips(self):
+        """
+        Requests sent to the server: every attempt, and the GetLastError and Login calls between them
+        """
+        return len(self.latencies) + self.last_error_hits + self.relogins
+
+    def to_dict(self):
+        return {'operation': self.operation, 'caller': self.caller, 'started': self.started,
+                'latencies': self.latencies, 'request_bytes': self.request_bytes,
+                'response_bytes': self.response_bytes, 'last_error_hits': self.last_error_hits,
+                'relogins': self.relogins, 'error': self.error}
+
+
+class OperationStats(object):
+    """
+    Totals of one operation
+    """
+    counters = ('calls', 'failures', 'retries', 'relogins', 'last_error_hits', 'request_bytes', 'response_bytes')
+
+    def __init__(self):
+        for counter in self.counters:
+            setattr(self, counter, 0)
+        self.latency = LatencyHistogram()
+
+    def add(self, call):
+        self.calls += 1
+        self.failures += call.error is not None
+        self.retries += call.retries
+        self.relogins += call.relogins
+        self.last_error_hits += call.last_error_hits
+        self.request_bytes += call.request_bytes
+        self.response_bytes += call.response_bytes
+        for latency in call.latencies:
+            self.latency.observe(latency)
+
+    def to_dict(self):
+        stats = dict((counter, getattr(self, counter)) for counter in self.counters)
+        for name, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+            stats[name] = self.latency.percentile(fraction)
+        return stats
+
+
+def _label(value):
+    return '"' + unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+
+
+class Metrics(object):
+    """
+    Registry of recorded calls
+
+    **Example**::
+
+        print cherwell_server.cherwell.metrics.to_prometheus()
+    """
+    def __init__(self):
+        self.operations = dict()
+        self.callers = dict()
+        self.recent_invocations = dict()
+        self.hooks = []
+        self.lock = threading.Lock()
+
+    def add_hook(self, hook):
+        """
+        Have a function called with the CallRecord of every call once it has finished
+
+        :param hook: The function
+        :type hook: function
+        :return: None
+        """
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def record(self, call):
+        """
+        Add a finished call to the totals and hand it to the hooks
+
+        :param call: The call
+        :type call: CallRecord
+        :return: None
+        """
+        with self.lock:
+            stats = self.operations.get(call.operation)
+            if stats is None:
+                stats = self.operations[call.operation] = OperationStats()
+            stats.add(call)
+            if call.caller is not None:
+                totals = self.callers.setdefault(call.caller, {'invocations': 0, 'calls': dict()})
+                totals['calls'][call.operation] = totals['calls'].get(call.operation, 0) + 1
+                recent = self.recent_invocations.setdefault(call.caller, OrderedDict())
+                if call.invocation not in recent:
+                    totals['invocations'] += 1
+                    recent[call.invocation] = True
+                    if len(recent) > _RECENT_INVOCATIONS:
+                        recent.popitem(last=False)
+        for hook in list(self.hooks):
+            try:
+                hook(call)
+            except Exception as e:
+                print e
+
+    def reset(self):
+        with self.lock:
+            self.operations.clear()
+            self.callers.clear()
+            self.recent_invocations.clear()
+
+    def snapshot(self):
+        """
+        :return: the totals of every operation, and for every caller the calls it made and the number of its
+                 invocations that made any
+        :rtype: dict
+        """
+        with self.lock:
+            return {'operations': dict((operation, stats.to_dict()) for operation, stats in self.operations.items()),
+                    'callers': dict((caller, {'invocations': totals['invocations'], 'calls': dict(totals['calls'])})
+                                    for caller, totals in self.callers.items())}
+
+    def to_json(self, **options):
+        return json.dumps(self.snapshot(), sort_keys=True, **options)
+
+    def to_prometheus(self):
+        """
+        :return: the totals in the Prometheus text exposition format
+        :rtype: str
+        """
+        lines = []
+        with self.lock:
+            operations = sorted(self.operations.items())
+            for counter in OperationStats.counters:
+                name = 'cherwell_soap_' + counter + '_total'
+                lines.append('# TYPE ' + name + ' counter')
+                for operation, stats in operations:
+                    lines.append('%s{operation=%s} %d' % (name, _label(operation), getattr(stats, counter)))
+
+            lines.append('# TYPE cherwell_soap_latency_seconds histogram')
+            for operation, stats in operations:
+                cumulative = 0
+                for bound, count in zip(LatencyHistogram.bounds + ['+Inf'], stats.latency.counts):
+                    cumulative += count
+                    le = bound if bound == '+Inf' else '%.6g' % bound
+                    lines.append('cherwell_soap_latency_seconds_bucket{operation=%s,le="%s"} %d' %
+                                 (_label(operation), le, cumulative))
+                lines.append('cherwell_soap_latency_seconds_sum{operation=%s} %.6f' %
+                             (_label(operation), stats.latency.sum))
+                lines.append('cherwell_soap_latency_seconds_count{operation=%s} %d' %
+                             (_label(operation), stats.latency.count))
+
+            callers = sorted(self.callers.items())
+            lines.append('# TYPE cherwell_caller_invocations_total counter')
+            for caller, totals in callers:
+                lines.append('cherwell_caller_invocations_total{caller=%s} %d' % (_label(caller),
+                                                                                  totals['invocations']))
+            lines.append('# TYPE cherwell_caller_calls_total counter')
+            for caller, totals in callers:
+                for operation, count in sorted(totals['calls'].items()):
+                    lines.append('cherwell_caller_calls_total{caller=%s,operation=%s} %d' %
+                                 (_label(caller), _label(operation), count))
+        return '\n'.join(lines) + '\n'
+
+
+class RoundTripBudgetExceeded(AssertionError):
+    """
+    Raised by a strict RoundTripProfiler whose block made more round trips than its budget
+    """
+
+
+class ProfileNode(object):
+    """
+    A traced method, or the operation a call ran, in the tree of a RoundTripProfiler
+    """
+    def __init__(self, name):
+        self.name = name
+        self.children = OrderedDict()
+        self.calls = 0
+        self.round_trips = 0
+        self.seconds = 0.0
+
+    def child(self, name):
+        node = self.children.get(name)
+        if node is None:
+            node = self.children[name] = ProfileNode(name)
+        return node
+
+    def add(self, call):
+        self.calls += 1
+        self.round_trips += call.round_trips
+        self.seconds += sum(call.latencies)
+
+
+class RoundTripProfiler(object):
+    """
+    Context manager keeping every call made in its block
+
+    **Example**::
+
+        with RoundTripProfiler(budget=6, strict=True) as profiler:
+            factory.create_incident(email, summary, description, service, category, subcategory, team)
+        print profiler.report()
+    """
+    def __init__(self, budget=None, strict=False, name='block'):
+        """
+        :param budget: Most round trips the block should make, None for no limit
+        :type budget: int
+        :param strict: Whether to raise RoundTripBudgetExceeded when the block leaves over its budget
+        :type strict: bool
+        :param name: Name of the root of the tree
+        :type name: str
+        """
+        self.budget = budget
+        self.strict = strict
+        self.name = name
+        self.calls = []
+        self.started = None
+        self.elapsed = None
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        profilers = getattr(_tags, 'profilers', None)
+        if profilers is None:
+            profilers = _tags.profilers = []
+        profilers.append(self)
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.elapsed = time.time() - self.started
+        _tags.profilers.remove(self)
+        if exc_type is None and self.strict and self.over_budget:
+            raise RoundTripBudgetExceeded(self.report())
+
+    def add(self, call):
+        with self.lock:
+            self.calls.append(call)
+
+    @property
+    def round_trips(self):
+        with self.lock:
+            return sum(call.round_trips for call in self.calls)
+
+    @property
+    def over_budget(self):
+        return self.budget is not None and self.round_trips > self.budget
+
+    def tree(self):
+        """
+        :return: the calls by the stack of traced methods that made them, with each call's operation as a leaf
+        :rtype: ProfileNode
+        """
+        root = ProfileNode(self.name)
+        with self.lock:
+            for call in self.calls:
+                node = root
+                node.add(call)
+                for name in call.path + (call.operation,):
+                    node = node.child(name)
+                    node.add(call)
+        return root
+
+    def duplicates(self):
+        """
+        Calls made more than once with the same arguments, which a cache or a reuse of the first result could save
+
+        :return: the operation, the representation of its arguments and the calls made with them, most repeated
+                 first
+        :rtype: list
+        """
+        calls_by_arguments = OrderedDict()
+        with self.lock:
+            for call in self.calls:
+                calls_by_arguments.setdefault((call.operation, repr(call.arguments)), []).append(call)
+        duplicates = [(operation, arguments, calls) for (operation, arguments), calls in calls_by_arguments.items()
+                      if len(calls) > 1]
+        duplicates.sort(key=lambda duplicate: -len(duplicate[2]))
+        return duplicates
+
+    def folded(self):
+        """
+        :return: the round trips of each stack, one "outer;inner;Operation count" line each, the input of
+                 flamegraph.pl and speedscope
+        :rtype: str
+        """
+        lines = []
+
+        def fold(node, stack):
+            stack = stack + [node.name]
+            if not node.children:
+                lines.append('%s %d' % (';'.join(stack), node.round_trips))
+            for child in node.children.values():
+                fold(child, stack)
+        fold(self.tree(), [])
+        return '\n'.join(lines) + '\n'
+
+    def report(self, width=30):
+        """
+        :param width: Width of the bar of the root, which every other bar is scaled to
+        :type width: int
+        :return: the tree of calls with their round trips and time, followed by the repeated calls
+        :rtype: str
+        """
+        root = self.tree()
+        budget = ' of %d budgeted' % self.budget if self.budget is not None else ''
+        elapsed = ', %.1fms elapsed' % (self.elapsed * 1000) if self.elapsed is not None else ''
+        lines = ['%d round trips%s in %d calls, %.1fms in calls%s' % (root.round_trips, budget, root.calls,
+                                                                      root.seconds * 1000, elapsed)]
+
+        def show(node, depth):
+            bar = '#' * int(round(width * node.round_trips / float(root.round_trips))) if root.round_trips else ''
+            lines.append('%-*s %4d %9.1fms  %s%s' % (width, bar, node.round_trips, node.seconds * 1000,
+                                                     '  ' * depth, node.name))
+            for child in node.children.values():
+                show(child, depth + 1)
+        show(root, 0)
+
+        duplicates = self.duplicates()
+        if duplicates:
+            lines.append('Repeated calls:')
+            for operation, arguments, calls in duplicates:
+                if len(arguments) > 80:
+                    arguments = arguments[:77] + '...'
+                lines.append('  %dx %s%s from %s' % (len(calls), operation, arguments,
+                                                     ', '.join(sorted(set(call.caller or self.name
+                                                                          for call in calls)))))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsPlugin(MessagePlugin):
+    """
+    suds plugin counting the bytes of the envelopes a Cherwell_Soap sends and receives
+    """
+    def __init__(self, soap):
+        self.soap = soap
+
+    def sending(self, context):
+        self.soap.count_bytes(sent=len(context.envelope))
+
+    def received(self, context):
+        self.soap.count_bytes(received=len(context.reply))
+
+
+class CountingReader(object):
+    """
+    File-like wrapper counting the bytes read from a response
+    """
+    def __init__(self, response, count):
+        self.response = response
+        self.count = count
+
+    def read(self, size=-1):
+        data = self.response.read(size)
+        self.count(received=len(data))
+        return data
+
+
+# Calls of every Cherwell_Soap that has not been given a registry of its own
+soap_metrics = Metrics()
@@ -0,0 +1,377 @@
+"""
+Local SQLite mirror of chosen business object types, for reports that read the same records over and over.
+
+Each mirrored type is loaded once with a stored query returning all of its records, then kept up to date with a
+stored query returning only the recently modified ones, such as those whose LastModifiedDateTime is within the last
+day. The LastModifiedDateTime of every record is kept so that only records that changed are written again. Chosen
+fields of each type are indexed so that field matches are answered locally as well.
+
+Reads are answered by the mirror only while the last sync of their type is within the staleness bound. Stale types,
+records the mirror does not hold and fields it does not index are read from Cherwell, and writes always go to
+Cherwell, which drops the written record from the mirror and leaves matches on its type to Cherwell until the next
+sync.
+"""
+import json
+import sqlite3
+import threading
+import time
+
+from cherwell_business_object import BusinessObjectXmlWriter
+
+__author__ = 'jptingle'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    type TEXT NOT NULL,
+    recid TEXT NOT NULL,
+    pubid TEXT,
+    last_modified TEXT,
+    synced REAL NOT NULL,
+    fields TEXT NOT NULL,
+    PRIMARY KEY (type, recid)
+);
+CREATE INDEX IF NOT EXISTS objects_pubid ON objects (type, pubid);
+CREATE TABLE IF NOT EXISTS field_index (
+    type TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value TEXT,
+    recid TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS field_index_value ON field_index (type, name, value);
+CREATE INDEX IF NOT EXISTS field_index_recid ON field_index (type, recid);
+CREATE TABLE IF NOT EXISTS syncs (
+    type TEXT PRIMARY KEY,
+    full_sync REAL,
+    last_sync REAL,
+    indexed_fields TEXT
+);
+CREATE TABLE IF NOT EXISTS writes (
+    type TEXT PRIMARY KEY,
+    written REAL NOT NULL
+);
+"""
+
+
+class MirroredType(object):
+    """
+    How one business object type is mirrored
+    """
+    def __init__(self, business_object_type, full_query, changes_query=None, indexed_fields=(),
+                 public_id_field=None, changes_window=24 * 3600):
+        """
+        :param business_object_type: The type to mirror
+        :type business_object_type: str
+        :param full_query: Stored query returning every record of the type
+        :type full_query: str
+        :param changes_query: Stored query returning the records modified within the last *changes_window* seconds,
+                              None to run the full query on every sync
+        :type changes_query: str
+        :param indexed_fields: Fields to answer matches on
+        :type indexed_fields: list
+        :param public_id_field: The field holding the public id if it is NOT "<BOname>ID"
+        :type public_id_field: str
+        :param changes_window: Seconds of changes the changes query covers. A type last synced longer ago than this
+                               is synced with the full query.
+        :type changes_window: float
+        """
+        self.type = business_object_type
+        self.full_query = full_query
+        self.changes_query = changes_query
+        self.indexed_fields = sorted(set(indexed_fields))
+        self.public_id_field = public_id_field if public_id_field is not None else business_object_type + 'ID'
+        self.changes_window = changes_window
+
+
+class CherwellMirror(object):
+    """
+    SQLite mirror of business object types read through a Cherwell connection.
+
+    **Example**::
+
+        mirror = CherwellMirror(cherwell_server, 'cherwell.db', max_staleness=900)
+        mirror.add_type('Incident', 'All Incidents', 'Incidents Modified Today',
+                        indexed_fields=['OwnedByTeam', 'Status'])
+        mirror.sync()
+        cherwell_server.mirror = mirror
+    """
+    def __init__(self, cherwell_connection, path, max_staleness=900, page_size=500):
+        """
+        :param cherwell_connection: Connection to sync from
+        :type cherwell_connection: Cherwell
+        :param path: The SQLite database file, ':memory:' for one that is not kept
+        :type path: str
+        :param max_staleness: Seconds since the last sync of a type for which its records are read from the mirror,
+                              None to always read them from the mirror
+        :type max_staleness: float
+        :param page_size: Records read ahead while syncing
+        :type page_size: int
+        """
+        self.cherwell_connection = cherwell_connection
+        self.path = path
+        self.max_staleness = max_staleness
+        self.page_size = page_size
+        self.types = dict()
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(_SCHEMA)
+
+    def add_type(self, business_object_type, full_query, changes_query=None, indexed_fields=(), **options):
+        """
+        Mirror a business object type. Its records are read on its next sync.
+
+        :param business_object_type: The type to mirror
+        :type business_object_type: str
+        :param full_query: Stored query returning every record of the type
+        :type full_query: str
+        :param changes_query: Stored query returning the recently modified records of the type
+        :type changes_query: str
+        :param indexed_fields: Fields to answer matches on
+        :type indexed_fields: list
+        :param options: public_id_field and changes_window of the MirroredType
+        :return: None
+        """
+        mirrored = MirroredType(business_object_type, full_query, changes_query, indexed_fields, **options)
+        with self.lock:
+            self.types[business_object_type] = mirrored
+            row = self.db.execute("SELECT indexed_fields FROM syncs WHERE type = ?", (business_object_type,)).fetchone()
+            if row is not None and json.loads(row[0]) != mirrored.indexed_fields:
+                self.reindex(mirrored)
+
+    def reindex(self, mirrored):
+        with self.db:
+            self.db.execute("DELETE FROM field_index WHERE type = ?", (mirrored.type,))
+            for recid, fields in self.db.execute("SELECT recid, fields FROM objects WHERE type = ?",
+                                                 (mirrored.type,)).fetchall():
+                self.index_fields(mirrored, recid, json.loads(fields))
+            self.db.execute("UPDATE syncs SET indexed_fields = ? WHERE type = ?",
+                            (json.dumps(mirrored.indexed_fields), mirrored.type))
+
+    def index_fields(self, mirrored, recid, fields):
+        self.db.executemany("INSERT INTO field_index (type, name, value, recid) VALUES (?, ?, ?, ?)",
+                            [(mirrored.type, name, fields.get(name), recid) for name in mirrored.indexed_fields
+                             if name in fields])
+
+    def sync(self, business_object_type=None, full=False):
+        """
+        Bring mirrored types up to date. The changes query is used when the type was synced within its changes
+        window, and the full query otherwise, which also drops records that no longer exist.
+
+        :param business_object_type: The type to sync, None for every mirrored type
+        :type business_object_type: str
+        :param full: Whether to run the full query even when the changes query would do
+        :type full: bool
+        Pages of records are read from Cherwell without holding the mirror, which is only locked while each page is
+        written. A sync that fails keeps the pages it wrote, since they hold records as Cherwell has them, but does
+        not count as a sync of the type, so records that no longer exist are not dropped and reads stay as stale as
+        they were.
+
+        :return: Number of records written, None if a query failed
+        :rtype: int
+        :raises: errors reading the query results
+        """
+        if business_object_type is None:
+            written = 0
+            for mirrored_type in sorted(self.types):
+                type_written = self.sync(mirrored_type, full)
+                if type_written is None:
+                    return None
+                written += type_written
+            return written
+
+        mirrored = self.types[business_object_type]
+        started = time.time()
+        full_sync, last_sync = self.sync_times(business_object_type)
+        full = full or not mirrored.changes_query or last_sync is None or \
+            started - last_sync > mirrored.changes_window
+        query = mirrored.full_query if full else mirrored.changes_query
+
+        errors = []
+        pages = self.cherwell_connection.iter_result_pages('GetQueryResults', (query, False, 0, False, 0.0, True),
+                                                           self.page_size, errors)
+        written = 0
+        for rows in pages:
+            with self.lock:
+                try:
+                    for row in rows:
+                        written += self.store_row(mirrored, row, started)
+                    self.db.commit()
+                except:
+                    self.db.rollback()
+                    raise
+        if errors:
+            print "Syncing " + business_object_type + " failed: " + errors[0]
+            return None
+
+        with self.lock:
+            try:
+                if full:
+                    self.db.execute("DELETE FROM objects WHERE type = ? AND synced < ?",
+                                    (business_object_type, started))
+                    self.db.execute("DELETE FROM field_index WHERE type = ? AND recid NOT IN "
+                                    "(SELECT recid FROM objects WHERE type = ?)",
+                                    (business_object_type, business_object_type))
+                    full_sync = started
+                self.db.execute("DELETE FROM writes WHERE type = ? AND written < ?", (business_object_type, started))
+                self.db.execute("INSERT OR REPLACE INTO syncs (type, full_sync, last_sync, indexed_fields) "
+                                "VALUES (?, ?, ?, ?)",
+                                (business_object_type, full_sync, started, json.dumps(mirrored.indexed_fields)))
+                self.db.commit()
+            except:
+                self.db.rollback()
+                raise
+        return written
+
+    def store_row(self, mirrored, row, synced):
+        """
+        Write a record read by a sync, unless the mirror already has it at the same LastModifiedDateTime
+
+        :return: 1 if the record was written, else 0
+        :rtype: int
+        """
+        recid = row.pop('RecId', None) or row.get('RecID')
+        if not recid:
+            return 0
+        row['RecID'] = recid
+        last_modified = row.get('LastModifiedDateTime')
+        stored = self.db.execute("SELECT last_modified FROM objects WHERE type = ? AND recid = ?",
+                                 (mirrored.type, recid)).fetchone()
+        if stored is not None and last_modified is not None and stored[0] == last_modified:
+            self.db.execute("UPDATE objects SET synced = ? WHERE type = ? AND recid = ?",
+                            (synced, mirrored.type, recid))
+            return 0
+        self.db.execute("INSERT OR REPLACE INTO objects (type, recid, pubid, last_modified, synced, fields) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        (mirrored.type, recid, row.get(mirrored.public_id_field), last_modified, synced,
+                         json.dumps(row)))
+        self.db.execute("DELETE FROM field_index WHERE type = ? AND recid = ?", (mirrored.type, recid))
+        self.index_fields(mirrored, recid, row)
+        return 1
+
+    def sync_times(self, business_object_type):
+        """
+        :return: when the type was last fully synced and last synced at all, None for either if it never was
+        :rtype: tuple
+        """
+        with self.lock:
+            row = self.db.execute("SELECT full_sync, last_sync FROM syncs WHERE type = ?",
+                                  (business_object_type,)).fetchone()
+        return row if row is not None else (None, None)
+
+    def is_fresh(self, business_object_type):
+        """
+        Whether reads of a type are answered by the mirror
+
+        :param business_object_type: The type of business object
+        :type business_object_type: str
+        :rtype: bool
+        """
+        if business_object_type not in self.types:
+            return False
+        last_sync = self.sync_times(business_object_type)[1]
+        if last_sync is None:
+            return False
+        return self.max_staleness is None or time.time() - last_sync <= self.max_staleness
+
+    def written_since_sync(self, business_object_type):
+        """
+        Whether a record of a type was written since the type was last synced, so that the mirror no longer knows
+        which records match
+
+        :param business_object_type: The type of business object
+        :type business_object_type: str
+        :rtype: bool
+        """
+        with self.lock:
+            row = self.db.execute("SELECT written FROM writes WHERE type = ?", (business_object_type,)).fetchone()
+        if row is None:
+            return False
+        last_sync = self.sync_times(business_object_type)[1]
+        return last_sync is None or row[0] >= last_sync
+
+    def get_fields(self, business_object_type, object_id, is_pubid=False):
+        """
+        Get the fields of a mirrored record
+
+        :param business_object_type: The type of business object
+        :type business_object_type: str
+        :param object_id: The record id or public id of the object
+        :type object_id: str
+        :param is_pubid: Whether object_id is a public id
+        :type is_pubid: bool
+        :return: the fields of the record, None if the mirror cannot answer
+        :rtype: dict
+        """
+        if not self.is_fresh(business_object_type):
+            return None
+        column = 'pubid' if is_pubid else 'recid'
+        with self.lock:
+            row = self.db.execute("SELECT fields FROM objects WHERE type = ? AND " + column + " = ?",
+                                  (business_object_type, object_id)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def get_xml(self, business_object_type, object_id, is_pubid=False):
+        """
+        Get the XML of a mirrored record, as get_bus_obj_by_recid and get_bus_obj_by_publicid return it
+
+        :return: the XML of the record, None if the mirror cannot answer
+        :rtype: str
+        """
+        fields = self.get_fields(business_object_type, object_id, is_pubid)
+        if fields is None:
+            return None
+        return BusinessObjectXmlWriter.for_type(business_object_type).write(fields)
+
+    def match(self, business_object_type, fields, wantpubid=True):
+        """
+        Find the mirrored records whose fields equal the given values
+
+        :param business_object_type: The type of business object
+        :type business_object_type: str
+        :param fields: The field values to match
+        :type fields: dict
+        :param wantpubid: Whether to return public ids rather than record ids
+        :type wantpubid: bool
+        :return: the ids of the matching records, None if the mirror cannot answer because the type is stale, was
+                 written since its last sync or a field is not indexed
+        :rtype: list
+        """
+        if not fields or not self.is_fresh(business_object_type) or self.written_since_sync(business_object_type):
+            return None
+        indexed_fields = self.types[business_object_type].indexed_fields
+        if any(field not in indexed_fields for field in fields):
+            return None
+        sql = "SELECT " + ('pubid' if wantpubid else 'recid') + " FROM objects WHERE type = ?"
+        params = [business_object_type]
+        for field, value in sorted(fields.items()):
+            sql += " AND recid IN (SELECT recid FROM field_index WHERE type = ? AND name = ? AND value = ?)"
+            params.extend((business_object_type, field, value))
+        with self.lock:
+            return [object_id for object_id, in self.db.execute(sql, params)]
+
+    def invalidate(self, business_object_type, object_id, is_pubid=False):
+        """
+        Drop a record that was created or updated from the mirror, so that it is read from Cherwell until the next
+        sync. Matches on its type are left to Cherwell as well, since the record may now match other values.
+
+        :param business_object_type: The type of business object
+        :type business_object_type: str
+        :param object_id: The record id or public id of the object
+        :type object_id: str
+        :param is_pubid: Whether object_id is a public id
+        :type is_pubid: bool
+        :return: None
+        """
+        column = 'pubid' if is_pubid else 'recid'
+        with self.lock:
+            with self.db:
+                self.db.execute("INSERT OR REPLACE INTO writes (type, written) VALUES (?, ?)",
+                                (business_object_type, time.time()))
+                for recid, in self.db.execute("SELECT recid FROM objects WHERE type = ? AND " + column + " = ?",
+                                              (business_object_type, object_id)).fetchall():
+                    self.db.execute("DELETE FROM field_index WHERE type = ? AND recid = ?",
+                                    (business_object_type, recid))
+                    self.db.execute("DELETE FROM objects WHERE type = ? AND recid = ?", (business_object_type, recid))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
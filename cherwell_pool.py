@@ -0,0 +1,199 @@
+import inspect
+import Queue
+import threading
+from contextlib import contextmanager
+
+from cherwell import Cherwell, FieldSelectivity
+from cherwell_transport import KeepAliveTransport
+
+__author__ = 'jptingle'
+
+
+class CherwellPool(object):
+    """
+    A thread-safe pool of logged-in Cherwell sessions. Every session has its own suds client,
+    server-side login and keep-alive HTTP transport, so threads sharing the pool no longer wait on
+    each other's calls. The pool has the same methods as Cherwell and can be used in its place,
+    including as the connection of a BusinessObject. Each call checks out a session for its
+    duration; use session() to run several calls on the same session.
+    """
+    # CherwellMirror, DefinitionCache and AttachmentCache shared by every session
+    mirror = None
+    definitions = None
+    attachment_cache = None
+    # The field queries of one match, and the items of bulk runs, each run on their own session
+    get_bo_ids_matching_fields = Cherwell.get_bo_ids_matching_fields.im_func
+    bulk_create = Cherwell.bulk_create.im_func
+    bulk_update = Cherwell.bulk_update.im_func
+    # Fetches each object on its own session and builds objects connected to the pool
+    get_many = Cherwell.get_many.im_func
+    # Paged reads check out a session for as long as they read, and build objects connected to the pool
+    iter_query_results = Cherwell.iter_query_results.im_func
+    iter_item_list = Cherwell.iter_item_list.im_func
+    iter_result_pages = Cherwell.iter_result_pages.im_func
+    row_object = Cherwell.row_object.im_func
+
+    def __init__(self, username, password, apilink, size=4, checkout_timeout=None, **soap_options):
+        """
+        :param username: Cherwell user name
+        :type username: str
+        :param password: Cherwell password
+        :type password: str
+        :param apilink: Link to the Cherwell API
+        :type apilink: str
+        :param size: The most sessions to keep logged in
+        :type size: int
+        :param checkout_timeout: Seconds to wait for a free session, None to wait forever
+        :type checkout_timeout: float
+        :param soap_options: Options for each session's Cherwell_Soap
+        """
+        self.username = username
+        self.password = password
+        self.apilink = apilink
+        self.size = size
+        self.query_workers = size
+        self.field_selectivity = FieldSelectivity()
+        self.checkout_timeout = checkout_timeout
+        self.soap_options = soap_options
+        self.idle_sessions = Queue.LifoQueue()
+        self.session_count = 0
+        self.lock = threading.Lock()
+        self.endpoint_url = None
+
+    def new_session(self):
+        return Cherwell(self.username, self.password, self.apilink,
+                        transport=KeepAliveTransport(), **self.soap_options)
+
+    def checkout(self):
+        """
+        Take a session out of the pool, logging in a new one if none is idle and the pool is not full
+
+        :return: a logged-in session
+        :rtype: Cherwell
+        """
+        try:
+            return self.idle_sessions.get_nowait()
+        except Queue.Empty:
+            pass
+
+        with self.lock:
+            can_grow = self.session_count < self.size
+            if can_grow:
+                self.session_count += 1
+        if can_grow:
+            try:
+                return self.new_session()
+            except:
+                with self.lock:
+                    self.session_count -= 1
+                raise
+
+        try:
+            return self.idle_sessions.get(timeout=self.checkout_timeout)
+        except Queue.Empty:
+            raise RuntimeError("No Cherwell session became free within " + str(self.checkout_timeout) + " seconds")
+
+    def checkin(self, session):
+        """
+        Return a session to the pool. A session whose last call failed because it is not logged in
+        is logged in again, or dropped from the pool when that fails.
+
+        :param session: The session to return
+        :type session: Cherwell
+        :return: None
+        """
+        soap = session.cherwell
+        if soap.last_error and soap.is_login_error(soap.last_error) and not soap.login():
+            with self.lock:
+                self.session_count -= 1
+            return
+        self.idle_sessions.put(session)
+
+    def endpoint(self):
+        """
+        URL of the server the sessions are logged in to, looked up on a session the first time
+
+        :rtype: str
+        """
+        if self.endpoint_url is None:
+            with self.session() as session:
+                self.endpoint_url = session.endpoint()
+        return self.endpoint_url
+
+    def worker_count(self, max_workers=None):
+        """
+        Most calls to run at once, one on each session, by default as many as the pool has sessions
+
+        :rtype: int
+        """
+        return max_workers or self.query_workers
+
+    @contextmanager
+    def session(self):
+        """
+        Check out a session for the duration of a with block
+
+        **Example**::
+
+            with pool.session() as cherwell:
+                incident_xml = cherwell.get_bus_obj_by_publicid('Incident', '123456')
+        """
+        session = self.checkout()
+        session.mirror = self.mirror
+        session.definitions = self.definitions
+        session.attachment_cache = self.attachment_cache
+        try:
+            yield session
+        finally:
+            self.checkin(session)
+
+    def take_idle_sessions(self):
+        """
+        Take every idle session out of the pool
+
+        :return: the idle sessions
+        :rtype: list
+        """
+        sessions = []
+        try:
+            while True:
+                sessions.append(self.idle_sessions.get_nowait())
+        except Queue.Empty:
+            return sessions
+
+    def login(self):
+        """
+        Log in every idle session again
+
+        :return: None
+        """
+        for session in self.take_idle_sessions():
+            session.login()
+            self.idle_sessions.put(session)
+
+    def logout(self):
+        """
+        Log out every idle session and drop it from the pool
+
+        :return: None
+        """
+        for session in self.take_idle_sessions():
+            session.logout()
+            session.cherwell.client.options.transport.close()
+            with self.lock:
+                self.session_count -= 1
+
+
+def _pooled_method(name):
+    def pooled_method(self, *args, **kwargs):
+        with self.session() as session:
+            return getattr(session, name)(*args, **kwargs)
+
+    pooled_method.__name__ = name
+    pooled_method.__doc__ = getattr(Cherwell, name).__doc__
+    return pooled_method
+
+
+for _name, _method in inspect.getmembers(Cherwell, inspect.ismethod):
+    if not _name.startswith('_') and not hasattr(CherwellPool, _name):
+        setattr(CherwellPool, _name, _pooled_method(_name))
@@ -0,0 +1,498 @@
+"""
+Client-side queries over business object fields, combining equality tests with AND, OR and NOT.
+
+Cherwell can only query one field value at a time, or run a stored query. A QueryEngine plans each query from what
+it has learned about the result sizes of fields and stored queries, choosing whichever is expected to take the fewest
+round trips:
+
+* look up the most selective field value with QueryByFieldValue, then fetch the matches and filter them on the rest
+  of the query,
+* for ids only, intersect the lookups of every field value without fetching any object, or
+* run a stored query covering part of the query, which returns its objects in one call, and filter the rest.
+"""
+from abc import ABCMeta, abstractmethod
+
+from cherwell_cache import business_object_cache
+
+__author__ = 'jptingle'
+
+
+class Predicate(object):
+    """
+    A test on the fields of a business object. Predicates combine with ``&``, ``|`` and ``~``.
+    """
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def matches(self, business_object):
+        """
+        Whether the fields of a business object, or a dict of fields, pass the test
+
+        :rtype: bool
+        """
+
+    @abstractmethod
+    def key(self):
+        """
+        Value identifying the test, which equal predicates share
+        """
+
+    @abstractmethod
+    def field_names(self):
+        """
+        Names of the fields the test reads
+
+        :rtype: set
+        """
+
+    def conjuncts(self):
+        """
+        The predicates that must all pass for this one to pass
+        """
+        return [self]
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.key() == other.key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((type(self).__name__, self.key()))
+
+
+def field_values(business_object):
+    return getattr(business_object, 'fields', business_object)
+
+
+class Eq(Predicate):
+    """
+    A field equals a value
+    """
+    def __init__(self, field, value):
+        self.field = field
+        self.value = value
+
+    def matches(self, business_object):
+        return field_values(business_object).get(self.field) == self.value
+
+    def key(self):
+        return self.field, self.value
+
+    def field_names(self):
+        return set([self.field])
+
+    def __repr__(self):
+        return "%s = %r" % (self.field, self.value)
+
+
+class And(Predicate):
+    """
+    Every predicate passes
+    """
+    def __init__(self, *predicates):
+        self.predicates = []
+        for predicate in predicates:
+            self.predicates.extend(predicate.conjuncts())
+
+    def matches(self, business_object):
+        return all(predicate.matches(business_object) for predicate in self.predicates)
+
+    def key(self):
+        return frozenset(self.predicates)
+
+    def field_names(self):
+        return set().union(*[predicate.field_names() for predicate in self.predicates])
+
+    def conjuncts(self):
+        return list(self.predicates)
+
+    def __repr__(self):
+        return "(" + " AND ".join(repr(predicate) for predicate in self.predicates) + ")"
+
+
+class Or(Predicate):
+    """
+    At least one predicate passes
+    """
+    def __init__(self, *predicates):
+        self.predicates = []
+        for predicate in predicates:
+            self.predicates.extend(predicate.predicates if isinstance(predicate, Or) else [predicate])
+
+    def matches(self, business_object):
+        return any(predicate.matches(business_object) for predicate in self.predicates)
+
+    def key(self):
+        return frozenset(self.predicates)
+
+    def field_names(self):
+        return set().union(*[predicate.field_names() for predicate in self.predicates])
+
+    def __repr__(self):
+        return "(" + " OR ".join(repr(predicate) for predicate in self.predicates) + ")"
+
+
+class Not(Predicate):
+    """
+    The predicate fails
+    """
+    def __init__(self, predicate):
+        self.predicate = predicate
+
+    def matches(self, business_object):
+        return not self.predicate.matches(business_object)
+
+    def key(self):
+        return self.predicate
+
+    def field_names(self):
+        return self.predicate.field_names()
+
+    def __repr__(self):
+        return "NOT " + repr(self.predicate)
+
+
+def all_of(predicates):
+    if not predicates:
+        return None
+    return predicates[0] if len(predicates) == 1 else And(*predicates)
+
+
+class QueryPlan(object):
+    """
+    One way to run a query. Running it returns an ordered list of (record id, public id, business object) matches,
+    the business object being None when only ids were asked for.
+    """
+    __metaclass__ = ABCMeta
+
+    def __init__(self, engine, business_object_type):
+        self.engine = engine
+        self.type = business_object_type
+
+    @abstractmethod
+    def round_trips(self):
+        """
+        Expected number of calls to Cherwell, counting one per object fetched
+        """
+
+    def cost(self):
+        return self.round_trips()
+
+    @abstractmethod
+    def run(self, want_objects):
+        """
+        :return: the (record id, public id, business object) matches
+        :rtype: list
+        """
+
+    @abstractmethod
+    def describe(self):
+        """
+        :return: lines describing the steps of the plan
+        :rtype: list
+        """
+
+    def fetch(self, ids, residual, want_objects):
+        """
+        Fetch the objects of (record id, public id) pairs that need them, and keep those passing *residual*
+        """
+        if residual is None and not want_objects:
+            return [(recid, pubid, None) for recid, pubid in ids]
+        business_objects = self.engine.cherwell_connection.get_many(self.type, [recid for recid, pubid in ids],
+                                                                    wantpubid=False)
+        return [(recid, pubid, business_object if want_objects else None)
+                for (recid, pubid), business_object in zip(ids, business_objects)
+                if business_object is not None and (residual is None or residual.matches(business_object))]
+
+
+class FieldLookup(QueryPlan):
+    """
+    Query one field value, then filter the matches on the rest of the query
+    """
+    def __init__(self, engine, business_object_type, equality, residual, want_objects):
+        super(FieldLookup, self).__init__(engine, business_object_type)
+        self.equality = equality
+        self.residual = residual
+        self.fetches = residual is not None or want_objects
+
+    def round_trips(self):
+        return 1 + (self.engine.expected_size(self.type, self.equality.field) if self.fetches else 0)
+
+    def run(self, want_objects):
+        ids = self.engine.cherwell_connection.query_ids_by_field_value(self.type, self.equality.field,
+                                                                       self.equality.value)
+        self.engine.selectivity.record(self.type, self.equality.field, len(ids))
+        return self.fetch(ids, self.residual, want_objects)
+
+    def describe(self):
+        lines = ["QueryByFieldValue %r (~%g rows)" % (self.equality, self.engine.expected_size(self.type,
+                                                                                              self.equality.field))]
+        if self.fetches:
+            lines.append("fetch each object")
+        if self.residual is not None:
+            lines.append("filter %r" % (self.residual,))
+        return lines
+
+
+class FieldIntersection(QueryPlan):
+    """
+    Query every field value and keep the ids found by all of them
+    """
+    def __init__(self, engine, business_object_type, equalities):
+        super(FieldIntersection, self).__init__(engine, business_object_type)
+        self.equalities = equalities
+
+    def round_trips(self):
+        return len(self.equalities)
+
+    def run(self, want_objects):
+        matched = None
+        for equality in sorted(self.equalities, key=lambda eq: self.engine.expected_size(self.type, eq.field)):
+            ids = self.engine.cherwell_connection.query_ids_by_field_value(self.type, equality.field, equality.value)
+            self.engine.selectivity.record(self.type, equality.field, len(ids))
+            if matched is None:
+                matched = ids
+            else:
+                found = set(ids)
+                matched = [pair for pair in matched if pair in found]
+            if not matched:
+                break
+        return self.fetch(matched or [], None, want_objects)
+
+    def describe(self):
+        return ["QueryByFieldValue %r (~%g rows)" % (equality, self.engine.expected_size(self.type, equality.field))
+                for equality in self.equalities] + ["intersect the ids"]
+
+
+class StoredQueryScan(QueryPlan):
+    """
+    Run a stored query covering part of the query, and filter its objects on the rest. Rows lacking a field the rest
+    of the query reads are fetched whole before they are filtered.
+    """
+    def __init__(self, engine, business_object_type, query_name, residual, columns):
+        super(StoredQueryScan, self).__init__(engine, business_object_type)
+        self.query_name = query_name
+        self.residual = residual
+        self.residual_fields = residual.field_names() if residual is not None else set()
+        self.fetches = bool(self.residual_fields - set(columns)) if columns is not None \
+            else residual is not None
+
+    def expected_rows(self):
+        return self.engine.expected_size(self.type, '@' + self.query_name)
+
+    def round_trips(self):
+        return 1 + (self.expected_rows() if self.fetches else 0)
+
+    def cost(self):
+        return self.round_trips() + self.expected_rows() * self.engine.row_cost
+
+    def run(self, want_objects):
+        public_id_field = self.type + 'ID'
+        rows = []
+        partial = []
+        for business_object in self.engine.cherwell_connection.iter_query_results(self.type, self.query_name):
+            rows.append(business_object)
+            if not all(field in business_object.fields for field in self.residual_fields):
+                partial.append(business_object.fields.get('RecID'))
+        self.engine.selectivity.record(self.type, '@' + self.query_name, len(rows))
+
+        fetched = dict()
+        if partial:
+            # The rows are cached as they are, which would hand them straight back to get_many
+            endpoint = self.engine.cherwell_connection.endpoint()
+            for recid in partial:
+                business_object_cache.invalidate(endpoint, self.type, recid)
+            fetched = dict(zip(partial, self.engine.cherwell_connection.get_many(self.type, partial,
+                                                                                 wantpubid=False)))
+        matches = []
+        for business_object in rows:
+            recid = business_object.fields.get('RecID')
+            if recid in fetched:
+                business_object = fetched[recid]
+                if business_object is None:
+                    continue
+            if self.residual is None or self.residual.matches(business_object):
+                matches.append((recid, business_object.fields.get(public_id_field),
+                                business_object if want_objects else None))
+        return matches
+
+    def describe(self):
+        lines = ["GetQueryResults %r (~%g rows)" % (self.query_name, self.expected_rows())]
+        if self.fetches:
+            lines.append("fetch each object")
+        if self.residual is not None:
+            lines.append("filter %r" % (self.residual,))
+        return lines
+
+
+class UnionPlan(QueryPlan):
+    """
+    Run a plan for each alternative of an OR and merge their matches
+    """
+    def __init__(self, engine, business_object_type, plans):
+        super(UnionPlan, self).__init__(engine, business_object_type)
+        self.plans = plans
+
+    def round_trips(self):
+        return sum(plan.round_trips() for plan in self.plans)
+
+    def cost(self):
+        return sum(plan.cost() for plan in self.plans)
+
+    def run(self, want_objects):
+        matches = []
+        seen = set()
+        for plan in self.plans:
+            for match in plan.run(want_objects):
+                if match[0] not in seen:
+                    seen.add(match[0])
+                    matches.append(match)
+        return matches
+
+    def describe(self):
+        lines = []
+        for number, plan in enumerate(self.plans):
+            lines.append("alternative %d:" % (number + 1))
+            lines.extend("  " + line for line in plan.describe())
+        lines.append("merge the matches")
+        return lines
+
+
+class QueryEngine(object):
+    """
+    Plans and runs queries on a Cherwell connection, learning the result sizes of fields as it goes.
+
+    **Example**::
+
+        engine = QueryEngine(cherwell_server)
+        engine.add_stored_query('Incident', 'Open Incidents', ~Eq('Status', 'Closed'))
+        query = Eq('OwnedByTeam', 'Information Security') & (Eq('Priority', '1') | Eq('Priority', '2'))
+        print engine.explain('Incident', query)
+        incidents = engine.find('Incident', query)
+    """
+    # Result size assumed for fields and stored queries that have not run yet
+    unknown_size = 100
+    # Round trips a row read from a stored query is worth
+    row_cost = 0.01
+
+    def __init__(self, cherwell_connection):
+        """
+        :param cherwell_connection: The connection to query
+        :type cherwell_connection: Cherwell
+        """
+        self.cherwell_connection = cherwell_connection
+        self.selectivity = cherwell_connection.field_selectivity
+        self.stored_queries = dict()
+
+    def add_stored_query(self, business_object_type, query_name, predicate=None, columns=None):
+        """
+        Let queries use a stored query. Unless *columns* is given, the rows are assumed to lack the fields the rest of a
+        query reads, so running it is planned to fetch every object.
+
+        :param business_object_type: The type of business object the stored query returns
+        :type business_object_type: str
+        :param query_name: Name or id of the stored query
+        :type query_name: str
+        :param predicate: The test the stored query applies, None when it returns every object of the type
+        :type predicate: Predicate
+        :param columns: The fields the stored query returns for each row
+        :type columns: list
+        :return: None
+        """
+        self.stored_queries.setdefault(business_object_type, []).append((query_name, predicate, columns))
+
+    def expected_size(self, business_object_type, field):
+        size = self.selectivity.expected_size(business_object_type, field)
+        return self.unknown_size if size == float('inf') else size
+
+    def plan(self, business_object_type, predicate, want_objects=True):
+        """
+        Choose the cheapest way to run a query
+
+        :param business_object_type: The type of business object to find
+        :type business_object_type: str
+        :param predicate: The test objects must pass
+        :type predicate: Predicate
+        :param want_objects: Whether the objects are needed rather than only their ids
+        :type want_objects: bool
+        :rtype: QueryPlan
+        """
+        candidates = []
+        if isinstance(predicate, Or):
+            try:
+                candidates.append(UnionPlan(self, business_object_type,
+                                            [self.plan(business_object_type, alternative, want_objects)
+                                             for alternative in predicate.predicates]))
+            except ValueError:
+                pass
+
+        conjuncts = predicate.conjuncts()
+        equalities = [conjunct for conjunct in conjuncts if isinstance(conjunct, Eq)]
+        for equality in equalities:
+            residual = all_of([conjunct for conjunct in conjuncts if conjunct is not equality])
+            candidates.append(FieldLookup(self, business_object_type, equality, residual, want_objects))
+        if not want_objects and len(equalities) > 1 and len(equalities) == len(conjuncts):
+            candidates.append(FieldIntersection(self, business_object_type, equalities))
+
+        for query_name, query_predicate, columns in self.stored_queries.get(business_object_type, []):
+            covered = query_predicate.conjuncts() if query_predicate is not None else []
+            if all(conjunct in conjuncts for conjunct in covered):
+                residual = all_of([conjunct for conjunct in conjuncts if conjunct not in covered])
+                candidates.append(StoredQueryScan(self, business_object_type, query_name, residual, columns))
+
+        if not candidates:
+            raise ValueError("No field lookup or stored query can run %r on %s" % (predicate, business_object_type))
+        return min(candidates, key=lambda candidate: candidate.cost())
+
+    def explain(self, business_object_type, predicate, want_objects=True):
+        """
+        Describe how a query would run
+
+        :return: the steps of the plan and its expected round trips
+        :rtype: str
+        """
+        plan = self.plan(business_object_type, predicate, want_objects)
+        lines = ["%s where %r" % (business_object_type, predicate)]
+        lines.extend("  " + line for line in plan.describe())
+        lines.append("  round trips: ~%g" % plan.round_trips())
+        return "\n".join(lines)
+
+    def find(self, business_object_type, predicate):
+        """
+        Find the business objects passing a test
+
+        :param business_object_type: The type of business object to find
+        :type business_object_type: str
+        :param predicate: The test objects must pass
+        :type predicate: Predicate
+        :return: the matching objects
+        :rtype: list
+        """
+        return [business_object for recid, pubid, business_object in
+                self.plan(business_object_type, predicate).run(True)]
+
+    def find_ids(self, business_object_type, predicate, wantpubid=True):
+        """
+        Find the ids of the business objects passing a test
+
+        :param business_object_type: The type of business object to find
+        :type business_object_type: str
+        :param predicate: The test objects must pass
+        :type predicate: Predicate
+        :param wantpubid: Whether to return public ids rather than record ids
+        :type wantpubid: bool
+        :return: the ids of the matching objects
+        :rtype: list
+        """
+        return [pubid if wantpubid else recid for recid, pubid, business_object in
+                self.plan(business_object_type, predicate, want_objects=False).run(False)]
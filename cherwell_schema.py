@@ -0,0 +1,284 @@
+"""
+Business object definitions from GetBusinessObjectDefinition, cached in memory and on disk, used to check field
+names and values before they are sent to Cherwell.
+
+Each type's definition is fetched once and written to disk along with the version of this cache format and a hash
+of the definition, so later runs load it without a call. Definitions older than *max_age* are fetched again, as is a
+definition that does not know a field being written, in case the field was added on the server since.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+
+from cherwell_business_object import FieldSchema
+
+__author__ = 'jptingle'
+
+# Bumped whenever the layout of the definition files changes, so older files are fetched again
+DEFINITION_FORMAT = 2
+
+_TRUE_VALUES = ('true', '1', 'yes')
+
+# Fields Cherwell fills in itself on create, along with the public id field "<BOname>ID"
+_SERVER_FILLED_FIELDS = ('RecID', 'CreatedDateTime', 'CreatedBy', 'CreatedByID', 'LastModifiedDateTime',
+                         'LastModBy', 'LastModByID')
+
+# Flags of a field definition marking a field Cherwell fills in itself
+_SERVER_FILLED_FLAGS = ('System', 'ReadOnly', 'Calculated', 'AutoPopulate')
+
+
+class FieldDefinition(object):
+    """
+    The type and constraints of one field
+    """
+    __slots__ = ('name', 'type', 'size', 'required', 'server_filled')
+
+    def __init__(self, name, type=None, size=0, required=False, server_filled=False):
+        self.name = name
+        self.type = type
+        self.size = size
+        self.required = required
+        # Filled in by Cherwell, so a create need not give it even when it is required
+        self.server_filled = server_filled
+
+    def to_dict(self):
+        return {'name': self.name, 'type': self.type, 'size': self.size, 'required': self.required,
+                'server_filled': self.server_filled}
+
+    def check(self, value):
+        """
+        Find what is wrong with a value for the field
+
+        :param value: The value to check
+        :type value: str
+        :return: the problem, None if the value is fine
+        :rtype: str
+        """
+        if value is None or value == '':
+            return None
+        field_type = (self.type or '').lower()
+        if field_type == 'number':
+            try:
+                float(value)
+            except ValueError:
+                return "%s must be a number, not %r" % (self.name, value)
+        elif field_type == 'logical':
+            if value.lower() not in ('true', 'false'):
+                return "%s must be True or False, not %r" % (self.name, value)
+        elif self.size and len(value) > self.size:
+            return "%s is longer than %d characters" % (self.name, self.size)
+        return None
+
+
+class BusinessObjectDefinition(object):
+    """
+    The fields of one business object type
+    """
+    def __init__(self, business_object_type, fields, version=None, fetched=None):
+        """
+        :param business_object_type: The type defined
+        :type business_object_type: str
+        :param fields: The definitions of its fields, in the order of the definition
+        :type fields: list
+        :param version: Hash of the definition it was read from
+        :type version: str
+        :param fetched: When the definition was fetched
+        :type fetched: float
+        """
+        self.type = business_object_type
+        self.fields = OrderedDict((field.name, field) for field in fields)
+        self.version = version
+        self.fetched = fetched if fetched is not None else time.time()
+
+    @classmethod
+    def from_xml(cls, business_object_type, definition_xml):
+        """
+        Read a GetBusinessObjectDefinition result. Every Field element with a Name is a field; its Type, Size and
+        Required are read from attributes or child elements of the same name. The record id, public id, created and
+        modified fields and fields flagged System, ReadOnly, Calculated or AutoPopulate are filled in by the server.
+
+        :rtype: BusinessObjectDefinition
+        """
+        if isinstance(definition_xml, unicode):
+            definition_xml = definition_xml.encode('utf-8')
+        fields = []
+        for element in ET.fromstring(definition_xml).iter():
+            if element.tag not in ('Field', 'FieldDef') or not element.get('Name'):
+                continue
+
+            def read(name, default=None):
+                value = element.get(name)
+                if value is None:
+                    child = element.find(name)
+                    value = child.text if child is not None else None
+                return value if value is not None else default
+
+            name = element.get('Name')
+            size = read('Size') or read('MaxLength') or '0'
+            server_filled = name in _SERVER_FILLED_FIELDS or name == business_object_type + 'ID' or \
+                any(read(flag, '').lower() in _TRUE_VALUES for flag in _SERVER_FILLED_FLAGS)
+            fields.append(FieldDefinition(name, read('Type'), int(size) if size.isdigit() else 0,
+                                          read('Required', '').lower() in _TRUE_VALUES, server_filled))
+        return cls(business_object_type, fields, hashlib.sha1(definition_xml).hexdigest())
+
+    def to_dict(self):
+        return {'format': DEFINITION_FORMAT, 'type': self.type, 'version': self.version, 'fetched': self.fetched,
+                'fields': [field.to_dict() for field in self.fields.values()]}
+
+    @classmethod
+    def from_dict(cls, definition_dict):
+        return cls(definition_dict['type'],
+                   [FieldDefinition(str(field['name']), field['type'], field['size'], field['required'],
+                                    field['server_filled'])
+                    for field in definition_dict['fields']],
+                   definition_dict['version'], definition_dict['fetched'])
+
+    def check(self, field_dict, creating=False):
+        """
+        Find what is wrong with field values to be written to an object of the type
+
+        :param field_dict: The field values
+        :type field_dict: dict
+        :param creating: Whether the values create the object, so every required field the server does not fill
+                         in must have one
+        :type creating: bool
+        :return: the problems found
+        :rtype: list
+        """
+        problems = []
+        for name, value in field_dict.iteritems():
+            field = self.fields.get(name)
+            if field is None:
+                problems.append("%s has no field %s" % (self.type, name))
+            else:
+                problem = field.check(value)
+                if problem is not None:
+                    problems.append(problem)
+        if creating:
+            problems.extend("%s is required" % field.name for field in self.fields.values()
+                            if field.required and not field.server_filled and not field_dict.get(field.name))
+        return problems
+
+
+class DefinitionCache(object):
+    """
+    Business object definitions by type. Set it as the definitions of a Cherwell or CherwellPool to have creates and
+    updates checked before they are sent.
+
+    **Example**::
+
+        cherwell_server.definitions = DefinitionCache(os.path.expanduser('~/.cherwell/definitions/production'))
+    """
+    def __init__(self, directory=None, max_age=24 * 3600, recheck_age=300):
+        """
+        :param directory: Directory to keep definitions in across runs, one per Cherwell server, None to only keep
+                          them in memory
+        :type directory: str
+        :param max_age: Seconds after which a definition is fetched again
+        :type max_age: float
+        :param recheck_age: Seconds after which a definition missing a field being written is fetched again
+        :type recheck_age: float
+        """
+        self.directory = directory
+        self.max_age = max_age
+        self.recheck_age = recheck_age
+        self.definitions = dict()
+        self.lock = threading.Lock()
+
+    def path(self, business_object_type):
+        name = business_object_type.encode('utf-8') if isinstance(business_object_type, unicode) \
+            else business_object_type
+        return os.path.join(self.directory, hashlib.sha1(name).hexdigest() + '.json')
+
+    def load(self, business_object_type):
+        if self.directory is None:
+            return None
+        try:
+            with open(self.path(business_object_type)) as definition_file:
+                definition_dict = json.load(definition_file)
+        except (IOError, ValueError):
+            return None
+        if definition_dict.get('format') != DEFINITION_FORMAT or definition_dict.get('type') != business_object_type:
+            return None
+        return BusinessObjectDefinition.from_dict(definition_dict)
+
+    def save(self, definition):
+        if self.directory is None:
+            return
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            temp_fd, temp_path = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(temp_fd, 'w') as temp_file:
+                json.dump(definition.to_dict(), temp_file)
+            os.rename(temp_path, self.path(definition.type))
+        except (IOError, OSError) as e:
+            print e
+
+    def fetch(self, cherwell_connection, business_object_type):
+        definition_xml = cherwell_connection.get_business_object_definition(business_object_type)
+        if not definition_xml:
+            return None
+        try:
+            definition = BusinessObjectDefinition.from_xml(business_object_type, definition_xml)
+        except ET.ParseError as e:
+            print e.message
+            return None
+        self.save(definition)
+        return definition
+
+    def get(self, cherwell_connection, business_object_type, refresh=False):
+        """
+        Get the definition of a type, fetching it when it is not cached or has expired
+
+        :param cherwell_connection: The connection to fetch with
+        :type cherwell_connection: Cherwell
+        :param business_object_type: The type of business object
+        :type business_object_type: str
+        :param refresh: Whether to fetch the definition even when it is cached
+        :type refresh: bool
+        :return: the definition, None if it could not be fetched
+        :rtype: BusinessObjectDefinition
+        """
+        with self.lock:
+            definition = self.definitions.get(business_object_type)
+        if definition is None and not refresh:
+            definition = self.load(business_object_type)
+        if refresh or definition is None or time.time() - definition.fetched > self.max_age:
+            definition = self.fetch(cherwell_connection, business_object_type) or definition
+        if definition is not None:
+            with self.lock:
+                self.definitions[business_object_type] = definition
+            FieldSchema.for_type(business_object_type).extend(definition.fields.keys())
+        return definition
+
+    def check(self, cherwell_connection, business_object_type, field_dict, creating=False):
+        """
+        Find what is wrong with field values before they are written to an object. Nothing is found when the
+        definition of the type cannot be fetched.
+
+        :param cherwell_connection: The connection to fetch the definition with
+        :type cherwell_connection: Cherwell
+        :param business_object_type: The type of business object
+        :type business_object_type: str
+        :param field_dict: The field values
+        :type field_dict: dict
+        :param creating: Whether the values create the object
+        :type creating: bool
+        :return: the problems found
+        :rtype: list
+        """
+        definition = self.get(cherwell_connection, business_object_type)
+        if definition is None:
+            return []
+        problems = definition.check(field_dict, creating)
+        if any(name not in definition.fields for name in field_dict) and \
+                time.time() - definition.fetched > self.recheck_age:
+            definition = self.get(cherwell_connection, business_object_type, refresh=True)
+            problems = definition.check(field_dict, creating)
+        return problems
@@ -0,0 +1,590 @@
+import errno
+import gzip
+import hashlib
+import httplib
+import itertools
+import json
+import mimetools
+import re
+import select
+import socket
+import threading
+import time
+import urllib2
+import urlparse
+from collections import deque
+from StringIO import StringIO
+
+from suds.transport import Reply, TransportError
+from suds.transport.http import HttpTransport
+from suds.transport.https import HttpAuthenticated
+
+__author__ = 'jptingle'
+
+# Errors of a send on a connection the server has already closed, before it could have read the request
+_CLOSED_ERRNOS = (errno.EPIPE, errno.ECONNRESET, errno.ECONNABORTED)
+
+
+class KeepAliveConnection(object):
+    """
+    A persistent HTTP(S) connection to one server. The connection is opened on first use, kept open
+    between requests and reopened when the server closes it.
+
+    A request is only sent again when the kept-alive connection turns out to have been closed before the server
+    could have read it. Timeouts and failures once the request may have reached the server are raised, since a
+    create or update sent twice could be applied twice.
+    """
+    def __init__(self, scheme, netloc, timeout=90):
+        self.scheme = scheme
+        self.netloc = netloc
+        self.timeout = timeout
+        self.connection = None
+        self.sending = False
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.scheme == 'https':
+            return httplib.HTTPSConnection(self.netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(self.netloc, timeout=self.timeout)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def dropped(self):
+        """
+        Whether the server has closed the idle connection. An idle connection has nothing to read unless it was
+        closed.
+        """
+        sock = self.connection.sock
+        if sock is None:
+            return True
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (select.error, socket.error):
+            return True
+        return bool(readable)
+
+    def closed_before_response(self, error):
+        """
+        Whether a failed request never reached the server, because the connection had been closed before it was
+        sent. A response lost once the whole request was sent, such as an empty status line, does not count: the
+        server may have read and applied the request before closing the connection.
+        """
+        if isinstance(error, socket.timeout):
+            return False
+        if isinstance(error, socket.error):
+            return self.sending and error.errno in _CLOSED_ERRNOS
+        return False
+
+    def request(self, method, url, body=None, headers=None):
+        """
+        Send a request over the connection
+
+        :param method: HTTP method
+        :type method: str
+        :param url: URL of the request
+        :type url: str
+        :param body: Request body
+        :type body: str
+        :param headers: Request headers
+        :type headers: dict
+        :return: the response and its body
+        :rtype: tuple
+        """
+        response = self.open(method, url, body, headers)
+        try:
+            return response.response, response.read()
+        finally:
+            response.close()
+
+    def open(self, method, url, body=None, headers=None):
+        """
+        Send a request over the connection, leaving its response to be read. No other request is sent over the
+        connection until the response is closed.
+
+        :return: the unread response
+        :rtype: KeepAliveResponse
+        """
+        parsed_url = urlparse.urlsplit(url)
+        path = urlparse.urlunsplit(('', '', parsed_url.path or '/', parsed_url.query, ''))
+        self.lock.acquire()
+        try:
+            if self.connection is not None and self.dropped():
+                self.close()
+            reused = self.connection is not None
+            try:
+                response = self.send(method, path, body, headers)
+            except (httplib.HTTPException, socket.error) as e:
+                self.close()
+                # The server may still have closed a kept-alive connection just as the request was sent
+                if not reused or not self.closed_before_response(e):
+                    raise
+                response = self.send(method, path, body, headers)
+        except:
+            self.lock.release()
+            raise
+        return KeepAliveResponse(self, response)
+
+    def release(self, response):
+        # What is left of an unread response would be taken for the response to the next request
+        if response.will_close or not response.isclosed():
+            self.close()
+        self.lock.release()
+
+    def send(self, method, path, body, headers):
+        if self.connection is None:
+            self.connection = self.connect()
+        if hasattr(body, 'seek'):
+            # A streamed body is sent again from its start when the request is retried
+            body.seek(0)
+        # Left set when sending fails, for closed_before_response
+        self.sending = True
+        self.connection.request(method, path, body, headers or {})
+        self.sending = False
+        return self.connection.getresponse()
+
+
+class KeepAliveResponse(object):
+    """
+    Response to a request sent with KeepAliveConnection.open, read like a urllib2 response
+    """
+    def __init__(self, connection, response):
+        self.connection = connection
+        self.response = response
+        self.code = response.status
+
+    def read(self, size=None):
+        if size is not None and size < 0:
+            size = None
+        return self.response.read(size)
+
+    def info(self):
+        return self.response.msg
+
+    def close(self):
+        if self.connection is not None:
+            connection, self.connection = self.connection, None
+            connection.release(self.response)
+
+
+class CookieResponse(object):
+    """
+    Adapts an httplib response to what cookielib expects of a urllib2 response.
+    """
+    def __init__(self, response):
+        self.response = response
+
+    def info(self):
+        return self.response.msg
+
+
+class KeepAliveTransport(HttpTransport):
+    """
+    suds transport that reuses one HTTP keep-alive connection per server instead of opening a new
+    connection for every SOAP call. Cookies, and with them the Cherwell session, are kept the same
+    way as by the default suds transport. Proxies are not supported.
+    """
+    def __init__(self, **kwargs):
+        HttpTransport.__init__(self, **kwargs)
+        self.connections = dict()
+        self.connections_lock = threading.Lock()
+
+    def connection(self, url):
+        parsed_url = urlparse.urlsplit(url)
+        key = (parsed_url.scheme, parsed_url.netloc)
+        with self.connections_lock:
+            if key not in self.connections:
+                self.connections[key] = KeepAliveConnection(parsed_url.scheme, parsed_url.netloc,
+                                                            self.options.timeout)
+            return self.connections[key]
+
+    def close(self):
+        with self.connections_lock:
+            for connection in self.connections.values():
+                connection.close()
+            self.connections.clear()
+
+    def open(self, request):
+        if not request.url.startswith('http'):
+            return HttpTransport.open(self, request)
+        response, data = self.connection(request.url).request('GET', request.url)
+        if response.status >= 300:
+            raise TransportError(response.reason, response.status, StringIO(data))
+        return StringIO(data)
+
+    def send(self, request):
+        u2request = urllib2.Request(request.url, request.message, request.headers)
+        self.addcookies(u2request)
+        request.headers.update(u2request.headers)
+        response, data = self.connection(request.url).request('POST', request.url, request.message,
+                                                              dict(u2request.header_items()))
+        self.getcookies(CookieResponse(response), u2request)
+        if response.status in (202, 204):
+            return None
+        if response.status >= 300:
+            raise TransportError(response.reason, response.status, StringIO(data))
+        return Reply(200, dict(response.getheaders()), data)
+
+    def send_streaming(self, request):
+        """
+        Send a request and return its response unread, for replies too large to hold in memory. The response keeps
+        the connection until it is closed.
+
+        :return: the response, whatever its HTTP status
+        :rtype: KeepAliveResponse
+        """
+        u2request = urllib2.Request(request.url, request.message, request.headers)
+        self.addcookies(u2request)
+        response = self.connection(request.url).open('POST', request.url, request.message,
+                                                     dict(u2request.header_items()))
+        self.getcookies(response, u2request)
+        return response
+
+
+class StreamingTransport(HttpAuthenticated):
+    """
+    The default suds transport, able to return responses unread like KeepAliveTransport.send_streaming
+    """
+    def send_streaming(self, request):
+        """
+        Send a request and return its response unread, for replies too large to hold in memory
+
+        :return: the response, whatever its HTTP status
+        """
+        u2request = urllib2.Request(request.url, request.message, request.headers)
+        self.addcookies(u2request)
+        self.proxy = self.options.proxy
+        try:
+            response = self.u2open(u2request)
+        except urllib2.HTTPError as e:
+            response = e
+        self.getcookies(response, u2request)
+        return response
+
+
+def send_streaming(transport, request):
+    """
+    Send a request with the send_streaming of a transport, or with its send and the reply held in memory when it
+    has none
+
+    :param transport: suds transport
+    :type transport: Transport
+    :param request: the request
+    :type request: Request
+    :return: the unread response, with its HTTP status as code
+    """
+    if hasattr(transport, 'send_streaming'):
+        return transport.send_streaming(request)
+    try:
+        reply = transport.send(request)
+    except TransportError as e:
+        if e.fp is None:
+            raise
+        return BufferedResponse(request.url, e.httpcode, [], e.fp.read())
+    if reply is None:
+        return BufferedResponse(request.url, 204, [], '')
+    return BufferedResponse(request.url, reply.code, reply.headers.items(), reply.message)
+
+
+# Bumped whenever the layout of cassettes changes
+CASSETTE_FORMAT = 2
+
+SCRUBBED = 'scrubbed'
+
+# Login parameters, scrubbed from requests before they are fingerprinted
+_CREDENTIALS = re.compile(r'(<(?:\w+:)?(?:userId|password)>)[^<]*(</)')
+_COOKIE_VALUE = re.compile(r'^(\s*[^=;\s]+=)[^;]*')
+
+# Response headers kept in cassettes
+_KEPT_HEADERS = ('content-type', 'set-cookie')
+
+
+def scrub_request(body):
+    return _CREDENTIALS.sub(r'\1' + SCRUBBED + r'\2', body)
+
+
+def fingerprint(body):
+    """
+    :param body: A request body, or a stream of one
+    :return: hash of the body with its credentials scrubbed, which is what replays match requests by
+    :rtype: str
+    """
+    body_hash = hashlib.sha1()
+    if hasattr(body, 'read'):
+        # Streamed bodies are hashed a block at a time. Only Login has credentials, and it is never streamed.
+        body.seek(0)
+        for block in iter(lambda: body.read(65536), ''):
+            body_hash.update(block)
+        body.seek(0)
+    else:
+        body_hash.update(scrub_request(body or ''))
+    return body_hash.hexdigest()
+
+
+def _request_path(url):
+    parsed_url = urlparse.urlsplit(url)
+    return urlparse.urlunsplit(('', '', parsed_url.path or '/', parsed_url.query, ''))
+
+
+def _kept_headers(headers):
+    kept = []
+    for name, value in headers:
+        if name.lower() in _KEPT_HEADERS:
+            if name.lower() == 'set-cookie':
+                value = _COOKIE_VALUE.sub(r'\1' + SCRUBBED, value)
+            kept.append([name, value])
+    return kept
+
+
+def _encode_body(body):
+    try:
+        return {'body': body.decode('utf-8')}
+    except UnicodeDecodeError:
+        return {'body': body.encode('base64'), 'encoding': 'base64'}
+
+
+def _decode_body(interaction):
+    if interaction.get('encoding') == 'base64':
+        return interaction['body'].decode('base64')
+    return interaction['body'].encode('utf-8')
+
+
+class BufferedResponse(StringIO):
+    """
+    A response held in memory, read the way suds and cookielib read a urllib2 response
+    """
+    def __init__(self, url, status, headers, body):
+        StringIO.__init__(self, body)
+        self.url = url
+        self.code = status
+        self.msg = ''.join('%s: %s\r\n' % (name, value) for name, value in headers)
+        self.headers = mimetools.Message(StringIO(self.msg))
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+
+class RecordingResponse(object):
+    """
+    A streamed response passed on to the caller as it is read, each block being written to the cassette as a part
+    of the interaction. The interaction itself is written once the response is closed, with what the caller read.
+    """
+    def __init__(self, recorder, request, response, started):
+        self.recorder = recorder
+        self.request = request
+        self.response = response
+        self.started = started
+        self.code = response.code
+        self.part = next(recorder.parts)
+        self.closed = False
+
+    def read(self, size=-1):
+        data = self.response.read(size)
+        if data:
+            self.recorder.write(dict(_encode_body(data), part=self.part))
+        return data
+
+    def info(self):
+        return self.response.info()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            headers = self.response.info().items()
+        finally:
+            self.response.close()
+        self.recorder.record('streamed', self.request.url, self.request.headers.get('SOAPAction'),
+                             self.request.message, self.code, headers, None, time.time() - self.started,
+                             part=self.part)
+
+
+class RecordingTransport(HttpTransport):
+    """
+    suds transport passing every request on to another transport and recording each response, and how long it
+    took, in a cassette. Credentials are scrubbed from what is recorded: requests are only kept as a hash of their
+    body with the Login parameters blanked out, and session cookies lose their values.
+
+    Cassettes are gzipped JSON lines, written as the responses arrive. Streamed responses are written in parts as
+    they are read, ahead of the line of their interaction.
+
+    **Example**::
+
+        transport = RecordingTransport('create_incident.cassette', KeepAliveTransport())
+        cherwell_server = Cherwell(username, password, apilink, transport=transport)
+        ...
+        transport.close()
+    """
+    def __init__(self, path, transport=None, **kwargs):
+        """
+        :param path: Cassette file to write
+        :type path: str
+        :param transport: Transport making the requests, a StreamingTransport by default
+        :type transport: HttpTransport
+        """
+        HttpTransport.__init__(self, **kwargs)
+        self.transport = transport if transport is not None else StreamingTransport()
+        self.path = path
+        self.lock = threading.Lock()
+        self.parts = itertools.count()
+        self.cassette_file = gzip.open(path, 'wb')
+        self.write({'format': CASSETTE_FORMAT, 'recorded': time.time()})
+
+    def write(self, entry):
+        with self.lock:
+            self.cassette_file.write(json.dumps(entry) + '\n')
+            self.cassette_file.flush()
+
+    def record(self, kind, url, action, request_body, status, headers, body, elapsed, part=None):
+        interaction = {'kind': kind, 'path': _request_path(url), 'action': action,
+                       'request': fingerprint(request_body), 'status': status,
+                       'headers': _kept_headers(headers), 'elapsed': round(elapsed, 6)}
+        if part is not None:
+            interaction['part'] = part
+        else:
+            interaction.update(_encode_body(body))
+        self.write(interaction)
+
+    def close(self):
+        with self.lock:
+            self.cassette_file.close()
+        if hasattr(self.transport, 'close'):
+            self.transport.close()
+
+    def open(self, request):
+        if not request.url.startswith('http'):
+            return self.transport.open(request)
+        started = time.time()
+        data = self.transport.open(request).read()
+        self.record('open', request.url, None, None, 200, [], data, time.time() - started)
+        return StringIO(data)
+
+    def send(self, request):
+        started = time.time()
+        try:
+            reply = self.transport.send(request)
+        except TransportError as e:
+            data = e.fp.read() if e.fp is not None else ''
+            self.record('send', request.url, request.headers.get('SOAPAction'), request.message, e.httpcode, [],
+                        data, time.time() - started)
+            raise TransportError(e.message, e.httpcode, StringIO(data))
+        if reply is None:
+            self.record('send', request.url, request.headers.get('SOAPAction'), request.message, 204, [], '',
+                        time.time() - started)
+            return None
+        self.record('send', request.url, request.headers.get('SOAPAction'), request.message, reply.code,
+                    reply.headers.items(), reply.message, time.time() - started)
+        return reply
+
+    def send_streaming(self, request):
+        started = time.time()
+        return RecordingResponse(self, request, send_streaming(self.transport, request), started)
+
+
+class ReplayTransport(HttpTransport):
+    """
+    suds transport answering requests from a cassette written by RecordingTransport, without a server.
+
+    A request is answered with the next unplayed response recorded for a request with the same body, or failing
+    that, unless *strict*, for the same operation. Responses are delayed by their recorded time scaled by
+    *time_scale*, so a replay takes as long as the recording did with the default of 1 and as little as the client
+    allows with 0.
+
+    **Example**::
+
+        transport = ReplayTransport('create_incident.cassette', time_scale=0)
+        cherwell_server = Cherwell(username, password, apilink, use_bundled_wsdl=True, transport=transport)
+    """
+    def __init__(self, path, time_scale=1.0, strict=False, **kwargs):
+        """
+        :param path: Cassette file to read
+        :type path: str
+        :param time_scale: Factor of the recorded response times to delay responses by
+        :type time_scale: float
+        :param strict: Whether to only answer requests whose bodies match a recorded one
+        :type strict: bool
+        """
+        HttpTransport.__init__(self, **kwargs)
+        self.time_scale = time_scale
+        self.strict = strict
+        self.interactions = []
+        self.played = set()
+        self.by_request = dict()
+        self.by_action = dict()
+        self.lock = threading.Lock()
+        with gzip.open(path, 'rb') as cassette_file:
+            header = json.loads(cassette_file.readline())
+            if header.get('format') != CASSETTE_FORMAT:
+                raise ValueError("%s is not a cassette of format %d" % (path, CASSETTE_FORMAT))
+            parts = dict()
+            for line in cassette_file:
+                entry = json.loads(line)
+                if 'kind' not in entry:
+                    parts.setdefault(entry['part'], []).append(_decode_body(entry))
+                    continue
+                if 'part' in entry:
+                    entry['data'] = ''.join(parts.pop(entry['part'], []))
+                self.add(entry)
+
+    def add(self, interaction):
+        index = len(self.interactions)
+        self.interactions.append(interaction)
+        action_key = (interaction['kind'], interaction['path'], interaction['action'])
+        self.by_request.setdefault(action_key + (interaction['request'],), deque()).append(index)
+        self.by_action.setdefault(action_key, deque()).append(index)
+
+    @property
+    def unplayed(self):
+        """
+        :return: the recorded interactions no request was answered with
+        :rtype: list
+        """
+        with self.lock:
+            return [interaction for index, interaction in enumerate(self.interactions) if index not in self.played]
+
+    def next_interaction(self, kind, url, action, body):
+        action_key = (kind, _request_path(url), action)
+        queues = [self.by_request.get(action_key + (fingerprint(body),))]
+        if not self.strict:
+            queues.append(self.by_action.get(action_key))
+        with self.lock:
+            for queue in queues:
+                while queue:
+                    index = queue.popleft()
+                    if index not in self.played:
+                        self.played.add(index)
+                        return self.interactions[index]
+        raise TransportError("No recorded response for %s %s" % (action or kind, action_key[1]), 404)
+
+    def play(self, kind, url, action, body):
+        interaction = self.next_interaction(kind, url, action, body)
+        delay = interaction['elapsed'] * self.time_scale
+        if delay > 0:
+            time.sleep(delay)
+        data = interaction['data'] if 'data' in interaction else _decode_body(interaction)
+        return interaction['status'], [tuple(header) for header in interaction['headers']], data
+
+    def open(self, request):
+        if not request.url.startswith('http'):
+            return HttpTransport.open(self, request)
+        status, headers, data = self.play('open', request.url, None, None)
+        return StringIO(data)
+
+    def send(self, request):
+        status, headers, data = self.play('send', request.url, request.headers.get('SOAPAction'), request.message)
+        if status in (202, 204):
+            return None
+        if status >= 300:
+            raise TransportError('Recorded error', status, StringIO(data))
+        return Reply(status, dict(headers), data)
+
+    def send_streaming(self, request):
+        status, headers, data = self.play('streamed', request.url, request.headers.get('SOAPAction'),
+                                          request.message)
+        return BufferedResponse(request.url, status, headers, data)
@@ -0,0 +1,370 @@
+import base64
+import os
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+
+__author__ = 'jptingle'
+
+BUNDLED_WSDL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'api.wsdl')
+
+WSDL_NAMESPACE = 'http://schemas.xmlsoap.org/wsdl/'
+WSDL_SOAP_NAMESPACE = 'http://schemas.xmlsoap.org/wsdl/soap/'
+SCHEMA_NAMESPACE = 'http://www.w3.org/2001/XMLSchema'
+SOAP_ENV_NAMESPACE = 'http://schemas.xmlsoap.org/soap/envelope/'
+
+ENVELOPE_START = '<?xml version="1.0" encoding="utf-8"?>' \
+                 '<soap:Envelope xmlns:soap="' + SOAP_ENV_NAMESPACE + '"><soap:Body>'
+ENVELOPE_END = '</soap:Body></soap:Envelope>'
+
+
+class SoapFault(Exception):
+    """
+    A SOAP fault returned by the server
+    """
+    def __init__(self, faultcode, faultstring):
+        super(SoapFault, self).__init__(faultstring)
+        self.faultcode = faultcode
+        self.faultstring = faultstring
+
+
+class Base64File(object):
+    """
+    A parameter value holding the base64 text of a file. The file is read and encoded a chunk at a time while the
+    envelope is sent, so it is never held in memory as a whole.
+    """
+    def __init__(self, path, chunk_size=3 * 65536):
+        """
+        :param path: Path of the file
+        :type path: str
+        :param chunk_size: Bytes of the file to read at a time, rounded down to a multiple of 3 so the encoded
+                           chunks join up into one base64 text
+        :type chunk_size: int
+        """
+        self.path = path
+        self.chunk_size = max(3, chunk_size - chunk_size % 3)
+
+    def __len__(self):
+        return (os.path.getsize(self.path) + 2) // 3 * 4
+
+    def __iter__(self):
+        with open(self.path, 'rb') as attachment_file:
+            while True:
+                chunk = attachment_file.read(self.chunk_size)
+                if not chunk:
+                    return
+                yield base64.b64encode(chunk)
+
+
+class EnvelopeStream(object):
+    """
+    File-like request body over the parts of an envelope, some of which may be streamed values such as
+    Base64File. httplib sends file-like bodies a block at a time, so the envelope is never held in memory as a whole.
+    """
+    def __init__(self, parts):
+        self.parts = parts
+        self.length = sum(len(part) for part in parts)
+        self.seek(0)
+
+    def __len__(self):
+        return self.length
+
+    def seek(self, offset, whence=0):
+        if offset != 0 or whence != 0:
+            raise IOError("An envelope stream can only be rewound to its start")
+        self.chunks = self.iter_chunks()
+        self.buffer = ''
+        self.position = 0
+
+    def iter_chunks(self):
+        for part in self.parts:
+            if isinstance(part, basestring):
+                yield part
+            else:
+                for chunk in part:
+                    yield chunk
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) - self.position < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer = self.buffer[self.position:] + chunk
+            self.position = 0
+        end = len(self.buffer) if size < 0 else self.position + size
+        data = self.buffer[self.position:end]
+        self.position += len(data)
+        return data
+
+
+class Base64Writer(object):
+    """
+    Decodes base64 text written to it a piece at a time into a file
+    """
+    def __init__(self, out_file):
+        self.out_file = out_file
+        self.pending = ''
+        self.size = 0
+
+    def write(self, text):
+        text = self.pending + ''.join(str(text).split())
+        usable = len(text) - len(text) % 4
+        self.pending = text[usable:]
+        if usable:
+            data = base64.b64decode(text[:usable])
+            self.out_file.write(data)
+            self.size += len(data)
+
+    def close(self):
+        if self.pending:
+            raise ValueError("Base64 text ended part way through a block")
+
+
+class StreamedResult(object):
+    """
+    XMLParser target that hands the text of an operation's result to *write* as the response is read, instead of
+    keeping it. Faults are raised when the parser is closed.
+    """
+    def __init__(self, result_tag, write):
+        self.result_tag = result_tag
+        self.write = write
+        self.in_result = False
+        self.received = False
+        self.fault = None
+        self.fault_field = None
+
+    def start(self, tag, attrib):
+        if tag == self.result_tag:
+            self.in_result = True
+            self.received = True
+        elif tag == '{%s}Fault' % SOAP_ENV_NAMESPACE:
+            self.fault = {'faultcode': '', 'faultstring': ''}
+        elif self.fault is not None and tag in self.fault:
+            self.fault_field = tag
+
+    def data(self, data):
+        if self.in_result:
+            self.write(data)
+        elif self.fault_field is not None:
+            self.fault[self.fault_field] += data
+
+    def end(self, tag):
+        if tag == self.result_tag:
+            self.in_result = False
+        self.fault_field = None
+
+    def close(self):
+        if self.fault is not None:
+            raise SoapFault(self.fault['faultcode'], self.fault['faultstring'])
+        return self.received
+
+
+def to_xml_text(value):
+    """
+    Convert a python value to the text of a SOAP parameter
+
+    :param value: The value to convert
+    :return: the escaped text
+    :rtype: str
+    """
+    if value is True or value is False:
+        return 'true' if value else 'false'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return escape(str(value))
+
+
+def from_xml_text(text, xsd_type):
+    """
+    Convert the text of a SOAP value to python according to its schema type
+
+    :param text: The element text, None if the element was empty or missing
+    :type text: str
+    :param xsd_type: The schema type such as s:boolean
+    :type xsd_type: str
+    :return: the converted value
+    """
+    if text is None or text == '':
+        return None
+    xsd_type = xsd_type.split(':')[-1]
+    if xsd_type == 'boolean':
+        return text.strip() == 'true'
+    if xsd_type == 'int':
+        return int(text)
+    if xsd_type == 'double':
+        return float(text)
+    return text
+
+
+class WsdlOperation(object):
+    """
+    A document/literal operation of the Cherwell API, as described by the WSDL
+    """
+    def __init__(self, name, soap_action, params, result_name, result_type):
+        self.name = name
+        self.soap_action = soap_action
+        self.params = params
+        self.result_name = result_name
+        self.result_type = result_type
+
+
+class ServiceDescription(object):
+    """
+    The operations, namespace and endpoint of the Cherwell API read directly from its WSDL. It builds and
+    parses the SOAP envelopes of both sides of a call without going through suds.
+    """
+    def __init__(self, wsdl_path=BUNDLED_WSDL):
+        root = ET.parse(wsdl_path).getroot()
+        self.namespace = root.get('targetNamespace')
+        self.operations = dict()
+        self.location = None
+
+        elements = dict()
+        for schema in root.iter('{%s}schema' % SCHEMA_NAMESPACE):
+            for element in schema.findall('{%s}element' % SCHEMA_NAMESPACE):
+                children = [(child.get('name'), child.get('type'))
+                            for child in element.iter('{%s}element' % SCHEMA_NAMESPACE)
+                            if child is not element]
+                elements[element.get('name')] = children
+
+        for binding in root.findall('{%s}binding' % WSDL_NAMESPACE):
+            if binding.find('{%s}binding' % WSDL_SOAP_NAMESPACE) is None:
+                continue
+            for operation in binding.findall('{%s}operation' % WSDL_NAMESPACE):
+                name = operation.get('name')
+                soap_action = operation.find('{%s}operation' % WSDL_SOAP_NAMESPACE).get('soapAction')
+                result = elements.get(name + 'Response') or [(None, None)]
+                self.operations[name] = WsdlOperation(name, soap_action, elements.get(name, []),
+                                                      result[0][0], result[0][1])
+
+        for address in root.iter('{%s}address' % WSDL_SOAP_NAMESPACE):
+            self.location = address.get('location')
+            break
+
+    def qualified(self, name):
+        return '{%s}%s' % (self.namespace, name)
+
+    def envelope_parts(self, operation_name, *args):
+        """
+        Build the request envelope of an operation as a list of strings to be joined or streamed
+
+        :param operation_name: Name of the operation
+        :type operation_name: str
+        :param args: Values of the operation parameters, in WSDL order
+        :return: parts of the envelope
+        :rtype: list
+        """
+        operation = self.operations[operation_name]
+        if len(args) > len(operation.params):
+            raise TypeError(operation_name + " takes at most " + str(len(operation.params)) + " arguments")
+        parts = [ENVELOPE_START, '<', operation_name, ' xmlns="', self.namespace, '">']
+        for (param_name, param_type), value in zip(operation.params, args):
+            if isinstance(value, Base64File):
+                # Base64 text needs no escaping, the file is encoded as the envelope is sent
+                parts.extend(('<', param_name, '>', value, '</', param_name, '>'))
+            elif value is not None:
+                parts.extend(('<', param_name, '>', to_xml_text(value), '</', param_name, '>'))
+        parts.extend(('</', operation_name, '>', ENVELOPE_END))
+        return parts
+
+    def build_request(self, operation_name, *args):
+        body = self.request_body(operation_name, *args)
+        return body if isinstance(body, basestring) else body.read()
+
+    def request_body(self, operation_name, *args):
+        """
+        Build the request envelope of an operation, as a stream when any of its values are streamed
+
+        :param operation_name: Name of the operation
+        :type operation_name: str
+        :param args: Values of the operation parameters, in WSDL order
+        :return: the envelope
+        :rtype: str or EnvelopeStream
+        """
+        parts = self.envelope_parts(operation_name, *args)
+        if all(isinstance(part, basestring) for part in parts):
+            return ''.join(parts)
+        return EnvelopeStream(parts)
+
+    def parse_response(self, operation_name, response_xml):
+        """
+        Get the result out of a response envelope
+
+        :param operation_name: Name of the operation that was called
+        :type operation_name: str
+        :param response_xml: The response envelope
+        :type response_xml: str
+        :return: the result of the operation
+        :raises SoapFault: when the response is a SOAP fault
+        """
+        operation = self.operations[operation_name]
+        body = ET.fromstring(response_xml).find('{%s}Body' % SOAP_ENV_NAMESPACE)
+        fault = body.find('{%s}Fault' % SOAP_ENV_NAMESPACE)
+        if fault is not None:
+            raise SoapFault(fault.findtext('faultcode'), fault.findtext('faultstring'))
+        if operation.result_name is None:
+            return None
+        result = body.find(self.qualified(operation_name + 'Response') + '/' + self.qualified(operation.result_name))
+        return from_xml_text(result.text if result is not None else None, operation.result_type)
+
+    def read_streamed_response(self, operation_name, response, write, block_size=65536):
+        """
+        Read a response envelope a block at a time, handing the text of the result to *write* as it is parsed
+
+        :param operation_name: Name of the operation that was called
+        :type operation_name: str
+        :param response: File-like response body
+        :param write: Function taking each piece of the result text
+        :type write: function
+        :param block_size: Bytes of the response to read at a time
+        :type block_size: int
+        :return: Whether the response had a result
+        :rtype: bool
+        :raises SoapFault: when the response is a SOAP fault
+        """
+        operation = self.operations[operation_name]
+        parser = ET.XMLParser(target=StreamedResult(self.qualified(operation.result_name), write))
+        while True:
+            block = response.read(block_size)
+            if not block:
+                break
+            parser.feed(block)
+        return parser.close()
+
+    def parse_request(self, request_xml):
+        """
+        Get the operation and parameter values out of a request envelope
+
+        :param request_xml: The request envelope
+        :type request_xml: str
+        :return: the operation name and a dict of its parameters
+        :rtype: tuple
+        """
+        body = ET.fromstring(request_xml).find('{%s}Body' % SOAP_ENV_NAMESPACE)
+        call = body[0]
+        operation = self.operations[call.tag.split('}')[-1]]
+        params = dict()
+        for param_name, param_type in operation.params:
+            param = call.find(self.qualified(param_name))
+            params[param_name] = from_xml_text(param.text if param is not None else None, param_type)
+        return operation.name, params
+
+    def build_response(self, operation_name, result):
+        """
+        Build the response envelope of an operation
+
+        :param operation_name: Name of the operation
+        :type operation_name: str
+        :param result: The result to return
+        :return: the response envelope
+        :rtype: str
+        """
+        operation = self.operations[operation_name]
+        parts = [ENVELOPE_START, '<', operation_name, 'Response xmlns="', self.namespace, '">']
+        if operation.result_name is not None and result is not None:
+            parts.extend(('<', operation.result_name, '>', to_xml_text(result), '</', operation.result_name, '>'))
+        parts.extend(('</', operation_name, 'Response>', ENVELOPE_END))
+        return ''.join(parts)
+
+    def build_fault(self, faultstring, faultcode='soap:Server'):
+        return ''.join((ENVELOPE_START, '<soap:Fault><faultcode>', faultcode, '</faultcode><faultstring>',
+                        to_xml_text(faultstring), '</faultstring></soap:Fault>', ENVELOPE_END))
@@ -0,0 +1,147 @@
+import os
+import tempfile
+import threading
+from unittest import TestCase
+
+from cherwell_async import AsyncCherwellSoap, SoapFuture
+from cherwell_fake_server import FakeCherwellServer
+from cherwell_wsdl import SoapFault
+
+__author__ = 'jptingle'
+
+test_object_xml = ('<BusinessObject Name="Incident"><FieldList><Field Name="Summary">Unit Test</Field>'
+                   '<Field Name="Status">New</Field></FieldList></BusinessObject>')
+test_object_updatexml = ('<BusinessObject Name="Incident"><FieldList><Field Name="Status">Assigned &amp; Open</Field>'
+                         '</FieldList></BusinessObject>')
+
+
+class TestAsyncCherwellSoap(TestCase):
+
+    def setUp(self):
+        self.server = FakeCherwellServer('user', 'secret').start()
+        self.client = AsyncCherwellSoap('user', 'secret', self.server.url, max_concurrency=3)
+        self.assertTrue(self.client.login().result(5))
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_login_with_bad_password(self):
+        client = AsyncCherwellSoap('user', 'wrong', self.server.url)
+        try:
+            self.assertFalse(client.login().result(5))
+            self.assertEqual(client.get_last_error().result(5), 'Invalid user name or password')
+        finally:
+            client.close()
+
+    def test_create_and_get_business_object(self):
+        recid = self.client.create_business_object('Incident', test_object_xml).result(5)
+        by_recid = self.client.get_business_object('Incident', recid).result(5)
+        pubid = self.server.objects[recid][1]['IncidentID']
+        by_pubid = self.client.get_business_object_by_public_id('Incident', pubid).result(5)
+
+        self.assertIn('<Field Name="Summary">Unit Test</Field>', by_recid)
+        self.assertEqual(by_recid, by_pubid)
+
+    def test_update_business_object(self):
+        recid = self.server.add_object('Incident', {'Status': 'New'})
+        pubid = self.server.objects[recid][1]['IncidentID']
+
+        self.assertTrue(self.client.update_business_object('Incident', recid, test_object_updatexml).result(5))
+        self.assertEqual(self.server.objects[recid][1]['Status'], 'Assigned & Open')
+        self.assertTrue(self.client.update_business_object_by_pubid('Incident', pubid, test_object_updatexml).result(5))
+        self.assertFalse(self.client.update_business_object('Incident', 'missing', test_object_updatexml).result(5))
+
+    def test_queries(self):
+        recid = self.server.add_object('Incident', {'OwnedByTeam': 'Information Security'})
+        self.server.add_object('Incident', {'OwnedByTeam': 'Service Desk'})
+        self.server.add_stored_query('Security Incidents', 'Incident', {'OwnedByTeam': 'Information Security'})
+
+        by_field = self.client.query_by_field_value('Incident', 'OwnedByTeam', 'Information Security').result(5)
+        stored = self.client.query_by_stored_query('Incident', 'Security Incidents').result(5)
+
+        self.assertIn('RecId="' + recid + '"', by_field)
+        self.assertEqual(by_field, stored)
+
+    def test_add_attachment_to_record(self):
+        recid = self.server.add_object('Incident', {})
+        self.assertTrue(self.client.add_attachment_to_record('Incident', recid, 'test.txt', 'blah\x00blah').result(5))
+        self.assertEqual(self.server.attachments[recid], [('test.txt', 'blah\x00blah')])
+
+    def test_add_attachment_from_file(self):
+        recid = self.server.add_object('Incident', {})
+        data = os.urandom(500000)
+        attachment_file, path = tempfile.mkstemp()
+        try:
+            os.write(attachment_file, data)
+            os.close(attachment_file)
+            self.assertTrue(self.client.add_attachment_from_file('Incident', recid, 'test.bin', path).result(5))
+        finally:
+            os.remove(path)
+        self.assertEqual(self.server.attachments[recid], [('test.bin', data)])
+
+    def test_relogin_after_session_expiry(self):
+        recid = self.server.add_object('Incident', {})
+        self.server.expire_sessions()
+
+        self.assertIsNotNone(self.client.get_business_object('Incident', recid).result(5))
+        self.assertEqual(self.server.call_count('Login'), 2)
+        self.assertEqual(self.server.call_count('GetLastError'), 1)
+
+    def test_concurrent_calls_relogin_once_after_session_expiry(self):
+        recid = self.server.add_object('Incident', {})
+        self.server.latency = 0.02
+        self.server.expire_sessions()
+
+        futures = [self.client.get_business_object('Incident', recid) for x in range(12)]
+        results = [future.result(10) for future in futures]
+
+        self.assertNotIn(None, results)
+        self.assertEqual(self.server.call_count('Login'), 2)
+
+    def test_concurrent_faults_do_not_relogin(self):
+        recid = self.server.add_object('Incident', {})
+        self.server.latency = 0.01
+        self.server.fault_rate = 0.2
+        self.server.error_rate = 0.2
+
+        futures = [self.client.get_business_object('Incident', recid) for x in range(30)]
+        for future in futures:
+            future.exception(10)
+
+        self.assertEqual(self.server.call_count('Login'), 1)
+        self.assertTrue(any(future.exception() is None and future.result() for future in futures))
+
+    def test_successful_call_is_one_round_trip(self):
+        recid = self.server.add_object('Incident', {})
+        calls_before = self.server.call_count()
+        self.client.get_business_object('Incident', recid).result(5)
+        self.assertEqual(self.server.call_count() - calls_before, 1)
+
+    def test_fault_is_raised(self):
+        future = self.client.call('GetServiceInfo')
+        self.assertRaises(SoapFault, future.result, 5)
+        self.assertIsInstance(future.exception(), SoapFault)
+
+    def test_bounded_concurrency_over_keep_alive_connections(self):
+        recid = self.server.add_object('Incident', {})
+        futures = [self.client.get_business_object('Incident', recid) for x in range(30)]
+        results = [future.result(5) for future in futures]
+
+        self.assertEqual(len(set(results)), 1)
+        self.assertLessEqual(self.server.max_in_flight, 3)
+        self.assertLessEqual(self.server.connections, 3)
+
+    def test_done_callback(self):
+        called = threading.Event()
+        future = self.client.get_last_error()
+        future.add_done_callback(lambda done: called.set())
+        future.result(5)
+        self.assertTrue(called.wait(5))
+
+        late_calls = []
+        future.add_done_callback(late_calls.append)
+        self.assertEqual(late_calls, [future])
+
+    def test_future_timeout(self):
+        self.assertRaises(RuntimeError, SoapFuture().result, 0.01)
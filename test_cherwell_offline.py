@@ -0,0 +1,1387 @@
+import errno
+import gzip
+import httplib
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from cherwell import Cherwell
+from cherwell_business_object import BusinessObject, BusinessObjectFactory, FieldSchema, Incident
+from cherwell_cache import AttachmentCache, BusinessObjectCache, TTLCache, business_object_cache, field_id_cache, \
+    missing_field_cache, public_id_cache
+from cherwell_fake_server import FakeCherwellServer
+from cherwell_metrics import Metrics, RoundTripBudgetExceeded, RoundTripProfiler
+from cherwell_mirror import CherwellMirror
+from cherwell_query import Eq, QueryEngine
+from cherwell_schema import DefinitionCache
+from cherwell_pool import CherwellPool
+from cherwell_transport import KeepAliveConnection, KeepAliveTransport, RecordingTransport, ReplayTransport
+from cherwell_wsdl import Base64File, EnvelopeStream, ServiceDescription, SoapFault
+
+__author__ = 'jptingle'
+
+
+class FakeServerTestCase(TestCase):
+
+    def setUp(self):
+        business_object_cache.clear()
+        field_id_cache.clear()
+        public_id_cache.clear()
+        missing_field_cache.clear()
+        self.server = FakeCherwellServer('user', 'secret').start()
+        self.addCleanup(self.server.stop)
+        self.cherwell = Cherwell('user', 'secret', self.server.url, use_bundled_wsdl=True)
+        del self.server.calls[:]
+
+
+class TestCherwellOffline(FakeServerTestCase):
+
+    def test_successful_call_is_one_round_trip(self):
+        recid = self.server.add_object('Incident', {'Summary': 'Unit Test'})
+        self.assertIsNotNone(self.cherwell.get_bus_obj_by_recid('Incident', recid))
+        self.assertEqual(self.server.calls, ['GetBusinessObject'])
+
+    def test_failed_call_asks_for_last_error_once(self):
+        self.assertFalse(self.cherwell.get_bus_obj_by_recid('Incident', 'missing'))
+        self.assertEqual(self.server.calls, ['GetBusinessObject', 'GetLastError'])
+
+    def test_relogin_after_session_expiry(self):
+        recid = self.server.add_object('Incident', {'Summary': 'Unit Test'})
+        self.server.expire_sessions()
+        self.assertIsNotNone(self.cherwell.get_bus_obj_by_recid('Incident', recid))
+        self.assertEqual(self.server.calls, ['GetBusinessObject', 'GetLastError', 'Login', 'GetBusinessObject'])
+
+    def test_streamed_call_answered_without_a_body(self):
+        transport = self.cherwell.cherwell.client.options.transport
+        transport.send = lambda request: None
+        self.assertIsNone(self.cherwell.cherwell.send_streamed('Logout'))
+
+    def test_get_bo_ids_matching_fields(self):
+        for x in range(10):
+            self.server.add_object('Incident', {'OwnedByTeam': 'Information Security', 'Priority': str(x % 3)})
+        matched = self.cherwell.get_bo_ids_matching_fields(
+            'Incident', {'OwnedByTeam': 'Information Security', 'Priority': '1'})
+        self.assertEqual(sorted(matched), ['100001', '100004', '100007'])
+
+    def test_get_bo_ids_matching_fields_shares_one_session_serially(self):
+        self.server.add_object('Incident', {'OwnedByTeam': 'Information Security', 'Priority': '1', 'Status': 'New'})
+        self.server.latency = 0.02
+        self.server.max_in_flight = 0
+        matched = self.cherwell.get_bo_ids_matching_fields(
+            'Incident', {'OwnedByTeam': 'Information Security', 'Priority': '1', 'Status': 'New'}, max_workers=3)
+        self.assertEqual(matched, ['100000'])
+        self.assertEqual(self.server.max_in_flight, 1)
+
+    def test_get_bo_ids_matching_fields_stops_at_empty_result(self):
+        self.server.add_object('Incident', {'OwnedByTeam': 'Information Security', 'Priority': '1'})
+        matched = self.cherwell.get_bo_ids_matching_fields(
+            'Incident', {'OwnedByTeam': 'Nobody', 'Priority': '1', 'Status': 'New'}, max_workers=1)
+        self.assertEqual(matched, [])
+        self.assertLess(self.server.call_count('QueryByFieldValue'), 3)
+
+    def test_get_bo_ids_matching_fields_selective_first(self):
+        for x in range(10):
+            self.server.add_object('Incident', {'OwnedByTeam': 'Information Security', 'Priority': str(x)})
+        fields = {'OwnedByTeam': 'Information Security', 'Priority': '5'}
+        self.cherwell.get_bo_ids_matching_fields('Incident', fields)
+        del self.server.calls[:]
+
+        self.cherwell.get_bo_ids_matching_fields('Incident', {'OwnedByTeam': 'Information Security', 'Priority': '11'},
+                                                 selective_first=True)
+        self.assertEqual(self.server.calls, ['QueryByFieldValue'])
+
+    def test_iter_query_ids(self):
+        query_result = ('<QueryResult><Records><Record RecId="a">1</Record><Record RecId="b">2</Record></Records>'
+                        '</QueryResult>')
+        records = self.cherwell.iter_query_ids(query_result)
+        self.assertEqual(next(records), ('a', '1'))
+        self.assertEqual(list(records), [('b', '2')])
+        self.assertEqual(self.cherwell.parse_query(query_result), ['a', 'b'])
+        self.assertEqual(self.cherwell.parse_query(query_result, wantpubid=True), ['1', '2'])
+
+    def test_iter_query_by_field_value(self):
+        recid = self.server.add_object('Incident', {'Status': 'New'})
+        self.server.add_stored_query('New Incidents', 'Incident', {'Status': 'New'})
+        self.assertEqual(list(self.cherwell.iter_query_by_field_value('Incident', 'Status', 'New', wantboth=True)),
+                         [(recid, '100000')])
+        self.assertEqual(list(self.cherwell.iter_query_by_stored_query('Incident', 'New Incidents', wantpubid=False)),
+                         [recid])
+
+
+class TestFaultInjection(FakeServerTestCase):
+
+    def test_injected_latency(self):
+        recid = self.server.add_object('Incident', {})
+        self.server.latency = {'GetBusinessObject': 0.05, None: 0}
+        started = time.time()
+        self.assertIsNotNone(self.cherwell.get_bus_obj_by_recid('Incident', recid))
+        self.assertGreaterEqual(time.time() - started, 0.05)
+
+    def test_injected_errors_are_reported_by_get_last_error(self):
+        recid = self.server.add_object('Incident', {})
+        self.server.error_rate = 1
+        self.assertFalse(self.cherwell.get_bus_obj_by_recid('Incident', recid))
+        self.assertEqual(self.cherwell.cherwell.last_error, 'Injected error')
+        self.assertEqual(self.server.calls, ['GetBusinessObject', 'GetLastError'])
+
+    def test_injection_is_repeatable(self):
+        def failures(seed):
+            server = FakeCherwellServer(error_rate=0.3, fault_rate=0.2, seed=seed)
+            return [server.injection('GetBusinessObject')[1] for x in range(50)]
+        self.assertEqual(failures(7), failures(7))
+        self.assertIn('fault', failures(7))
+        self.assertIn('error', failures(7))
+
+
+class TestKeepAliveConnection(TestCase):
+
+    def serve(self, answer):
+        """
+        Accept connections on a local port, reading one request from each and handing the socket to *answer*
+        """
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        self.addCleanup(listener.close)
+        self.requests = 0
+
+        def accept():
+            while True:
+                try:
+                    client, address = listener.accept()
+                except socket.error:
+                    return
+                request = ''
+                while '\r\n\r\n' not in request:
+                    request += client.recv(4096)
+                self.requests += 1
+                answer(client)
+        thread = threading.Thread(target=accept)
+        thread.daemon = True
+        thread.start()
+        return KeepAliveConnection('http', '127.0.0.1:%d' % listener.getsockname()[1], timeout=0.2)
+
+    def test_connection_closed_while_idle_is_reopened(self):
+        def answer_and_close(client):
+            client.sendall('HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok')
+            client.close()
+        connection = self.serve(answer_and_close)
+        for x in range(2):
+            response, data = connection.request('GET', '/')
+            self.assertEqual(data, 'ok')
+        self.assertEqual(self.requests, 2)
+
+    def test_timeout_is_not_sent_again(self):
+        def never_answer(client):
+            time.sleep(0.5)
+            client.close()
+        connection = self.serve(never_answer)
+        connection.connection = connection.connect()
+        with self.assertRaises(socket.timeout):
+            connection.request('POST', '/', 'create')
+        time.sleep(0.3)
+        self.assertEqual(self.requests, 1)
+
+    def test_request_sent_in_full_is_not_sent_again(self):
+        def answer_then_drop_next(client):
+            client.sendall('HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok')
+            request = ''
+            while '\r\n\r\n' not in request:
+                request += client.recv(4096)
+            self.requests += 1
+            client.close()
+        connection = self.serve(answer_then_drop_next)
+        self.assertEqual(connection.request('POST', '/', 'create')[1], 'ok')
+        with self.assertRaises(httplib.BadStatusLine):
+            connection.request('POST', '/', 'create')
+        time.sleep(0.3)
+        self.assertEqual(self.requests, 2)
+
+
+class TestCherwellPool(FakeServerTestCase):
+
+    def setUp(self):
+        super(TestCherwellPool, self).setUp()
+        self.pool = CherwellPool('user', 'secret', self.server.url, size=3, use_bundled_wsdl=True)
+
+    def tearDown(self):
+        self.pool.logout()
+        super(TestCherwellPool, self).tearDown()
+
+    def test_pool_is_drop_in_for_cherwell(self):
+        recid = self.server.add_object('Incident', {'OwnedByTeam': 'Information Security'})
+        self.assertEqual(self.pool.get_bus_obj_by_recid('Incident', recid),
+                         self.cherwell.get_bus_obj_by_recid('Incident', recid))
+        self.assertEqual(self.pool.get_incidents_of_team('Information Security'), ['100000'])
+
+    def test_threads_share_bounded_sessions(self):
+        recid = self.server.add_object('Incident', {})
+        results = []
+
+        def fetch():
+            for x in range(5):
+                results.append(self.pool.get_bus_obj_by_recid('Incident', recid))
+
+        threads = [threading.Thread(target=fetch) for x in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(results), 30)
+        self.assertEqual(len(set(results)), 1)
+        self.assertLessEqual(self.pool.session_count, 3)
+
+    def test_expired_session_is_recycled(self):
+        recid = self.server.add_object('Incident', {})
+        self.assertIsNotNone(self.pool.get_bus_obj_by_recid('Incident', recid))
+        self.assertEqual(self.pool.session_count, 1)
+
+        self.server.expire_sessions()
+        self.server.password = 'changed'
+        self.assertFalse(self.pool.get_bus_obj_by_recid('Incident', recid))
+        self.assertEqual(self.pool.session_count, 0)
+
+        self.pool.password = 'changed'
+        self.assertIsNotNone(self.pool.get_bus_obj_by_recid('Incident', recid))
+        self.assertEqual(self.pool.session_count, 1)
+
+
+class TestBulk(FakeServerTestCase):
+
+    def setUp(self):
+        super(TestBulk, self).setUp()
+        self.pool = CherwellPool('user', 'secret', self.server.url, size=3, use_bundled_wsdl=True)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.pool.logout()
+        shutil.rmtree(self.directory)
+        super(TestBulk, self).tearDown()
+
+    def test_bulk_create(self):
+        results = list(self.pool.bulk_create(('Incident', {'Summary': str(x)}) for x in range(20)))
+
+        self.assertEqual(len(results), 20)
+        self.assertTrue(all(result.ok for result in results))
+        self.assertEqual(sorted(self.server.objects[result.value][1]['Summary'] for result in results),
+                         sorted(str(x) for x in range(20)))
+        self.assertLessEqual(self.pool.session_count, 3)
+
+    def test_bulk_update_reports_errors_per_item(self):
+        recid = self.server.add_object('Incident', {'Status': 'New'})
+        objects = [('Incident', recid, {'Status': 'Closed'}), ('Incident', 'missing', {'Status': 'Closed'})]
+        results = sorted(self.cherwell.bulk_update(objects), key=lambda result: result.index)
+
+        self.assertTrue(results[0].ok)
+        self.assertEqual(self.server.objects[recid][1]['Status'], 'Closed')
+        self.assertEqual(results[1].error, 'Business object not found')
+        self.assertEqual(results[1].item, objects[1])
+
+    def test_single_connection_runs_inline(self):
+        threads = []
+        create = self.cherwell.create_business_object
+
+        def create_business_object(*args):
+            threads.append(threading.current_thread())
+            return create(*args)
+        self.cherwell.create_business_object = create_business_object
+        results = list(self.cherwell.bulk_create((('Incident', {'Summary': str(x)}) for x in range(5)), max_workers=4))
+
+        self.assertEqual([result.index for result in results], range(5))
+        self.assertEqual(set(threads), set([threading.current_thread()]))
+
+    def test_resume_from_checkpoint(self):
+        checkpoint_path = os.path.join(self.directory, 'checkpoint')
+        objects = [('Incident', {'Summary': str(x)}) for x in range(20)]
+        run = self.pool.bulk_create(objects, max_workers=2, checkpoint_path=checkpoint_path)
+        first_results = [next(run) for x in range(5)]
+        run.close()
+
+        resumed_results = list(self.pool.bulk_create(objects, max_workers=2, checkpoint_path=checkpoint_path))
+        self.assertEqual(len(self.server.objects), 20)
+        self.assertFalse(set(result.index for result in first_results) &
+                         set(result.index for result in resumed_results))
+        self.assertEqual(list(self.pool.bulk_create(objects, checkpoint_path=checkpoint_path)), [])
+
+    def test_resume_from_checkpoint_cut_short(self):
+        checkpoint_path = os.path.join(self.directory, 'checkpoint')
+        with open(checkpoint_path, 'w') as checkpoint_file:
+            checkpoint_file.write('{"index": 0, "value": "a"}\n{"index": 1, "value": "b"}\n{"index": 2, "va')
+        objects = [('Incident', {'Summary': str(x)}) for x in range(4)]
+
+        results = list(self.cherwell.bulk_create(objects, checkpoint_path=checkpoint_path))
+        self.assertEqual([result.index for result in results], [2, 3])
+        self.assertEqual(list(self.cherwell.bulk_create(objects, checkpoint_path=checkpoint_path)), [])
+
+    def test_items_are_read_as_workers_free_up(self):
+        read = []
+
+        def objects():
+            for x in range(100):
+                read.append(x)
+                yield 'Incident', {'Summary': str(x)}
+
+        run = self.pool.bulk_create(objects(), max_workers=2, max_pending=2)
+        next(run)
+        time.sleep(0.3)
+        self.assertLess(len(read), 20)
+        run.close()
+
+    def test_rate_limit(self):
+        started = time.time()
+        list(self.pool.bulk_create((('Incident', {}) for x in range(10)), rate=50))
+        self.assertGreaterEqual(time.time() - started, 0.17)
+
+
+class TestAttachmentUpload(FakeServerTestCase):
+
+    def setUp(self):
+        super(TestAttachmentUpload, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.recid = self.server.add_object('Incident', {'Summary': 'Unit Test'})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestAttachmentUpload, self).tearDown()
+
+    def write_file(self, data):
+        path = os.path.join(self.directory, 'evidence.bin')
+        with open(path, 'wb') as attachment_file:
+            attachment_file.write(data)
+        return path
+
+    def test_base64_stream_decodes_to_file(self):
+        for size in (0, 1, 2, 3, 4, 299, 300, 301, 1000):
+            data = os.urandom(size)
+            stream = EnvelopeStream(['<a>', Base64File(self.write_file(data), chunk_size=100), '</a>'])
+            blocks = []
+            while True:
+                block = stream.read(64)
+                if not block:
+                    break
+                self.assertLessEqual(len(block), 64)
+                blocks.append(block)
+            envelope = ''.join(blocks)
+            self.assertEqual(len(envelope), len(stream))
+            self.assertEqual(envelope[3:-4].decode('base64'), data)
+
+            stream.seek(0)
+            self.assertEqual(stream.read(), envelope)
+
+    def test_streamed_request_matches_built_request(self):
+        service = ServiceDescription()
+        path = self.write_file('blah\x00blah')
+        streamed = service.request_body('AddAttachmentToRecord', 'Incident', self.recid, 'a.txt', Base64File(path))
+        operation_name, params = service.parse_request(streamed.read())
+        self.assertEqual(params['attachmentData'], 'blah\x00blah'.encode('base64').strip())
+
+    def test_attach_file_is_encoded_once(self):
+        data = os.urandom(3 * 65536 + 7)
+        incident = Incident('100000', self.cherwell)
+        self.assertTrue(incident.attach_file('evidence.bin', self.write_file(data)))
+        self.assertEqual(self.server.attachments[self.recid], [('evidence.bin', data)])
+
+    def test_add_attachment_to_record_is_encoded_once(self):
+        self.assertTrue(self.cherwell.add_attachment_to_record('Incident', self.recid, 'a.txt', 'blah\x00blah'))
+        self.assertEqual(self.server.attachments[self.recid], [('a.txt', 'blah\x00blah')])
+
+    def test_upload_over_keep_alive_session_after_expiry(self):
+        pool = CherwellPool('user', 'secret', self.server.url, size=1, use_bundled_wsdl=True)
+        try:
+            path = self.write_file('evidence')
+            self.assertTrue(pool.add_attachment_from_file('Incident', self.recid, 'a.txt', path))
+            self.server.expire_sessions()
+            self.assertTrue(pool.add_attachment_from_file('Incident', self.recid, 'b.txt', path))
+        finally:
+            pool.logout()
+        self.assertEqual(self.server.attachments[self.recid], [('a.txt', 'evidence'), ('b.txt', 'evidence')])
+
+
+class TestAttachmentDownload(FakeServerTestCase):
+
+    def setUp(self):
+        super(TestAttachmentDownload, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.cache = AttachmentCache(os.path.join(self.directory, 'cache'))
+        self.cherwell.attachment_cache = self.cache
+        self.recid = self.server.add_object('Incident', {'Summary': 'Unit Test'})
+        self.data = os.urandom(300001)
+        self.attachment_id = self.server.add_attachment(self.recid, 'evidence.bin', self.data)
+        self.incident = Incident('100000', self.cherwell)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestAttachmentDownload, self).tearDown()
+
+    def read_file(self, path):
+        with open(path, 'rb') as downloaded_file:
+            return downloaded_file.read()
+
+    def test_list_and_download(self):
+        attachments = self.incident.list_attachments()
+        self.assertEqual(attachments, [{'Id': self.attachment_id, 'Name': 'evidence.bin', 'Size': '300001'}])
+
+        path = os.path.join(self.directory, 'evidence.bin')
+        self.assertTrue(self.incident.download_attachment(attachments[0], path))
+        self.assertEqual(self.read_file(path), self.data)
+
+    def test_attachment_is_downloaded_once(self):
+        first_path = os.path.join(self.directory, 'first')
+        second_path = os.path.join(self.directory, 'second')
+        self.assertTrue(self.cherwell.download_attachment(self.attachment_id, first_path))
+        self.assertTrue(self.cherwell.download_attachment(self.attachment_id, second_path))
+        self.assertEqual(self.server.call_count('GetAttachment'), 1)
+        self.assertEqual(self.read_file(second_path), self.data)
+
+        # A later run with the same cache directory
+        self.assertIsNotNone(AttachmentCache(self.cache.directory).get(self.cherwell.cherwell.endpoint(),
+                                                                       self.attachment_id))
+
+    def test_cache_is_opt_in(self):
+        cherwell = Cherwell('user', 'secret', self.server.url, use_bundled_wsdl=True)
+        path = os.path.join(self.directory, 'evidence.bin')
+        self.assertTrue(cherwell.download_attachment(self.attachment_id, path))
+        self.assertTrue(cherwell.download_attachment(self.attachment_id, path))
+        self.assertEqual(self.server.call_count('GetAttachment'), 2)
+        self.assertEqual(self.read_file(path), self.data)
+
+    def test_attachments_are_cached_per_server(self):
+        self.cherwell.download_attachment(self.attachment_id, os.path.join(self.directory, 'first'))
+        self.assertIsNotNone(self.cache.get(self.cherwell.cherwell.endpoint(), self.attachment_id))
+        self.assertIsNone(self.cache.get('http://other/CherwellService/api.asmx', self.attachment_id))
+
+    def test_least_recently_used_files_are_evicted(self):
+        self.cache.max_bytes = len(self.data) * 2
+        endpoint = self.cherwell.cherwell.endpoint()
+        other_ids = [self.server.add_attachment(self.recid, 'other.bin', os.urandom(len(self.data)))
+                     for x in range(2)]
+        self.cherwell.download_attachment(self.attachment_id, os.path.join(self.directory, 'first'))
+        # Used more recently than the next download
+        os.utime(self.cache.get(endpoint, self.attachment_id), (time.time() + 10,) * 2)
+        for other_id in other_ids:
+            self.cherwell.download_attachment(other_id, os.path.join(self.directory, other_id))
+
+        self.assertIsNotNone(self.cache.get(endpoint, self.attachment_id))
+        self.assertIsNone(self.cache.get(endpoint, other_ids[0]))
+        self.assertIsNotNone(self.cache.get(endpoint, other_ids[1]))
+
+    def test_same_content_is_stored_once(self):
+        copy_id = self.server.add_attachment(self.recid, 'copy.bin', self.data)
+        self.cherwell.download_attachment(self.attachment_id, os.path.join(self.directory, 'first'))
+        self.cherwell.download_attachment(copy_id, os.path.join(self.directory, 'second'))
+
+        endpoint = self.cherwell.cherwell.endpoint()
+        self.assertEqual(self.cache.get(endpoint, self.attachment_id), self.cache.get(endpoint, copy_id))
+        self.assertEqual(self.server.call_count('GetAttachment'), 2)
+
+    def test_missing_attachment(self):
+        path = os.path.join(self.directory, 'missing')
+        self.assertFalse(self.cherwell.download_attachment('missing', path))
+        self.assertIsNone(self.cache.get(self.cherwell.cherwell.endpoint(), 'missing'))
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(self.cherwell.download_attachment('missing', path, use_cache=False))
+        self.assertFalse(os.path.exists(path))
+
+    def test_download_without_cache_after_session_expiry(self):
+        pool = CherwellPool('user', 'secret', self.server.url, size=1, use_bundled_wsdl=True)
+        pool.attachment_cache = self.cache
+        try:
+            pool.get_attachments('Incident', self.recid)
+            self.server.expire_sessions()
+            path = os.path.join(self.directory, 'evidence.bin')
+            self.assertTrue(pool.download_attachment(self.attachment_id, path, use_cache=False))
+        finally:
+            pool.logout()
+        self.assertEqual(self.read_file(path), self.data)
+        self.assertFalse(os.path.exists(self.cache.directory))
+
+
+class TestPagedQueries(FakeServerTestCase):
+
+    def setUp(self):
+        super(TestPagedQueries, self).setUp()
+        for x in range(500):
+            self.server.add_object('Incident', {'OwnedByTeam': 'Information Security', 'Summary': 'Incident %d' % x})
+        self.server.add_stored_query('Security Incidents', 'Incident',
+                                     {'OwnedByTeam': 'Information Security'})
+
+    def test_objects_come_from_one_call(self):
+        incidents = list(self.cherwell.iter_query_results('Incident', 'Security Incidents', page_size=64))
+        self.assertEqual(len(incidents), 500)
+        self.assertEqual(incidents[7]['Summary'], 'Incident 7')
+        self.assertEqual(incidents[7].id, incidents[7]['RecID'])
+        self.assertEqual(self.server.calls, ['GetQueryResults'])
+
+    def test_record_limit_and_early_stop(self):
+        self.assertEqual(len(list(self.cherwell.iter_query_results('Incident', 'Security Incidents',
+                                                                   record_limit=20))), 20)
+        incidents = self.cherwell.iter_query_results('Incident', 'Security Incidents', page_size=10)
+        self.assertEqual(next(incidents)['Summary'], 'Incident 0')
+        incidents.close()
+        self.assertEqual(self.server.call_count('GetQueryResults'), 2)
+
+    def test_cached_objects_are_reused(self):
+        cached = list(self.cherwell.iter_query_results('Incident', 'Security Incidents', record_limit=1))[0]
+        again = list(self.cherwell.iter_query_results('Incident', 'Security Incidents', record_limit=1))[0]
+        self.assertIs(again, cached)
+        self.assertIs(business_object_cache.get(self.cherwell.endpoint(), 'Incident', cached.id), cached)
+
+    def test_failed_read_is_raised(self):
+        receive_streamed = self.cherwell.cherwell.receive_streamed
+
+        def cut_short(operation_name, write, *params):
+            # Read in full first, so the fake server is not cut off while it writes
+            pieces = []
+            receive_streamed(operation_name, pieces.append, *params)
+            text = ''.join(pieces)
+            write(text[:len(text) // 2])
+            raise socket.error(errno.ECONNRESET, 'Connection reset by peer')
+        self.cherwell.cherwell.receive_streamed = cut_short
+
+        incidents = self.cherwell.iter_query_results('Incident', 'Security Incidents', page_size=10)
+        self.assertRaises(socket.error, list, incidents)
+
+    def test_fault_is_raised_without_an_error_list(self):
+        def fail(session_id, params):
+            raise RuntimeError('Query failed')
+        self.server.handlers['GetQueryResults'] = fail
+
+        self.assertRaises(SoapFault, list, self.cherwell.iter_query_results('Incident', 'Security Incidents'))
+        errors = []
+        self.assertEqual(list(self.cherwell.iter_result_pages('GetQueryResults',
+                                                              ('Security Incidents', False, 0, False, 0.0, True),
+                                                              errors=errors)), [])
+        self.assertEqual(len(errors), 1)
+
+    def test_missing_query_and_item_list(self):
+        self.assertEqual(list(self.cherwell.iter_query_results('Incident', 'Missing')), [])
+        pool = CherwellPool('user', 'secret', self.server.url, size=1, use_bundled_wsdl=True)
+        try:
+            self.assertEqual(list(pool.iter_item_list('Query', 'Incident')),
+                             [{'Name': 'Security Incidents', 'Type': 'Query'}])
+            self.assertEqual(len(list(pool.iter_query_results('Incident', 'Security Incidents'))), 500)
+        finally:
+            pool.logout()
+
+
+class TestBusinessObjectOffline(FakeServerTestCase):
+
+    def setUp(self):
+        super(TestBusinessObjectOffline, self).setUp()
+        self.recid = self.server.add_object('Incident', {'Summary': 'Unit Test', 'Status': 'New'})
+        self.incident = Incident('100000', self.cherwell)
+        del self.server.calls[:]
+
+    def test_cached_fields_are_not_downloaded_again(self):
+        self.assertEqual(self.incident['Summary'], 'Unit Test')
+        self.assertEqual(self.incident['Status'], 'New')
+        self.assertEqual(self.server.calls, ['GetBusinessObjectByPublicId'])
+
+    def test_stale_fields_are_downloaded_again(self):
+        self.incident.field_ttl = 60
+        self.incident['Summary']
+        self.server.objects[self.recid][1]['Summary'] = 'Changed'
+        self.incident.field_times['Summary'] -= 61
+        self.assertEqual(self.incident['Summary'], 'Changed')
+        self.assertEqual(self.server.call_count('GetBusinessObjectByPublicId'), 2)
+
+    def test_missing_field_is_downloaded_once(self):
+        self.assertIsNone(self.incident['Sumary'])
+        self.assertIsNone(self.incident['Sumary'])
+        self.assertEqual(self.server.calls, ['GetBusinessObjectByPublicId'])
+
+    def test_missing_field_is_not_added_to_the_schema(self):
+        self.assertIsNone(self.incident['Sumary'])
+        self.assertNotIn('Sumary', FieldSchema.for_type('Incident').positions)
+
+    def test_missing_field_is_remembered_for_the_type(self):
+        self.assertIsNone(self.incident['Sumary'])
+        other = Incident(self.server.objects[self.server.add_object('Incident', {})][1]['IncidentID'], self.cherwell)
+        self.assertIsNone(other['Sumary'])
+        self.assertEqual(self.server.calls, ['GetBusinessObjectByPublicId'])
+
+    def test_invalidate_and_refresh(self):
+        self.incident['Summary']
+        self.server.objects[self.recid][1]['Summary'] = 'Changed'
+        self.incident.invalidate('Summary')
+        self.assertEqual(self.incident['Status'], 'New')
+        self.assertEqual(self.incident['Summary'], 'Changed')
+
+        self.server.objects[self.recid][1]['Status'] = 'Closed'
+        self.assertTrue(self.incident.refresh())
+        self.assertEqual(self.incident['Status'], 'Closed')
+        self.assertEqual(self.server.call_count('GetBusinessObjectByPublicId'), 3)
+
+    def test_to_xml_use_cached(self):
+        self.incident['Summary']
+        self.assertEqual(self.incident.to_xml(use_cached=True), self.incident.to_xml())
+        self.assertEqual(self.server.call_count('GetBusinessObjectByPublicId'), 2)
+
+    def test_to_xml_use_cached_downloads_partial_objects(self):
+        self.incident.import_fields({'Summary': 'Unit Test'})
+        self.assertIn('Name="Status"', self.incident.to_xml(use_cached=True))
+        self.assertEqual(self.server.calls, ['GetBusinessObjectByPublicId'])
+
+    def test_unchanged_writes_are_dropped(self):
+        self.incident['Summary']
+        self.incident['Summary'] = 'Unit Test'
+        self.incident.set_fields({'Status': 'New'})
+        self.assertEqual(self.server.call_count('UpdateBusinessObjectByPublicId'), 0)
+
+        self.incident['Status'] = 'Assigned'
+        self.assertEqual(self.server.call_count('UpdateBusinessObjectByPublicId'), 1)
+        self.assertEqual(self.server.objects[self.recid][1]['Status'], 'Assigned')
+
+    def test_changes_are_coalesced_into_one_update(self):
+        with self.incident:
+            self.incident['Status'] = 'Assigned'
+            self.incident.set_fields({'OwnedByTeam': 'Service Desk', 'Status': 'In Progress'})
+            self.incident.invalidate('Summary')
+            self.assertEqual(self.incident['Summary'], 'Unit Test')
+            self.assertEqual(self.incident['Status'], 'In Progress')
+            self.assertEqual(self.server.call_count('UpdateBusinessObjectByPublicId'), 0)
+
+        self.assertEqual(self.server.call_count('UpdateBusinessObjectByPublicId'), 1)
+        self.assertEqual(self.server.objects[self.recid][1]['Status'], 'In Progress')
+        self.assertEqual(self.server.objects[self.recid][1]['OwnedByTeam'], 'Service Desk')
+        self.assertFalse(self.incident.dirty_fields)
+
+    def test_failed_block_keeps_changes_until_commit(self):
+        try:
+            with self.incident:
+                self.incident['Status'] = 'Closed'
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(self.server.call_count('UpdateBusinessObjectByPublicId'), 0)
+        self.assertEqual(self.incident.dirty_fields, set(['Status']))
+
+        self.assertTrue(self.incident.commit())
+        self.assertEqual(self.server.objects[self.recid][1]['Status'], 'Closed')
+        self.assertTrue(self.incident.commit())
+        self.assertEqual(self.server.call_count('UpdateBusinessObjectByPublicId'), 1)
+
+    def test_create_incident_assigns_in_one_update(self):
+        factory = BusinessObjectFactory(self.cherwell)
+        del self.server.calls[:]
+        incident = factory.create_incident('nobody@example.com', 'Summary', 'Description', 'Service', 'Category',
+                                           'SubCategory', 'Service Desk')
+
+        record = self.server.objects[incident['RecID']][1]
+        self.assertEqual((record['Status'], record['OwnedByTeam']), ('New', 'Service Desk'))
+        self.assertEqual(self.server.call_count('CreateBusinessObject'), 1)
+        self.assertEqual(self.server.call_count('GetBusinessObject'), 1)
+        self.assertEqual(self.server.call_count('UpdateBusinessObject'), 0)
+        self.assertEqual(self.server.call_count('UpdateBusinessObjectByPublicId'), 1)
+
+    def test_create_is_one_create_and_one_fetch(self):
+        factory = BusinessObjectFactory(self.cherwell)
+        del self.server.calls[:]
+        incident = factory.create_bo_of_type(Incident, {'Summary': 'Created'}, haspubid=True)
+
+        self.assertEqual(self.server.calls, ['CreateBusinessObject', 'GetBusinessObject'])
+        self.assertTrue(incident.has_pubid)
+        self.assertEqual(incident.id, self.server.objects[incident['RecID']][1]['IncidentID'])
+        self.assertEqual(incident['Summary'], 'Created')
+        self.assertEqual(len(self.server.calls), 2)
+
+    def test_create_without_fetch(self):
+        factory = BusinessObjectFactory(self.cherwell)
+        del self.server.calls[:]
+        incident = factory.create_bo_of_type(Incident, {'Summary': 'Created'}, haspubid=True, fetch=False)
+
+        self.assertEqual(self.server.calls, ['CreateBusinessObject'])
+        self.assertFalse(incident.has_pubid)
+        self.assertEqual(incident['Summary'], 'Created')
+        self.assertEqual(incident['IncidentID'], self.server.objects[incident.id][1]['IncidentID'])
+        self.assertEqual(self.server.calls, ['CreateBusinessObject', 'GetBusinessObject'])
+
+
+class TestBusinessObjectXml(TestCase):
+
+    def test_writer_matches_element_tree(self):
+        field_dicts = [{},
+                       {'Summary': 'Unit Test'},
+                       {'Description': u'caf\xe9 & <b>bold</b> "quoted" > \u2603', 'Empty': '', 'Missing': None},
+                       {'Name "with" <specials> &\nnewline': 'x', 'Zero': 0},
+                       dict(('Field%d' % x, 'Value %d' % x) for x in range(200))]
+        for field_dict in field_dicts:
+            for botype in ('Incident', u'Odd "type" & <name>'):
+                self.assertEqual(BusinessObjectFactory.generate_object_xml(botype, field_dict),
+                                 BusinessObjectFactory.generate_object_xml_with_etree(botype, field_dict))
+
+    def test_writer_rejects_what_element_tree_rejects(self):
+        for field_dict in ({'Priority': 5}, {None: 'x'}):
+            self.assertRaises(TypeError, BusinessObjectFactory.generate_object_xml_with_etree, 'Incident', field_dict)
+            self.assertRaises(TypeError, BusinessObjectFactory.generate_object_xml, 'Incident', field_dict)
+
+class TestCompactFieldStorage(TestCase):
+
+    def test_objects_of_a_type_share_interned_field_names(self):
+        first = BusinessObject('CompactTest', 'x', None)
+        second = BusinessObject('CompactTest', 'y', None)
+        first.import_xml('<BusinessObject Name="CompactTest"><FieldList><Field Name="Summary">One</Field>'
+                         '<Field Name="Notes" /></FieldList></BusinessObject>')
+        second.import_xml(u'<BusinessObject Name="CompactTest"><FieldList><Field Name="Summary">Tw\xf6</Field>'
+                          u'</FieldList></BusinessObject>')
+
+        self.assertIs(first.fields.schema, FieldSchema.for_type('CompactTest'))
+        self.assertEqual(first.fields, {'Summary': 'One', 'Notes': None})
+        self.assertEqual(second.fields['Summary'], u'Tw\xf6')
+        self.assertNotIn('Notes', second.fields)
+        self.assertIs([name for name in first.fields if name == 'Summary'][0],
+                      [name for name in second.fields if name == 'Summary'][0])
+        self.assertFalse(hasattr(first, '__dict__'))
+        self.assertFalse(hasattr(Incident('1', None), '__dict__'))
+
+    def test_field_values_mapping(self):
+        bo = BusinessObject('CompactTest', 'x', None)
+        bo.fields['Status'] = 'New'
+        bo.fields.update({'Owner': 'me'})
+
+        self.assertEqual(len(bo.fields), 2)
+        self.assertEqual(bo.fields.get('Missing', 'default'), 'default')
+        self.assertEqual(bo.fields.pop('Owner'), 'me')
+        self.assertEqual(bo.fields.pop('Owner', None), None)
+        self.assertRaises(KeyError, bo.fields.__getitem__, 'Owner')
+        self.assertEqual(dict(bo.fields), {'Status': 'New'})
+
+    def test_nested_fields_are_not_imported(self):
+        bo = BusinessObject('CompactTest', 'x', None)
+        bo.import_xml('<BusinessObject Name="CompactTest"><FieldList><Field Name="A">a</Field></FieldList>'
+                      '<RelationshipList><FieldList><Field Name="B">b</Field></FieldList></RelationshipList>'
+                      '</BusinessObject>')
+        self.assertEqual(bo.fields, {'A': 'a'})
+
+
+class TestBusinessObjectCache(FakeServerTestCase):
+
+    def make_object(self, recid, pubid=None, **fields):
+        business_object = BusinessObject('Incident', pubid or recid, self.cherwell)
+        business_object.has_pubid = pubid is not None
+        business_object.import_xml(BusinessObjectFactory.generate_object_xml('Incident', dict(fields, RecID=recid)))
+        return business_object
+
+    def test_lookup_by_recid_and_public_id(self):
+        cache = BusinessObjectCache()
+        business_object = self.make_object('rec1', '100')
+        cache.add(business_object)
+        endpoint = self.cherwell.endpoint()
+        self.assertIs(cache.get(endpoint, 'Incident', 'rec1'), business_object)
+        self.assertIs(cache.get(endpoint, 'Incident', '100', is_pubid=True), business_object)
+        self.assertIsNone(cache.get('http://other/CherwellService/api.asmx', 'Incident', 'rec1'))
+        cache.invalidate(endpoint, 'Incident', '100', is_pubid=True)
+        self.assertIsNone(cache.get(endpoint, 'Incident', 'rec1'))
+        self.assertEqual(len(cache), 0)
+
+    def test_least_recently_used_are_evicted(self):
+        cache = BusinessObjectCache(max_objects=2)
+        first, second, third = [self.make_object('rec' + str(x)) for x in range(3)]
+        cache.add(first)
+        cache.add(second)
+        endpoint = self.cherwell.endpoint()
+        cache.get(endpoint, 'Incident', 'rec0')
+        cache.add(third)
+        self.assertIs(cache.get(endpoint, 'Incident', 'rec0'), first)
+        self.assertIsNone(cache.get(endpoint, 'Incident', 'rec1'))
+
+    def test_memory_cap(self):
+        cache = BusinessObjectCache(max_bytes=3000)
+        for x in range(5):
+            cache.add(self.make_object('rec' + str(x), Description='x' * 1000))
+        self.assertLessEqual(cache.total_bytes, 3000)
+        self.assertIsNotNone(cache.get(self.cherwell.endpoint(), 'Incident', 'rec4'))
+
+    def test_objects_of_other_servers_are_kept_apart(self):
+        other_server = FakeCherwellServer('user', 'secret').start()
+        self.addCleanup(other_server.stop)
+        other = Cherwell('user', 'secret', other_server.url, use_bundled_wsdl=True)
+        self.server.add_object('Incident', {'Summary': 'Here'})
+        other_server.add_object('Incident', {'Summary': 'There'})
+
+        self.assertEqual(BusinessObjectFactory(self.cherwell).get_bo_of_type(Incident, '100000')['Summary'], 'Here')
+        self.assertEqual(BusinessObjectFactory(other).get_bo_of_type(Incident, '100000')['Summary'], 'There')
+        self.assertEqual(other.get_recid('Incident', '100000'), other_server.public_ids[('Incident', '100000')])
+
+    def test_parent_incident_is_resolved_once(self):
+        self.server.add_object('Incident', {'Summary': 'Unit Test'})
+        factory = BusinessObjectFactory(self.cherwell)
+        factory.create_journal_entry('100000', 'first')
+        factory.create_team_note('100000', 'second')
+        factory.create_task('100000', 'Information Security', 'API Account', '1', 'Subject', 'Notes')
+        self.assertEqual(self.server.call_count('GetBusinessObjectByPublicId'), 0)
+        self.assertEqual(self.server.call_count('QueryByFieldValue'), 1)
+
+    def test_update_invalidates_cached_object(self):
+        recid = self.server.add_object('Incident', {'Summary': 'Unit Test'})
+        factory = BusinessObjectFactory(self.cherwell)
+        incident = factory.get_bo_of_type(Incident, '100000')
+        self.assertIs(factory.get_bo_of_type(Incident, '100000'), incident)
+
+        self.cherwell.update_business_object(recid, 'Incident', BusinessObjectFactory.generate_object_xml(
+            'Incident', {'Summary': 'Changed'}))
+        self.assertEqual(factory.get_bo_of_type(Incident, '100000')['Summary'], 'Changed')
+
+    def test_update_through_another_instance_keeps_the_shared_one(self):
+        recid = self.server.add_object('Incident', {'Summary': 'Unit Test', 'Status': 'New',
+                                                    'LastModifiedDateTime': '1/1/2016 9:00:00 AM'})
+        factory = BusinessObjectFactory(self.cherwell)
+        shared = factory.get_bo_of_type(Incident, '100000')
+        other = Incident('100000', self.cherwell)
+        other['Status'] = 'Closed'
+        # As Cherwell does when it applies an update
+        self.server.objects[recid][1]['LastModifiedDateTime'] = '1/2/2016 9:00:00 AM'
+        self.assertIs(factory.get_bo_of_type(Incident, '100000'), shared)
+        del self.server.calls[:]
+        self.assertEqual(shared['Status'], 'Closed')
+        self.assertEqual(shared['LastModifiedDateTime'], '1/2/2016 9:00:00 AM')
+        self.assertEqual(other['LastModifiedDateTime'], '1/2/2016 9:00:00 AM')
+        self.assertEqual(self.server.calls, ['GetBusinessObjectByPublicId'] * 2)
+
+
+class TestGetMany(FakeServerTestCase):
+
+    def test_ids_are_fetched_once_in_input_order(self):
+        for x in range(6):
+            self.server.add_object('Task', {'Summary': 'Task %d' % x})
+        cached = self.cherwell.get_many('Task', ['100001'])[0]
+        del self.server.calls[:]
+
+        ids = ['100003', '100001', '100003', 'missing', '100000', '100005']
+        tasks = self.cherwell.get_many('Task', ids, max_workers=3)
+        self.assertEqual([task['Summary'] if task else None for task in tasks],
+                         ['Task 3', 'Task 1', 'Task 3', None, 'Task 0', 'Task 5'])
+        self.assertIs(tasks[0], tasks[2])
+        self.assertIs(tasks[1], cached)
+        self.assertEqual(self.server.call_count('GetBusinessObjectByPublicId'), 4)
+
+    def test_single_connection_fetches_one_at_a_time(self):
+        recids = [self.server.add_object('Task', {'Summary': 'Task %d' % x}) for x in range(5)]
+        self.server.latency = 0.02
+        self.server.max_in_flight = 0
+        tasks = self.cherwell.get_many('Task', recids, wantpubid=False, max_workers=3)
+        self.assertEqual([task['RecID'] for task in tasks], recids)
+        self.assertEqual(self.server.max_in_flight, 1)
+
+    def test_by_recid_on_pool(self):
+        recids = [self.server.add_object('Task', {'Summary': 'Task %d' % x}) for x in range(5)]
+        pool = CherwellPool('user', 'secret', self.server.url, size=3, use_bundled_wsdl=True)
+        self.server.latency = 0.02
+        self.server.max_in_flight = 0
+        try:
+            tasks = pool.get_many('Task', recids, wantpubid=False)
+        finally:
+            pool.logout()
+        self.assertEqual([task['RecID'] for task in tasks], recids)
+        self.assertIs(tasks[0].cherwell_connection, pool)
+        self.assertGreater(self.server.max_in_flight, 1)
+
+    def test_related_objects(self):
+        recid = self.server.add_object('Incident', {'Summary': 'Unit Test'})
+        for x in range(3):
+            self.server.add_object('Task', {'ParentRecID': recid, 'Summary': 'Task %d' % x})
+        incident = Incident('100000', self.cherwell)
+        tasks = incident.get_tasks()
+        self.assertEqual(sorted(task['Summary'] for task in tasks), ['Task 0', 'Task 1', 'Task 2'])
+        self.assertEqual(self.server.call_count('GetBusinessObjectByPublicId'), 4)
+
+
+class TestMirror(FakeServerTestCase):
+
+    def setUp(self):
+        super(TestMirror, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.recids = [self.server.add_object('Incident', {'OwnedByTeam': 'Team %d' % (x % 3), 'Summary': str(x),
+                                                           'LastModifiedDateTime': '1/1/2016 9:00:00 AM'})
+                       for x in range(9)]
+        self.server.add_stored_query('All Incidents', 'Incident', {})
+        self.server.add_stored_query('Incidents Modified Today', 'Incident', {'ModifiedToday': 'Yes'})
+        self.mirror = self.make_mirror()
+        self.assertEqual(self.mirror.sync(), 9)
+        del self.server.calls[:]
+
+    def tearDown(self):
+        self.mirror.close()
+        shutil.rmtree(self.directory)
+        super(TestMirror, self).tearDown()
+
+    def make_mirror(self):
+        mirror = CherwellMirror(self.cherwell, os.path.join(self.directory, 'mirror.db'))
+        mirror.add_type('Incident', 'All Incidents', 'Incidents Modified Today', indexed_fields=['OwnedByTeam'])
+        return mirror
+
+    def modify(self, recid, **fields):
+        record = self.server.objects[recid][1]
+        record.update(fields, ModifiedToday='Yes')
+
+    def test_reads_are_answered_locally(self):
+        self.cherwell.mirror = self.mirror
+        self.assertEqual(sorted(self.cherwell.get_bo_ids_matching_fields('Incident', {'OwnedByTeam': 'Team 1'})),
+                         ['100001', '100004', '100007'])
+        self.assertEqual(Incident('100004', self.cherwell)['Summary'], '4')
+        self.assertEqual(BusinessObject('Incident', self.recids[5], self.cherwell)['Summary'], '5')
+        self.assertEqual(self.server.calls, [])
+
+        self.assertEqual(self.cherwell.query_by_field_value('Incident', 'Summary', '4'), ['100004'])
+        self.assertEqual(self.server.calls, ['QueryByFieldValue'])
+
+    def test_stale_type_is_read_from_cherwell(self):
+        self.cherwell.mirror = self.mirror
+        self.mirror.max_staleness = 0
+        time.sleep(0.01)
+        self.assertEqual(Incident('100004', self.cherwell)['Summary'], '4')
+        self.assertEqual(self.server.calls, ['GetBusinessObjectByPublicId'])
+
+    def test_incremental_sync(self):
+        self.modify(self.recids[0], Summary='Changed', LastModifiedDateTime='1/2/2016 9:00:00 AM')
+        self.modify(self.recids[1])
+        self.assertEqual(self.mirror.sync(), 1)
+        self.assertEqual(self.mirror.get_fields('Incident', '100000', is_pubid=True)['Summary'], 'Changed')
+
+        self.cherwell.mirror = self.mirror
+        self.cherwell.update_business_object('100001', 'Incident', BusinessObjectFactory.generate_object_xml(
+            'Incident', {'Summary': 'Updated'}), givenrecid=False)
+        self.assertIsNone(self.mirror.get_fields('Incident', '100001', is_pubid=True))
+        self.assertEqual(Incident('100001', self.cherwell)['Summary'], 'Updated')
+
+    def test_match_after_update_and_create(self):
+        self.cherwell.mirror = self.mirror
+        self.cherwell.update_business_object('100001', 'Incident', BusinessObjectFactory.generate_object_xml(
+            'Incident', {'Summary': 'Updated'}), givenrecid=False)
+        self.assertEqual(sorted(self.cherwell.get_bo_ids_matching_fields('Incident', {'OwnedByTeam': 'Team 1'})),
+                         ['100001', '100004', '100007'])
+        self.assertEqual(self.server.calls[-1], 'QueryByFieldValue')
+
+        recid = self.cherwell.create_business_object('Incident', BusinessObjectFactory.generate_object_xml(
+            'Incident', {'OwnedByTeam': 'Team 1'}))
+        self.assertIn(recid, self.cherwell.get_bo_ids_matching_fields('Incident', {'OwnedByTeam': 'Team 1'},
+                                                                      wantPubId=False))
+
+        self.assertEqual(self.mirror.sync(full=True), 2)
+        del self.server.calls[:]
+        self.assertEqual(len(self.cherwell.get_bo_ids_matching_fields('Incident', {'OwnedByTeam': 'Team 1'})), 4)
+        self.assertEqual(self.server.calls, [])
+
+    def test_mirror_is_readable_while_pages_are_read(self):
+        iter_result_pages = self.cherwell.iter_result_pages
+        reads = []
+
+        def read_between_pages(*args):
+            for rows in iter_result_pages(*args):
+                reader = threading.Thread(target=lambda: reads.append(self.mirror.get_fields('Incident', '100004',
+                                                                                             is_pubid=True)))
+                reader.start()
+                reader.join(5)
+                yield rows
+        self.cherwell.iter_result_pages = read_between_pages
+        self.mirror.page_size = 4
+        self.modify(self.recids[0], Summary='Changed', LastModifiedDateTime='1/2/2016 9:00:00 AM')
+
+        self.assertEqual(self.mirror.sync(full=True), 1)
+        self.assertEqual([fields['Summary'] for fields in reads], ['4'] * len(reads))
+        self.assertGreater(len(reads), 1)
+
+    def test_failed_sync_keeps_the_mirror(self):
+        self.server.stored_queries.clear()
+        self.assertIsNone(self.mirror.sync(full=True))
+        self.mirror.close()
+
+        # A later run with the same database
+        self.mirror = self.make_mirror()
+        self.assertTrue(self.mirror.is_fresh('Incident'))
+        self.assertEqual(len(self.mirror.match('Incident', {'OwnedByTeam': 'Team 2'}, wantpubid=False)), 3)
+
+        self.server.add_stored_query('All Incidents', 'Incident', {'OwnedByTeam': 'Team 0'})
+        self.assertEqual(self.mirror.sync(full=True), 0)
+        self.assertEqual(self.mirror.match('Incident', {'OwnedByTeam': 'Team 2'}), [])
+
+
+class TestQueryEngine(FakeServerTestCase):
+
+    def setUp(self):
+        super(TestQueryEngine, self).setUp()
+        for x in range(30):
+            self.server.add_object('Incident', {'OwnedByTeam': 'Information Security', 'Priority': str(x % 10),
+                                                'Status': 'Closed' if x % 2 else 'New'})
+        self.engine = QueryEngine(self.cherwell)
+        self.team = Eq('OwnedByTeam', 'Information Security')
+
+    def test_plan_follows_learned_selectivity(self):
+        query = self.team & Eq('Priority', '3')
+        self.assertEqual(sorted(self.engine.find_ids('Incident', query)), ['100003', '100013', '100023'])
+        self.assertEqual(self.server.calls, ['QueryByFieldValue', 'QueryByFieldValue'])
+        del self.server.calls[:]
+
+        explanation = self.engine.explain('Incident', query)
+        self.assertIn("QueryByFieldValue Priority = '3' (~3 rows)", explanation)
+        self.assertIn("round trips: ~4", explanation)
+        incidents = self.engine.find('Incident', query & Eq('Status', 'Closed'))
+        self.assertEqual([incident['Priority'] for incident in incidents], ['3', '3', '3'])
+        self.assertEqual(self.server.call_count('QueryByFieldValue'), 1)
+        self.assertEqual(self.server.call_count('GetBusinessObject'), 3)
+
+    def test_or_and_not(self):
+        self.assertEqual(sorted(self.engine.find_ids('Incident', Eq('Priority', '1') | Eq('Priority', '2'),
+                                                     wantpubid=False)),
+                         sorted(recid for recid, (bo_type, record) in self.server.objects.items()
+                                if record['Priority'] in ('1', '2')))
+        self.assertEqual(self.server.calls, ['QueryByFieldValue', 'QueryByFieldValue'])
+        self.assertRaises(ValueError, self.engine.plan, 'Incident', ~Eq('Status', 'Closed'))
+
+    def test_stored_query_is_chosen(self):
+        self.server.add_stored_query('Security Incidents', 'Incident', {'OwnedByTeam': 'Information Security'})
+        self.engine.add_stored_query('Incident', 'Security Incidents', self.team, columns=['Status', 'Priority'])
+        query = self.team & ~Eq('Status', 'Closed') & (Eq('Priority', '0') | Eq('Priority', '4'))
+        self.assertIn("GetQueryResults 'Security Incidents'", self.engine.explain('Incident', query))
+
+        incidents = self.engine.find('Incident', query)
+        self.assertEqual(sorted(incident['Priority'] for incident in incidents), ['0', '0', '0', '4', '4', '4'])
+        self.assertEqual(self.server.calls, ['GetQueryResults'])
+
+    def test_stored_query_rows_lacking_residual_fields_are_fetched(self):
+        self.server.add_stored_query('All Incidents', 'Incident', {}, columns=['OwnedByTeam', 'Priority'])
+        self.engine.add_stored_query('Incident', 'All Incidents')
+        self.assertIn("fetch each object", self.engine.explain('Incident', ~Eq('Status', 'Closed')))
+        self.engine.add_stored_query('Incident', 'Security Incidents', self.team)
+        self.assertIn("QueryByFieldValue", self.engine.explain('Incident', self.team & Eq('Priority', '3')))
+
+        incidents = self.engine.find('Incident', ~Eq('Status', 'Closed'))
+        self.assertEqual(len(incidents), 15)
+        self.assertEqual(set(incident['Status'] for incident in incidents), set(['New']))
+        self.assertEqual(self.server.call_count('GetQueryResults'), 1)
+        self.assertEqual(self.server.call_count('GetBusinessObject'), 30)
+
+
+class TestDefinitions(FakeServerTestCase):
+
+    def setUp(self):
+        super(TestDefinitions, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.server.add_definition('Incident', [
+            {'Name': 'RecID', 'Type': 'Text', 'Size': '42', 'Required': 'True'},
+            {'Name': 'IncidentID', 'Type': 'Number', 'Required': 'True'},
+            {'Name': 'CreatedDateTime', 'Type': 'DateTime', 'Required': 'True'},
+            {'Name': 'Stat_Age', 'Type': 'Number', 'Required': 'True', 'Calculated': 'True'},
+            {'Name': 'Summary', 'Type': 'Text', 'Size': '20', 'Required': 'True'},
+            {'Name': 'Priority', 'Type': 'Number'},
+            {'Name': 'Reviewed', 'Type': 'Logical'},
+        ])
+        self.recid = self.server.add_object('Incident', {'Summary': 'Unit Test'})
+        self.cherwell.definitions = DefinitionCache(self.directory)
+        del self.server.calls[:]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestDefinitions, self).tearDown()
+
+    def update(self, fields):
+        return self.cherwell.update_business_object(
+            self.recid, 'Incident', BusinessObjectFactory.generate_object_xml('Incident', fields))
+
+    def test_bad_fields_are_not_sent(self):
+        self.assertFalse(self.update({'Sumary': 'Typo'}))
+        self.assertEqual(self.cherwell.cherwell.last_error, 'Incident has no field Sumary')
+        self.assertFalse(self.update({'Priority': 'high', 'Reviewed': 'maybe', 'Summary': 'x' * 21}))
+        self.assertTrue(self.update({'Priority': '2', 'Reviewed': 'True'}))
+        self.assertEqual(self.server.calls, ['GetBusinessObjectDefinition', 'UpdateBusinessObject'])
+
+    def test_create_needs_required_fields(self):
+        def create(fields):
+            return self.cherwell.create_business_object(
+                'Incident', BusinessObjectFactory.generate_object_xml('Incident', fields))
+
+        self.assertIsNone(create({'Priority': '1'}))
+        self.assertEqual(self.cherwell.cherwell.last_error, 'Summary is required')
+        self.assertTrue(create({'Priority': '1', 'Summary': 'New'}))
+        self.assertEqual(self.server.call_count('CreateBusinessObject'), 1)
+
+    def test_fields_are_checked_before_they_are_written(self):
+        factory = BusinessObjectFactory(self.cherwell)
+        self.assertFalse(factory.create_business_object('Incident', {'Priority': '1'}).id)
+        self.assertEqual(self.cherwell.cherwell.last_error, 'Summary is required')
+        results = list(self.cherwell.bulk_update([('Incident', self.recid, {'Priority': 'high'})]))
+        self.assertEqual(results[0].error, 'Priority must be a number, not %r' % 'high')
+        self.assertEqual(self.server.calls, ['GetBusinessObjectDefinition'])
+
+    def test_definition_is_kept_on_disk(self):
+        self.addCleanup(FieldSchema.schemas.__setitem__, 'Incident', FieldSchema.schemas.pop('Incident', None) or
+                        FieldSchema('Incident'))
+        self.assertTrue(self.update({'Priority': '2'}))
+        self.cherwell.definitions = DefinitionCache(self.directory)
+        self.assertTrue(self.update({'Priority': '3'}))
+        self.assertEqual(self.server.call_count('GetBusinessObjectDefinition'), 1)
+        self.assertEqual(FieldSchema.for_type('Incident').names[:3], ['RecID', 'IncidentID', 'CreatedDateTime'])
+
+        # A field added on the server since the definition was fetched
+        self.server.definitions['Incident'].append({'Name': 'Category', 'Type': 'Text'})
+        self.cherwell.definitions.recheck_age = 0
+        self.assertTrue(self.update({'Category': 'Security'}))
+        self.assertEqual(self.server.call_count('GetBusinessObjectDefinition'), 2)
+
+    def test_unknown_type_is_not_checked(self):
+        self.assertTrue(self.cherwell.create_business_object('Task', BusinessObjectFactory.generate_object_xml(
+            'Task', {'Anything': 'goes'})))
+
+
+class TestMetrics(FakeServerTestCase):
+
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        self.metrics = self.cherwell.cherwell.metrics = Metrics()
+
+    def test_calls_are_tagged_with_their_caller(self):
+        factory = BusinessObjectFactory(self.cherwell)
+        factory.create_incident('nobody@example.com', 'Summary', 'Description', 'Service', 'Category',
+                                'SubCategory', 'Service Desk')
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(snapshot['callers']['BusinessObjectFactory.create_incident']['invocations'], 1)
+        self.assertEqual(sum(snapshot['callers']['BusinessObjectFactory.create_incident']['calls'].values()),
+                         len(self.server.calls) - self.server.call_count('GetLastError'))
+
+        create = snapshot['operations']['CreateBusinessObject']
+        self.assertEqual(create['calls'], 1)
+        self.assertGreater(create['request_bytes'], 0)
+        self.assertGreater(create['response_bytes'], 0)
+        self.assertIsNotNone(create['p99'])
+
+    def test_threads_carry_the_caller(self):
+        recids = [self.server.add_object('Task', {}) for x in range(4)]
+        self.cherwell.get_many('Task', recids, wantpubid=False)
+        self.assertEqual(self.metrics.snapshot()['callers']['Cherwell.get_many'],
+                         {'invocations': 1, 'calls': {'GetBusinessObject': 4}})
+
+    def test_relogins_and_failures(self):
+        recid = self.server.add_object('Incident', {})
+        self.server.expire_sessions()
+        self.cherwell.get_bus_obj_by_recid('Incident', recid)
+        self.cherwell.get_bus_obj_by_recid('Incident', 'missing')
+        stats = self.metrics.snapshot()['operations']['GetBusinessObject']
+        self.assertEqual((stats['calls'], stats['retries'], stats['relogins'], stats['last_error_hits'],
+                          stats['failures']), (2, 1, 1, 2, 1))
+
+    def test_exporters_and_hooks(self):
+        calls = []
+        self.metrics.add_hook(calls.append)
+        self.server.add_stored_query('All Incidents', 'Incident', {})
+        self.server.add_object('Incident', {'Summary': 'Unit Test'})
+        self.assertEqual(len(list(self.cherwell.iter_query_results('Incident', 'All Incidents'))), 1)
+        self.assertEqual([(call.operation, call.error) for call in calls], [('GetQueryResults', None)])
+        self.assertGreater(calls[0].response_bytes, 0)
+
+        prometheus = self.metrics.to_prometheus()
+        self.assertIn('cherwell_soap_calls_total{operation="GetQueryResults"} 1\n', prometheus)
+        self.assertIn('cherwell_soap_latency_seconds_bucket{operation="GetQueryResults",le="+Inf"} 1\n', prometheus)
+        self.assertEqual(json.loads(self.metrics.to_json())['operations']['GetQueryResults']['calls'], 1)
+
+
+class TestRoundTripProfiler(FakeServerTestCase):
+
+    def create_incident(self):
+        factory = BusinessObjectFactory(self.cherwell)
+        return factory.create_incident('nobody@example.com', 'Summary', 'Description', 'Service', 'Category',
+                                       'SubCategory', 'Service Desk')
+
+    def test_calls_are_kept_under_their_callers(self):
+        with RoundTripProfiler() as profiler:
+            self.create_incident()
+        self.assertEqual(profiler.round_trips, len(self.server.calls))
+        root = profiler.tree()
+        self.assertEqual(root.round_trips, profiler.round_trips)
+        create_incident = root.children['BusinessObjectFactory.create_incident']
+        self.assertEqual(create_incident.round_trips, profiler.round_trips)
+        self.assertIn('CreateBusinessObject', profiler.folded())
+        self.assertTrue(all(line.startswith('block;BusinessObjectFactory.create_incident;')
+                            for line in profiler.folded().splitlines()))
+        self.assertIn('BusinessObjectFactory.create_incident', profiler.report())
+
+    def test_repeated_calls_are_found(self):
+        recid = self.server.add_object('Task', {})
+        recids = [self.server.add_object('Task', {}) for x in range(3)]
+        with RoundTripProfiler() as profiler:
+            self.cherwell.get_many('Task', recids, wantpubid=False)
+            for x in range(2):
+                business_object_cache.clear()
+                self.cherwell.get_bus_obj_by_recid('Task', recid)
+        duplicates = profiler.duplicates()
+        self.assertEqual([(operation, len(calls)) for operation, arguments, calls in duplicates],
+                         [('GetBusinessObject', 2)])
+        self.assertIn(recid, duplicates[0][1])
+        get_many = profiler.tree().children['Cherwell.get_many']
+        self.assertEqual(get_many.calls, 3)
+        self.assertEqual(get_many.children['Cherwell.get_bus_obj_by_recid'].children['GetBusinessObject'].calls, 3)
+        self.assertIn('Repeated calls:', profiler.report())
+
+    def test_strict_budget(self):
+        with RoundTripProfiler(budget=20, strict=True) as profiler:
+            self.create_incident()
+        self.assertFalse(profiler.over_budget)
+
+        with self.assertRaises(RoundTripBudgetExceeded) as raised:
+            with RoundTripProfiler(budget=1, strict=True):
+                self.create_incident()
+        self.assertIn('of 1 budgeted', str(raised.exception))
+
+
+class TestRecordReplay(FakeServerTestCase):
+
+    def setUp(self):
+        super(TestRecordReplay, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.cassette_path = os.path.join(self.directory, 'workflow.cassette')
+        self.server.add_object('CustomerInternal', {'Email': 'nobody@example.com', 'FullName': 'Nobody'})
+
+    def connect(self, transport):
+        return Cherwell('user', 'secret', self.server.url, use_bundled_wsdl=True, transport=transport)
+
+    def run_workflow(self, cherwell):
+        business_object_cache.clear()
+        field_id_cache.clear()
+        public_id_cache.clear()
+        factory = BusinessObjectFactory(cherwell)
+        incident = factory.create_incident('nobody@example.com', 'Summary', 'Description', 'Service', 'Category',
+                                           'SubCategory', 'Service Desk')
+        task = factory.create_task(incident.id, 'Service Desk', 'Nobody', '1', 'Subject', 'Notes')
+        journal = factory.create_journal_entry(incident.id, 'Created a task')
+        return incident.id, incident['Status'], task['RecID'], journal['RecID']
+
+    def record(self):
+        recorder = RecordingTransport(self.cassette_path, KeepAliveTransport())
+        recorded = self.run_workflow(self.connect(recorder))
+        recorder.close()
+        return recorded
+
+    def test_replay_without_the_server(self):
+        recorded = self.record()
+        calls = self.server.call_count()
+        replayer = ReplayTransport(self.cassette_path, time_scale=0, strict=True)
+        self.assertEqual(self.run_workflow(self.connect(replayer)), recorded)
+        self.assertEqual(self.server.call_count(), calls)
+        self.assertEqual(replayer.unplayed, [])
+
+    def test_credentials_are_scrubbed(self):
+        self.record()
+        with gzip.open(self.cassette_path, 'rb') as cassette_file:
+            cassette = cassette_file.read()
+        self.assertNotIn('secret', cassette)
+        self.assertIn('ASP.NET_SessionId=scrubbed', cassette)
+        self.assertFalse(any(session_id in cassette for session_id in self.server.sessions))
+
+    def test_streamed_calls_and_original_timing(self):
+        self.server.add_stored_query('All Incidents', 'Incident', {})
+        self.server.add_object('Incident', {'Summary': 'Unit Test'})
+        self.server.latency = 0.05
+        recorder = RecordingTransport(self.cassette_path)
+        rows = [incident['Summary'] for incident in
+                self.connect(recorder).iter_query_results('Incident', 'All Incidents')]
+        recorder.close()
+
+        self.server.stop()
+        # Started again before the stop every test ends with
+        self.addCleanup(self.server.start)
+        replayer = ReplayTransport(self.cassette_path)
+        cherwell = self.connect(replayer)
+        business_object_cache.clear()
+        started = time.time()
+        self.assertEqual([incident['Summary'] for incident in
+                          cherwell.iter_query_results('Incident', 'All Incidents')], rows)
+        self.assertGreaterEqual(time.time() - started, 0.05)
+
+    def test_streamed_bodies_are_not_held_in_memory(self):
+        recid = self.server.add_object('Incident', {'Summary': 'Unit Test'})
+        data = os.urandom(300000)
+        attachment_id = self.server.add_attachment(recid, 'evidence.bin', data)
+        upload_path = os.path.join(self.directory, 'upload.bin')
+        with open(upload_path, 'wb') as upload_file:
+            upload_file.write(data)
+        download_path = os.path.join(self.directory, 'download.bin')
+        recorder = RecordingTransport(self.cassette_path)
+        cherwell = self.connect(recorder)
+        self.assertTrue(cherwell.download_attachment(attachment_id, download_path))
+        self.assertTrue(cherwell.add_attachment_from_file('Incident', recid, 'upload.bin', upload_path))
+        recorder.close()
+
+        with gzip.open(self.cassette_path, 'rb') as cassette_file:
+            entries = [json.loads(line) for line in cassette_file][1:]
+        streamed = [entry for entry in entries if entry.get('kind') == 'streamed']
+        self.assertEqual(len(streamed), 1)
+        self.assertGreater(len([entry for entry in entries if entry.get('part') == streamed[0]['part']]), 2)
+
+        os.remove(download_path)
+        cherwell = self.connect(ReplayTransport(self.cassette_path, time_scale=0, strict=True))
+        self.assertTrue(cherwell.download_attachment(attachment_id, download_path))
+        with open(download_path, 'rb') as download_file:
+            self.assertEqual(download_file.read(), data)
+        self.assertTrue(cherwell.add_attachment_from_file('Incident', recid, 'upload.bin', upload_path))
+
+
+class TestIdResolution(FakeServerTestCase):
+
+    def setUp(self):
+        super(TestIdResolution, self).setUp()
+        self.customer_recid = self.server.add_object('CustomerInternal', {'Email': 'test@test.com',
+                                                                          'CustomerInternalID': 'Test, Unit'})
+
+    def test_customer_ids_come_from_one_query(self):
+        self.assertEqual(self.cherwell.get_customer_ids('test@test.com'), (self.customer_recid, 'Test, Unit'))
+        self.assertEqual(self.cherwell.get_customer_id('test@test.com'), 'Test, Unit')
+        self.assertEqual(self.cherwell.get_customer_id('test@test.com', wantpubid=False), self.customer_recid)
+        self.assertEqual(self.server.calls, ['QueryByFieldValue'])
+        self.assertRaises(IndexError, self.cherwell.get_customer_id, 'nobody@test.com')
+
+    def test_incidents_for_known_customer_need_no_lookups(self):
+        factory = BusinessObjectFactory(self.cherwell)
+        for x in range(3):
+            fields = dict()
+            factory.populate_customer_field('test@test.com', fields)
+            self.assertEqual(fields['CustomerRecID'], self.customer_recid)
+            self.assertEqual(fields['CustomerDisplayName'], 'Test, Unit')
+        self.assertEqual(self.server.calls, ['QueryByFieldValue'])
+
+    def test_preloaded_customers_need_no_lookups(self):
+        self.server.add_object('CustomerInternal', {'Email': 'other@test.com', 'CustomerInternalID': 'Test, Other'})
+        self.server.add_stored_query('All Customers', 'CustomerInternal', {})
+        self.assertEqual(self.cherwell.preload_customer_ids('All Customers'), 2)
+        del self.server.calls[:]
+        factory = BusinessObjectFactory(self.cherwell)
+        fields = dict()
+        factory.populate_customer_field('test@test.com', fields)
+        self.assertEqual((fields['CustomerRecID'], fields['CustomerDisplayName']), (self.customer_recid, 'Test, Unit'))
+        self.assertEqual(self.cherwell.get_customer_id('other@test.com'), 'Test, Other')
+        self.assertEqual(self.server.calls, [])
+
+    def test_set_customer_with_unknown_email(self):
+        incident = Incident(self.server.objects[self.server.add_object('Incident', {})][1]['IncidentID'],
+                            self.cherwell)
+        self.assertRaises(IndexError, incident.set_customer, 'nobody@test.com')
+
+    def test_preload_ids(self):
+        recid = self.server.add_object('Incident', {'Status': 'New'})
+        self.server.add_stored_query('New Incidents', 'Incident', {'Status': 'New'})
+        self.assertEqual(self.cherwell.preload_ids('Incident', 'New Incidents'), 1)
+        del self.server.calls[:]
+        self.assertEqual(self.cherwell.get_recid('Incident', self.server.objects[recid][1]['IncidentID']), recid)
+        self.assertEqual(self.server.calls, [])
+
+    def test_recid_from_downloaded_object_with_non_ascii_fields(self):
+        self.cherwell.query_ids_by_field_value = lambda *args: []
+        self.cherwell.get_bus_obj_by_publicid = lambda *args: (
+            '<BusinessObject Name="Incident"><FieldList><Field Name="RecID">rec1</Field>'
+            '<Field Name="Summary">Caf\xc3\xa9</Field></FieldList></BusinessObject>')
+        self.assertEqual(self.cherwell.get_recid('Incident', '100'), 'rec1')
+
+    def test_ttl_cache_expiry_and_bound(self):
+        cache = TTLCache(max_entries=2, ttl=60)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('c'), 3)
+        cache.entries['c'] = (0, 3)
+        self.assertIsNone(cache.get('c'))